@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from metrics import metrics
+from snapshot import encode_snapshot, read_snapshot
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DURATION = metrics.histogram('bot_backup_duration_seconds', 'Длительность записи резервной копии', ['kind'])
+BACKUP_BYTES = metrics.counter('bot_backup_bytes_total', 'Байт записано в резервные копии', ['kind'])
+
+# Разделы снимка, которые сравниваются по ключам (топикам и чатам)
+SECTIONS = ('queues', 'pending_swaps', 'queue_message_ids', 'known_users', 'topic_to_chat', 'queue_stats',
+            'topic_expiry', 'topic_policies')
+# Имя копии: время создания и вид, например 20261019-153000-123-diff.qsnap
+BACKUP_NAME = re.compile(r'^(\d{8}-\d{6}-\d{3})-(full|diff)\.qsnap$')
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8')).digest()
+
+
+def _copy_state(data):
+    """Копия снимка для записи в другом потоке: списки и записи копируются,
+    чтобы обработчики могли менять очереди, пока копия пишется"""
+    return {
+        'queues': {k: [dict(entry) for entry in v] for k, v in data['queues'].items() if v},
+        'pending_swaps': {k: dict(v) for k, v in data['pending_swaps'].items()},
+        'queue_message_ids': {k: v for k, v in data['queue_message_ids'].items() if v is not None},
+        'known_users': {k: [dict(user) for user in v] for k, v in data['known_users'].items() if v},
+        'topic_to_chat': dict(data['topic_to_chat']),
+        # Статистика и политики сериализуются заново при каждом snapshot_data, копировать не нужно
+        'queue_stats': dict(data['queue_stats']),
+        'topic_expiry': {k: dict(v) for k, v in data['topic_expiry'].items()},
+        'topic_policies': dict(data['topic_policies']),
+    }
+
+
+def apply_changes(state, changes):
+    """Применение разностной копии к состоянию полной"""
+    for section, delta in changes.items():
+        values = state.setdefault(section, {})
+        for key in delta.get('deleted', []):
+            values.pop(key, None)
+        values.update(delta.get('set', {}))
+    return state
+
+
+class BackupManager:
+    """
+    Резервные копии с ротацией
+    Полная копия хранит всё состояние, разностная - только топики и чаты, изменившиеся
+    с последней полной. Восстановление читает не больше двух файлов. Новая полная копия
+    создаётся после full_every разностных или если разностная выросла до половины полной.
+    Хранятся keep_full последних полных копий с их разностными
+    """
+    def __init__(self, directory, full_every=24, keep_full=7, interval=3600):
+        self.directory = directory
+        self.full_every = full_every
+        self.keep_full = keep_full
+        self.interval = interval
+        # Хэши значений последней полной копии: {раздел: {ключ: sha1}}
+        self._base = None
+        self._base_name = None
+        self._base_bytes = 0
+        self._diffs_since_full = 0
+        self._lock = asyncio.Lock()
+
+    def list_backups(self):
+        """Копии по возрастанию времени: [{'name', 'kind', 'bytes', 'path'}]"""
+        if not os.path.isdir(self.directory):
+            return []
+        backups = []
+        for filename in sorted(os.listdir(self.directory)):
+            match = BACKUP_NAME.match(filename)
+            if match:
+                path = os.path.join(self.directory, filename)
+                backups.append({
+                    'name': filename[:-len('.qsnap')],
+                    'kind': match.group(2),
+                    'bytes': os.path.getsize(path),
+                    'path': path,
+                })
+        return backups
+
+    async def create(self, manager):
+        """Создать копию текущего состояния. Запись и сжатие - в отдельном потоке"""
+        async with self._lock:
+            # Копия снимается в событийном цикле, пока состояние не меняется
+            state = _copy_state(manager.snapshot_data())
+            return await asyncio.to_thread(self._write, state)
+
+    def _write(self, state):
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        digests = {section: {key: _digest(value) for key, value in state[section].items()} for section in SECTIONS}
+
+        kind = 'full'
+        payload = None
+        if self._base is not None and self._diffs_since_full < self.full_every:
+            changes = {}
+            for section in SECTIONS:
+                base, current = self._base[section], digests[section]
+                changed = {key: state[section][key] for key, digest in current.items() if base.get(key) != digest}
+                deleted = [key for key in base if key not in current]
+                if changed or deleted:
+                    changes[section] = {'set': changed, 'deleted': deleted}
+            payload = encode_snapshot(
+                {'kind': 'diff', 'base': self._base_name, 'created': datetime.now().isoformat(), 'changes': changes},
+                'gzip'
+            )
+            if len(payload) * 2 < self._base_bytes:
+                kind = 'diff'
+        if kind == 'full':
+            payload = encode_snapshot({'kind': 'full', 'created': datetime.now().isoformat(), 'state': state}, 'gzip')
+
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]}-{kind}"
+        path = os.path.join(self.directory, name + '.qsnap')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+        if kind == 'full':
+            self._base = digests
+            self._base_name = name
+            self._base_bytes = len(payload)
+            self._diffs_since_full = 0
+            self._trim()
+        else:
+            self._diffs_since_full += 1
+
+        duration = time.perf_counter() - start
+        BACKUP_DURATION.observe(duration, kind=kind)
+        BACKUP_BYTES.inc(len(payload), kind=kind)
+        logger.info(f"Backup {name} written: {len(payload)} bytes in {duration * 1000:.1f} ms")
+        return {'name': name, 'kind': kind, 'bytes': len(payload)}
+
+    def _trim(self):
+        """Удаление полных копий сверх keep_full вместе с их разностными"""
+        backups = self.list_backups()
+        fulls = [b for b in backups if b['kind'] == 'full']
+        if len(fulls) <= self.keep_full:
+            return
+        # Разностные копии всегда ссылаются на предшествующую им полную
+        oldest_kept = fulls[-self.keep_full]['name']
+        for backup in backups:
+            if backup['name'] < oldest_kept:
+                try:
+                    os.remove(backup['path'])
+                    logger.info(f"Backup {backup['name']} removed by retention")
+                except OSError as e:
+                    logger.error(f"Failed to remove backup {backup['name']}: {e}")
+
+    def load(self, name):
+        """Состояние на момент копии name (полной или разностной)"""
+        backup = next((b for b in self.list_backups() if b['name'] == name), None)
+        if backup is None:
+            raise FileNotFoundError(f"Backup {name} not found")
+        data = read_snapshot(backup['path'])
+        if data['kind'] == 'full':
+            return data['state']
+        base = read_snapshot(os.path.join(self.directory, data['base'] + '.qsnap'))
+        return apply_changes(base['state'], data['changes'])
+
+    async def load_async(self, name):
+        return await asyncio.to_thread(self.load, name)
+
+
+async def callback_scheduled_backup(context):
+    """Периодическая резервная копия"""
+    # Импорт здесь: консольные команды модуля не должны загружать файл данных
+    from queue_manager import queue_manager
+    try:
+        await backup_manager.create(queue_manager)
+    except Exception as e:
+        logger.error(f"Error in scheduled backup: {e}")
+
+
+def register_backups(application):
+    """Периодические копии каждые BACKUP_INTERVAL секунд (0 - только по /backup)"""
+    if application.job_queue and backup_manager.interval > 0:
+        application.job_queue.run_repeating(
+            callback_scheduled_backup, interval=backup_manager.interval, first=backup_manager.interval
+        )
+
+
+def backup_manager_from_env():
+    """BackupManager с настройками BACKUP_*"""
+    return BackupManager(
+        os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups')),
+        full_every=int(os.getenv('BACKUP_FULL_EVERY', '24')),
+        keep_full=int(os.getenv('BACKUP_KEEP_FULL', '7')),
+        interval=int(os.getenv('BACKUP_INTERVAL', '3600')),
+    )
+
+
+# Глобальный экземпляр (main.py загружает .env до импорта модулей)
+backup_manager = backup_manager_from_env()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Резервные копии очередей")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help="Список копий")
+    restore = subparsers.add_parser('restore', help="Собрать файл данных из копии (бот должен быть остановлен)")
+    restore.add_argument('name')
+    restore.add_argument('--output', required=True, help="Файл данных, например queues_data.json")
+    restore.add_argument('--compression', default='none', choices=['none', 'gzip', 'lzma'])
+    args = parser.parse_args()
+    # Отдельный запуск: настройки из .env, как у бота
+    load_dotenv()
+    manager = backup_manager_from_env()
+
+    if args.command == 'list':
+        for backup in manager.list_backups():
+            print(f"{backup['name']}\t{backup['kind']}\t{backup['bytes']}")
+        return
+
+    state = manager.load(args.name)
+    state['last_save'] = datetime.now().isoformat()
+    with open(args.output + '.tmp', 'wb') as f:
+        f.write(encode_snapshot(state, args.compression))
+    os.replace(args.output + '.tmp', args.output)
+    print(f"{args.name} -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Потребление памяти PersistentQueueManager на синтетических данных
+
+Для каждого масштаба (см. bench_queue_manager.SCALES) в отдельном процессе строится
+состояние и замеряются: прирост памяти по tracemalloc и RSS, байты на известного
+пользователя и на запись в очереди, пиковая память save_data и load_data.
+
+Запуск:
+    python benchmarks/bench_memory.py --scales small medium large --output memory.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from queue_manager import PersistentQueueManager  # noqa: E402
+from bench_queue_manager import SCALES, build_state  # noqa: E402
+
+
+def current_rss():
+    """Текущий RSS процесса в байтах (Linux: /proc, иначе - пиковый RSS)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss: килобайты в Linux, байты в macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def traced_peak(func):
+    """Пиковая память, выделенная во время func() (tracemalloc)"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure_scale(name):
+    scale = SCALES[name]
+    with tempfile.TemporaryDirectory(prefix=f"bench_mem_{name}_") as workdir:
+        path = os.path.join(workdir, 'queues_data.json')
+
+        # RSS - без tracemalloc, который сам занимает память под трассировку
+        gc.collect()
+        rss_before = current_rss()
+        manager = PersistentQueueManager(path)
+        build_state(manager, scale)
+        gc.collect()
+        rss_after = current_rss()
+        del manager
+        gc.collect()
+
+        tracemalloc.start()
+        manager = PersistentQueueManager(path)
+        build_state(manager, scale)
+        gc.collect()
+        state_bytes, build_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        entries = manager.total_entries
+        known = manager.known_users_total
+        save_peak = traced_peak(manager.save_data)
+        snapshot_bytes = os.path.getsize(path)
+        del manager
+        gc.collect()
+        load_peak = traced_peak(lambda: PersistentQueueManager(path))
+
+    return {
+        'scale': scale,
+        'queue_entries': entries,
+        'known_users': known,
+        'state_bytes': state_bytes,
+        'build_peak_bytes': build_peak,
+        'rss_delta_bytes': rss_after - rss_before,
+        # Оценка: записи очереди и известные пользователи - примерно одинаковые словари
+        'bytes_per_entity': round(state_bytes / max(entries + known, 1), 1),
+        'rss_per_entity': round((rss_after - rss_before) / max(entries + known, 1), 1),
+        'snapshot_bytes': snapshot_bytes,
+        'save_peak_bytes': save_peak,
+        'load_peak_bytes': load_peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Память PersistentQueueManager")
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=sorted(SCALES))
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    parser.add_argument('--single', choices=sorted(SCALES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    if args.single:
+        print(json.dumps(measure_scale(args.single)))
+        return
+
+    # Каждый масштаб - в новом процессе, чтобы RSS не включал память предыдущих замеров
+    report = {'results': {}}
+    for name in args.scales:
+        print(f"Масштаб {name}: {SCALES[name]}", file=sys.stderr)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--single', name],
+            check=True, capture_output=True, text=True
+        ).stdout
+        report['results'][name] = json.loads(output)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
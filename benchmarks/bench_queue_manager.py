@@ -0,0 +1,273 @@
+"""
+Микробенчмарки PersistentQueueManager на синтетических данных
+
+Запуск:
+    python benchmarks/bench_queue_manager.py --scales small medium
+    python benchmarks/bench_queue_manager.py --output results.json --baseline benchmarks/baseline.json
+
+Сеть не используется, состояние хранится во временном каталоге.
+Операции, которых нет в проверяемой версии менеджера (например, pop_front до /next),
+пропускаются, поэтому тот же скрипт подходит для замеров "до" и "после" изменения.
+--journal подключает журнал горячего резерва (queue_journal.py) на время замеров.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from queue_manager import PersistentQueueManager  # noqa: E402
+
+# Синтетические масштабы: топики, длина каждой очереди, чаты, известные пользователи
+SCALES = {
+    'small': {'topics': 10, 'queue_len': 20, 'chats': 1, 'known_users': 100},
+    'medium': {'topics': 1000, 'queue_len': 20, 'chats': 10, 'known_users': 10000},
+    'large': {'topics': 10000, 'queue_len': 20, 'chats': 100, 'known_users': 100000},
+}
+
+
+def build_state(manager, scale, seed=0):
+    """Заполнение менеджера синтетическими данными без промежуточных сохранений"""
+    rnd = random.Random(seed)
+    chats = [-1000000 - i for i in range(scale['chats'])]
+    users_per_chat = max(scale['known_users'] // len(chats), 1)
+
+    for chat_index, chat_id in enumerate(chats):
+        base = chat_index * users_per_chat
+        for user_id in range(base, base + users_per_chat):
+            manager._upsert_known_user(chat_id, user_id, f"First{user_id}", f"Last{user_id}", f"user{user_id}")
+
+    for topic_id in range(1, scale['topics'] + 1):
+        chat_id = chats[topic_id % len(chats)]
+        manager.topic_to_chat[topic_id] = chat_id
+        manager.queue_message_ids[topic_id] = topic_id * 10
+        chat_index = chats.index(chat_id)
+        base = chat_index * users_per_chat
+        members = rnd.sample(range(base, base + users_per_chat), min(scale['queue_len'], users_per_chat))
+        # Тип очереди берётся у менеджера: list в старых версиях, deque начиная с /next
+        manager.queues[topic_id] = manager.queues.default_factory(
+            {
+                'user_id': user_id,
+                'first_name': f"First{user_id}",
+                'last_name': f"Last{user_id}",
+                'username': f"user{user_id}",
+                'display_name': f"First{user_id} Last{user_id}",
+                'joined_at': datetime.now().isoformat()
+            }
+            for user_id in members
+        )
+    manager._recount()
+    return chats
+
+
+def measure(func, min_runs=5, max_runs=1000, budget=2.0, setup=None):
+    """
+    Замер func() несколько раз в пределах бюджета времени. Возвращает список длительностей
+    setup() выполняется перед каждым запуском и в замер не входит
+    """
+    durations = []
+    deadline = time.perf_counter() + budget
+    while len(durations) < max_runs and (len(durations) < min_runs or time.perf_counter() < deadline):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations):
+    ordered = sorted(durations)
+    return {
+        'runs': len(ordered),
+        'mean_us': round(statistics.fmean(ordered) * 1e6, 2),
+        'p50_us': round(ordered[len(ordered) // 2] * 1e6, 2),
+        'p95_us': round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1e6, 2),
+        'min_us': round(ordered[0] * 1e6, 2),
+    }
+
+
+def run_scale(name, scale, budget, seed=0, journal=False):
+    rnd = random.Random(seed)
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        path = os.path.join(workdir, 'queues_data.json')
+        manager = PersistentQueueManager(path)
+        chats = build_state(manager, scale, seed)
+        if journal:
+            from queue_journal import JournalWriter
+            manager.journal = JournalWriter(os.path.join(workdir, 'journal'))
+        manager.save_data()
+        topics = list(manager.queues.keys())
+        results = {}
+
+        # Добавление новых пользователей (каждое - с сохранением)
+        next_user = [10 ** 9]
+        added = []
+
+        def add_user():
+            topic_id = rnd.choice(topics)
+            next_user[0] += 1
+            manager.add_user_to_queue(topic_id, next_user[0], 'Bench', 'User', f"bench{next_user[0]}")
+            added.append((topic_id, next_user[0]))
+        results['add_user_to_queue'] = summarize(measure(add_user, budget=budget))
+
+        # Удаление ранее добавленных (пользователь в конце очереди - худший случай поиска)
+        def remove_user():
+            topic_id, user_id = added.pop() if added else (rnd.choice(topics), -1)
+            manager.remove_user_from_queue(topic_id, user_id)
+        results['remove_user_from_queue'] = summarize(measure(remove_user, max_runs=max(len(added), 1), budget=budget))
+
+        def swap():
+            topic_id = rnd.choice(topics)
+            queue = manager.queues[topic_id]
+            if len(queue) >= 2:
+                manager.swap_users(topic_id, queue[0]['user_id'], queue[-1]['user_id'])
+        results['swap_users'] = summarize(measure(swap, budget=budget))
+
+        # Уже известный пользователь без изменений - основной путь при сборе пользователей
+        def known_existing():
+            chat_id = rnd.choice(chats)
+            user = rnd.choice(manager.known_users[chat_id])
+            manager.add_known_user(chat_id, user['user_id'], user['first_name'], user['last_name'], user['username'])
+        results['add_known_user_existing'] = summarize(measure(known_existing, budget=budget))
+
+        def known_new():
+            chat_id = rnd.choice(chats)
+            next_user[0] += 1
+            manager.add_known_user(chat_id, next_user[0], 'New', 'User', f"new{next_user[0]}")
+        results['add_known_user_new'] = summarize(measure(known_new, budget=budget))
+
+        def queue_text():
+            manager.get_queue_text(rnd.choice(topics))
+        results['get_queue_text'] = summarize(measure(queue_text, budget=budget))
+
+        results['save_data'] = summarize(measure(manager.save_data, budget=budget))
+        results['load_data'] = summarize(measure(lambda: PersistentQueueManager(path), budget=budget))
+        results['snapshot_bytes'] = os.path.getsize(path)
+
+        # Операции, появившиеся позже набора: после замеров сохранения и загрузки,
+        # потому что меняют состояние (политики, опустевшие после истечения очереди).
+        # Снятие первого (/next)
+        if hasattr(manager, 'pop_front'):
+            def pop_front():
+                manager.pop_front(rnd.choice(topics), 1)
+            results['pop_front'] = summarize(measure(pop_front, max_runs=len(topics) * 5, budget=budget))
+
+        # Запись в упорядоченную очередь (политика priority на всех топиках, ранжирование вне замера)
+        if hasattr(manager, 'set_topic_policy'):
+            from queue_policy import TopicPolicy
+            for topic_id in topics:
+                policy = manager.topic_policies[topic_id] = TopicPolicy('priority')
+                queue = manager.queues[topic_id]
+                for entry in queue:
+                    entry['rank'] = policy.rank(entry)
+                ordered = sorted(queue, key=lambda entry: entry['rank'])
+                queue.clear()
+                queue.extend(ordered)
+            results['add_user_to_queue_priority'] = summarize(measure(add_user, budget=budget))
+
+        # Отмена удаления: запись возвращается на прежнее место
+        if hasattr(manager, 'undo'):
+            def remove_head():
+                topic_id = rnd.choice(topics)
+                if manager.queues[topic_id]:
+                    manager.remove_user_from_queue(topic_id, manager.queues[topic_id][0]['user_id'])
+                undo_topic[0] = topic_id
+            undo_topic = [None]
+            results['undo'] = summarize(measure(lambda: manager.undo(undo_topic[0]), setup=remove_head, budget=budget))
+
+        # Истечение TTL: сроки топика из общей кучи и снятие истёкших одним проходом
+        if hasattr(manager, 'expire_topic'):
+            expiring = list(topics)
+            rnd.shuffle(expiring)
+
+            def backdate():
+                topic_id = expiring.pop()
+                for entry in manager.queues[topic_id]:
+                    entry['joined_at'] = (datetime.now() - timedelta(hours=2)).isoformat()
+                manager.set_topic_expiry(topic_id, ttl=3600)
+
+            def expire():
+                now = time.time()
+                for topic_id, kinds in manager.pop_due_expiry(now).items():
+                    manager.expire_topic(topic_id, kinds, now)
+            results['expire_topic'] = summarize(measure(expire, max_runs=len(expiring), budget=budget, setup=backdate))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(current, baseline, threshold):
+    """Сравнение медиан с базовыми результатами. Возвращает список регрессий"""
+    regressions = []
+    for scale, ops in current['results'].items():
+        base_ops = baseline.get('results', {}).get(scale, {})
+        for op, stats in ops.items():
+            base = base_ops.get(op)
+            if not isinstance(stats, dict) or not isinstance(base, dict):
+                continue
+            ratio = stats['p50_us'] / base['p50_us'] if base['p50_us'] else float('inf')
+            marker = ''
+            if ratio > 1 + threshold:
+                marker = '  <-- регрессия'
+                regressions.append((scale, op, ratio))
+            print(f"{scale:>8} {op:<26} {base['p50_us']:>12.1f} -> {stats['p50_us']:>12.1f} мкс  x{ratio:.2f}{marker}",
+                  file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки PersistentQueueManager")
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=sorted(SCALES))
+    parser.add_argument('--budget', type=float, default=2.0, help="Секунд на одну операцию")
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    parser.add_argument('--baseline', help="Файл с базовыми результатами для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Допустимое замедление (0.2 = 20%%)")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--journal', action='store_true', help="Замер с журналом горячего резерва")
+    args = parser.parse_args()
+
+    # Логи менеджера на каждое сохранение искажают замеры
+    logging.disable(logging.INFO)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scales': {name: SCALES[name] for name in args.scales},
+            'journal': args.journal,
+        },
+        'results': {},
+    }
+    for name in args.scales:
+        print(f"Масштаб {name}: {SCALES[name]}", file=sys.stderr)
+        report['results'][name] = run_scale(name, SCALES[name], args.budget, journal=args.journal)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+Проверка целостности данных PersistentQueueManager при падениях
+
+Режим kill: дочерний процесс без остановки меняет очереди (каждое изменение вызывает
+save_data) и сообщает хэш состояния до и после каждого сохранения. Родитель убивает его
+SIGKILL в случайный момент и загружает файл заново. Загруженное состояние должно совпасть
+с последним завершённым сохранением или с тем, что писалось в момент падения.
+
+Режим power: имитация отключения питания в процессе. После сохранения с диска пропадает то,
+что не гарантировано выбранным уровнем QUEUE_DURABILITY:
+    none - данные нового файла не сброшены: файл обрезается в случайном месте
+    file - данные на диске, но переименование не сброшено: остаётся предыдущий файл
+    dir  - ничего не теряется
+
+В обоих режимах после загрузки проверяются инварианты (счётчики, индекс известных
+пользователей, уникальность пользователей в очереди). Исходы:
+    committed - загружено последнее завершённое сохранение
+    in_flight - загружено сохранение, прерванное падением
+    previous  - загружено предыдущее сохранение (потеряно последнее изменение)
+    lost      - файл не прочитан, состояние пустое
+    invalid   - состояние не совпадает ни с одним сохранённым или нарушены инварианты
+Код выхода 1, если есть исход invalid.
+
+Запуск:
+    python benchmarks/crash_test.py kill --iterations 200
+    python benchmarks/crash_test.py power --durability none file dir --iterations 500
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from queue_manager import PersistentQueueManager, DURABILITY_LEVELS  # noqa: E402
+
+TOPICS = 20
+USERS = 200
+CHAT_ID = -1001000000000
+
+
+def state_digest(manager):
+    """Хэш сохраняемого состояния (без производных индексов и счётчиков)"""
+    state = {
+        'queues': {str(k): list(v) for k, v in manager.queues.items() if v},
+        'pending_swaps': manager.pending_swaps,
+        'queue_message_ids': {str(k): v for k, v in manager.queue_message_ids.items() if v is not None},
+        'known_users': {str(k): v for k, v in manager.known_users.items() if v},
+        'topic_to_chat': {str(k): v for k, v in manager.topic_to_chat.items()},
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+
+def check_invariants(manager):
+    """Список нарушенных инвариантов загруженного состояния"""
+    problems = []
+    if manager.total_entries != sum(len(queue) for queue in manager.queues.values()):
+        problems.append('total_entries')
+    if manager.known_users_total != sum(len(users) for users in manager.known_users.values()):
+        problems.append('known_users_total')
+    for topic_id, queue in manager.queues.items():
+        if len({entry['user_id'] for entry in queue}) != len(queue):
+            problems.append(f"duplicate users in queue {topic_id}")
+    for chat_id, users in manager.known_users.items():
+        if {user['user_id'] for user in users} != set(manager._known_index.get(chat_id, {})):
+            problems.append(f"known index of chat {chat_id}")
+    return problems
+
+
+def random_operation(manager, rnd):
+    """Одно случайное изменение; каждое вызывает save_data"""
+    topic_id = rnd.randrange(1, TOPICS + 1)
+    user_id = rnd.randrange(1, USERS + 1)
+    queue = manager.queues[topic_id]
+    roll = rnd.random()
+    if roll < 0.45:
+        manager.add_user_to_queue(topic_id, user_id, f"User{user_id}", '', f"user{user_id}")
+    elif roll < 0.75:
+        if queue:
+            manager.remove_user_from_queue(topic_id, rnd.choice(queue)['user_id'])
+    elif roll < 0.9:
+        if len(queue) >= 2:
+            first, second = rnd.sample(queue, 2)
+            manager.swap_users(topic_id, first['user_id'], second['user_id'])
+    elif roll < 0.95:
+        manager.set_queue_message_id(topic_id, rnd.randrange(1, 10 ** 6))
+    else:
+        manager.add_known_user(CHAT_ID, user_id, f"User{user_id}", 'Renamed', f"user{user_id}")
+
+
+class ReportingManager(PersistentQueueManager):
+    """Менеджер, сообщающий родителю хэш состояния до и после каждого сохранения"""
+    def save_data(self):
+        digest = state_digest(self)
+        print(f"begin {digest}", flush=True)
+        super().save_data()
+        print(f"end {digest}", flush=True)
+
+
+def run_child(path, durability, seed):
+    manager = ReportingManager(path, durability=durability)
+    # Загруженное состояние уже на диске: считается последним завершённым сохранением
+    print(f"end {state_digest(manager)}", flush=True)
+    rnd = random.Random(seed)
+    while True:
+        random_operation(manager, rnd)
+
+
+def classify(loaded, committed, in_flight, previous, empty):
+    if loaded == committed:
+        return 'committed'
+    if loaded == in_flight:
+        return 'in_flight'
+    if loaded == previous:
+        return 'previous'
+    if loaded == empty:
+        return 'lost'
+    return 'invalid'
+
+
+def load(path, durability):
+    manager = PersistentQueueManager(path, durability=durability)
+    return state_digest(manager), check_invariants(manager)
+
+
+def kill_mode(args, workdir, empty):
+    results = {}
+    rnd = random.Random(args.seed)
+    for durability in args.durability:
+        outcomes = Counter()
+        path = os.path.join(workdir, f"kill_{durability}.json")
+        for _ in range(args.iterations):
+            child = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'child', '--path', path,
+                 '--durability', durability, '--seed', str(rnd.randrange(2 ** 32))],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+            )
+            # Первая строка - сигнал, что процесс запущен и загрузил данные
+            first_line = child.stdout.readline()
+            time.sleep(rnd.uniform(0, args.max_delay))
+            child.send_signal(signal.SIGKILL)
+            lines = [first_line] + child.stdout.read().splitlines()
+            child.wait()
+
+            committed = previous = in_flight = None
+            for line in lines:
+                kind, _, digest = line.strip().partition(' ')
+                if kind == 'begin':
+                    in_flight = digest
+                elif kind == 'end':
+                    previous, committed, in_flight = committed, digest, None
+            loaded, problems = load(path, durability)
+            outcome = classify(loaded, committed, in_flight, previous, empty)
+            outcomes['invalid' if problems else outcome] += 1
+        results[durability] = dict(outcomes)
+    return results
+
+
+def power_mode(args, workdir, empty):
+    results = {}
+    rnd = random.Random(args.seed)
+    for durability in args.durability:
+        outcomes = Counter()
+        path = os.path.join(workdir, f"power_{durability}.json")
+        manager = PersistentQueueManager(path, durability=durability)
+        committed = state_digest(manager)
+        for _ in range(args.iterations):
+            before = open(path, 'rb').read() if os.path.exists(path) else None
+            previous = committed
+            # Операции без изменений (выход отсутствующего и т.п.) ничего не сохраняют
+            while committed == previous:
+                random_operation(manager, rnd)
+                committed = state_digest(manager)
+            after = open(path, 'rb').read()
+
+            if durability == 'none':
+                # Содержимое нового файла не успело попасть на диск
+                with open(path, 'wb') as f:
+                    f.write(after[:rnd.randrange(len(after) + 1)])
+            elif durability == 'file' and before is not None and rnd.random() < 0.5:
+                # Переименование не сброшено на диск: в каталоге остался старый файл
+                with open(path, 'wb') as f:
+                    f.write(before)
+
+            loaded, problems = load(path, durability)
+            outcome = classify(loaded, committed, None, previous, empty)
+            outcomes['invalid' if problems else outcome] += 1
+
+            # Каждое падение независимо: следующая итерация начинает с целого последнего снимка
+            with open(path, 'wb') as f:
+                f.write(after)
+        results[durability] = dict(outcomes)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Целостность данных при падениях")
+    parser.add_argument('mode', choices=['kill', 'power', 'child'])
+    parser.add_argument('--durability', nargs='+', default=list(DURABILITY_LEVELS), choices=DURABILITY_LEVELS)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--max-delay', type=float, default=0.2, help="kill: максимальная задержка перед SIGKILL")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    if args.mode == 'child':
+        run_child(args.path, args.durability[0], args.seed)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='crash_test_') as workdir:
+        empty = state_digest(PersistentQueueManager(os.path.join(workdir, 'empty.json')))
+        run = kill_mode if args.mode == 'kill' else power_mode
+        report = {'mode': args.mode, 'iterations': args.iterations, 'results': run(args, workdir, empty)}
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    if any(outcomes.get('invalid') for outcomes in report['results'].values()):
+        sys.exit("Загружено несогласованное состояние")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Нагрузочный тест бота на локальной замене Bot API (fake_bot_api.py)
+
+Бот запускается отдельным процессом (main.py) с TELEGRAM_BASE_URL, указывающим на
+FakeBotAPI. Драйвер создаёт топики командой /start и затем с заданной частотой нажимает
+кнопки "Добавиться"/"Выйти" от имени имитируемых пользователей. Задержка считается от
+появления обновления в getUpdates до answerCallbackQuery.
+
+Запуск:
+    python benchmarks/load_test.py --chats 10 --topics 5 --users 1000 --rate 200 --duration 30
+    python benchmarks/load_test.py --latency 0.05 --jitter 0.05 --flood-rate 0.01 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI, FaultConfig, make_user  # noqa: E402
+
+TOKEN = '123456:LOADTEST'
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def wait_until(predicate, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+def start_bot(api, workdir, args):
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        TELEGRAM_BASE_URL=api.base_url,
+        BOT_MODE='polling',
+        QUEUE_DATA_FILE=os.path.join(workdir, 'queues_data.json'),
+        CONCURRENT_UPDATES=str(args.concurrent_updates),
+        UPDATE_QUEUE_SIZE=str(args.update_queue_size),
+    )
+    log = open(os.path.join(workdir, 'bot.log'), 'wb')
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'main.py')],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+async def create_topics(api, args):
+    """Чаты, администраторы и сообщения с очередью в каждом топике"""
+    topics = []  # (chat_id, thread_id, message_id, пользователи чата)
+    for chat_index in range(args.chats):
+        chat_id = -1001000000000 - chat_index
+        admin = make_user(900000 + chat_index, first_name=f"Admin{chat_index}")
+        api.add_chat(chat_id, admins=[admin])
+        users = [make_user(chat_index * args.users + i + 1) for i in range(args.users)]
+        for topic_index in range(args.topics):
+            # Очереди бота хранятся по topic_id без chat_id, поэтому id топиков уникальны во всех чатах
+            thread_id = 100 + chat_index * args.topics + topic_index
+            waiter = api.wait_for_message(
+                lambda m, c=chat_id, t=thread_id: m['chat']['id'] == c
+                and m.get('message_thread_id') == t and 'reply_markup' in m,
+                timeout=30
+            )
+            api.send_text(chat_id, thread_id, admin, '/start')
+            message = await waiter
+            topics.append((chat_id, thread_id, message['message_id'], users))
+    return topics
+
+
+async def drive(api, topics, args):
+    """Нажатия кнопок с постоянной средней частотой (открытая модель нагрузки)"""
+    rnd = random.Random(args.seed)
+    sent = 0
+    start = time.perf_counter()
+    next_at = start
+    while time.perf_counter() - start < args.duration:
+        chat_id, _, message_id, users = rnd.choice(topics)
+        action = 'add_to_queue' if rnd.random() < args.join_ratio else 'remove_from_queue'
+        api.press_button(chat_id, message_id, rnd.choice(users), action)
+        sent += 1
+        next_at += rnd.expovariate(args.rate)
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    return sent, time.perf_counter() - start
+
+
+async def run(args):
+    faults = FaultConfig(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        flood_rate=args.flood_rate, retry_after=args.retry_after, chat_rate=args.chat_rate
+    )
+    api = FakeBotAPI(faults=faults)
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix='bot_load_')
+    bot = start_bot(api, workdir, args)
+    try:
+        if not await wait_until(lambda: api.calls['getUpdates'] > 0 or bot.poll() is not None, 60):
+            raise RuntimeError("Бот не начал получать обновления")
+        if bot.poll() is not None:
+            raise RuntimeError(f"Бот завершился с кодом {bot.returncode}, см. {workdir}/bot.log")
+
+        topics = await create_topics(api, args)
+        api.reset_stats()
+
+        load_start = time.perf_counter()
+        sent, elapsed = await drive(api, topics, args)
+        await wait_until(lambda: api.unanswered_callbacks == 0, args.drain_timeout)
+        # Пропускная способность - до последнего ответа, с учётом обработки накопившихся
+        # обновлений (ответы, потерянные из-за 429 и ошибок, ожидание не удлиняют)
+        total_elapsed = max((api.last_answer_at or time.perf_counter()) - load_start, elapsed)
+
+        latencies = sorted(api.callback_latencies)
+        return {
+            'config': vars(args),
+            'sent': sent,
+            'answered': len(latencies),
+            'unanswered': api.unanswered_callbacks,
+            'offered_rate': round(sent / elapsed, 2),
+            'throughput': round(len(latencies) / total_elapsed, 2),
+            'latency_ms': {
+                name: round(value * 1000, 2) if value is not None else None
+                for name, value in (
+                    ('p50', percentile(latencies, 0.5)),
+                    ('p95', percentile(latencies, 0.95)),
+                    ('p99', percentile(latencies, 0.99)),
+                    ('max', latencies[-1] if latencies else None),
+                )
+            },
+            'api_calls': dict(api.calls),
+            'api_errors': {str(code): count for code, count in api.errors.items()},
+            'workdir': workdir if args.keep else None,
+        }
+    finally:
+        if bot.poll() is None:
+            bot.send_signal(signal.SIGINT)
+            try:
+                bot.wait(30)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        await api.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на fake Bot API")
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--topics', type=int, default=4, help="Топиков в каждом чате")
+    parser.add_argument('--users', type=int, default=200, help="Пользователей в каждом чате")
+    parser.add_argument('--rate', type=float, default=100.0, help="Нажатий в секунду")
+    parser.add_argument('--duration', type=float, default=20.0, help="Длительность нагрузки, секунды")
+    parser.add_argument('--join-ratio', type=float, default=0.6, help="Доля нажатий 'Добавиться'")
+    parser.add_argument('--drain-timeout', type=float, default=30.0)
+    parser.add_argument('--concurrent-updates', type=int, default=64)
+    parser.add_argument('--update-queue-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--chat-rate', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="Не удалять каталог с логом и данными бота")
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Воспроизведение записанных обновлений (RECORD_UPDATES) на локальной замене Bot API
+
+Обновления передаются в очередь Application в исходном порядке и проходят через те же
+обработчики, что и в работе: команды, handle_callback, collect_users. Темп:
+    --speed 1     исходный (по меткам времени записи)
+    --speed 10    ускоренный в 10 раз
+    --speed 0     без пауз (максимально быстро)
+
+Запуск:
+    python benchmarks/replay_updates.py updates.jsonl.gz --speed 0
+    python benchmarks/replay_updates.py updates.jsonl.gz --state queues_data.json --latency 0.05 --output replay.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI, FaultConfig  # noqa: E402
+from update_recorder import read_recording  # noqa: E402
+from load_test import TOKEN, percentile, wait_until  # noqa: E402
+
+
+def command_senders(records):
+    """Авторы команд считаются администраторами: иначе админские команды не воспроизвести"""
+    admins = {}
+    for _, update in records:
+        message = update.get('message') or {}
+        if (message.get('text') or '').startswith('/') and message.get('from') and message.get('chat'):
+            admins.setdefault(message['chat']['id'], {})[message['from']['id']] = message['from']
+    return admins
+
+
+async def replay(args, records, workdir):
+    # queue_manager создаётся при импорте: файл данных должен быть задан заранее
+    data_file = os.path.join(workdir, 'queues_data.json')
+    if args.state:
+        shutil.copy(args.state, data_file)
+    os.environ['QUEUE_DATA_FILE'] = data_file
+    from telegram import Update
+    import main as bot_main
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    faults = FaultConfig(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        flood_rate=args.flood_rate, retry_after=args.retry_after, chat_rate=args.chat_rate
+    )
+    api = FakeBotAPI(faults=faults)
+    for _, update in records:
+        api.observe_update(update)
+    for chat_id, admins in command_senders(records).items():
+        api.add_chat(chat_id, title=api.chats.get(chat_id, {}).get('title'), admins=admins.values())
+    await api.start()
+
+    application = bot_main.build_application(
+        TOKEN,
+        concurrent_updates=args.concurrent_updates,
+        update_queue_size=args.update_queue_size,
+        use_updater=False,
+        base_url=api.base_url
+    )
+    processor = application.update_processor
+    try:
+        async with application:
+            await application.start()
+            first_ts = records[0][0]
+            start = time.perf_counter()
+            for ts, data in records:
+                if args.speed > 0:
+                    delay = start + (ts - first_ts) / args.speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if data.get('callback_query'):
+                    api.expect_answer(data['callback_query']['id'])
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            fed = time.perf_counter() - start
+
+            await wait_until(
+                lambda: application.update_queue.qsize() == 0 and processor.current_concurrent_updates == 0,
+                args.drain_timeout, interval=0.01
+            )
+            elapsed = time.perf_counter() - start
+            await application.stop()
+    finally:
+        await api.stop()
+
+    latencies = sorted(api.callback_latencies)
+    return {
+        'recording': args.recording,
+        'speed': args.speed,
+        'updates': len(records),
+        'recorded_span_s': round(records[-1][0] - first_ts, 3),
+        'feed_s': round(fed, 3),
+        'elapsed_s': round(elapsed, 3),
+        'throughput': round(len(records) / elapsed, 2) if elapsed else None,
+        'shed': getattr(application.update_queue, 'shed_count', 0),
+        'callbacks_answered': len(latencies),
+        'callbacks_unanswered': api.unanswered_callbacks,
+        'callback_latency_ms': {
+            name: round(value * 1000, 2) if value is not None else None
+            for name, value in (
+                ('p50', percentile(latencies, 0.5)),
+                ('p95', percentile(latencies, 0.95)),
+                ('p99', percentile(latencies, 0.99)),
+                ('max', latencies[-1] if latencies else None),
+            )
+        },
+        'api_calls': dict(api.calls),
+        'api_errors': {str(code): count for code, count in api.errors.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных обновлений")
+    parser.add_argument('recording', help="Файл записи (RECORD_UPDATES), .jsonl или .jsonl.gz")
+    parser.add_argument('--speed', type=float, default=1.0, help="Ускорение; 0 - без пауз")
+    parser.add_argument('--state', help="Начальный файл данных (копируется во временный каталог)")
+    parser.add_argument('--limit', type=int, default=None, help="Воспроизвести только первые N обновлений")
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--concurrent-updates', type=int, default=64)
+    parser.add_argument('--update-queue-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--chat-rate', type=float, default=None)
+    parser.add_argument('--verbose', action='store_true', help="Логи бота уровня INFO")
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    args = parser.parse_args()
+
+    records = list(read_recording(args.recording))[:args.limit]
+    if not records:
+        sys.exit("Запись пуста")
+
+    workdir = tempfile.mkdtemp(prefix='bot_replay_')
+    try:
+        report = asyncio.run(replay(args, records, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Проверка разделения по чатам (shard_router.py) на локальной замене Bot API
+
+Фронт с N рабочими запускается отдельным процессом и получает обновления из FakeBotAPI.
+В каждом чате создаётся топик (/start) и пользователи записываются в очередь кнопкой.
+После остановки проверяется, что данные каждого чата лежат только в файле его рабочего
+и ни одна запись не потеряна. Затем данные перераспределяются на N + 1 рабочих
+(shard_router.py rebalance) и проверка повторяется для нового распределения.
+В режиме webhook фронт регистрирует webhook в FakeBotAPI и получает обновления POST-запросами;
+дополнительно проверяется, что webhook зарегистрирован один раз (только фронтом) и ни одна
+доставка не отклонена.
+
+Запуск:
+    python benchmarks/shard_test.py --workers 3 --chats 12 --users 5
+    python benchmarks/shard_test.py --mode webhook
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI, make_user  # noqa: E402
+from shard_router import rebalance, shard_for  # noqa: E402
+from snapshot import read_snapshot  # noqa: E402
+
+TOKEN = '123456:SHARDTEST'
+WEBHOOK_SECRET = 'shard-test-secret'
+
+
+async def wait_until(predicate, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+def free_port_base(count):
+    """Первый из count подряд свободных локальных портов"""
+    for _ in range(50):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            base = probe.getsockname()[1]
+        if base + count > 65535:
+            continue
+        try:
+            sockets = []
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+    raise RuntimeError("Нет свободных портов")
+
+
+def check_shards(workdir, workers, expected):
+    """
+    Расхождения распределения: expected - {chat_id: {topic_id: число записей}}
+    Чат должен быть только в файле своего рабочего, очереди - совпадать по размеру
+    """
+    problems = []
+    seen = {}
+    for index in range(workers):
+        path = os.path.join(workdir, f"queues_data.shard{index}.json")
+        if not os.path.exists(path):
+            continue
+        data = read_snapshot(path)
+        for topic_id_str, chat_id in data.get('topic_to_chat', {}).items():
+            if shard_for(chat_id, workers) != index:
+                problems.append(f"chat {chat_id} is in shard {index}")
+            seen[(chat_id, int(topic_id_str))] = len(data.get('queues', {}).get(topic_id_str, []))
+    for chat_id, topics in expected.items():
+        for topic_id, count in topics.items():
+            if seen.get((chat_id, topic_id)) != count:
+                problems.append(f"topic {topic_id} of chat {chat_id}: {seen.get((chat_id, topic_id))} of {count} entries")
+    return problems
+
+
+async def run(args, workdir):
+    api = FakeBotAPI()
+    await api.start()
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN=TOKEN, TELEGRAM_BASE_URL=api.base_url, BOT_MODE=args.mode)
+    # Порты рабочих и за ними порт webhook фронта
+    port_base = free_port_base(args.workers + 1)
+    if args.mode == 'webhook':
+        front_port = port_base + args.workers
+        env.update(
+            WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(front_port), WEBHOOK_PATH='/telegram',
+            WEBHOOK_SECRET=WEBHOOK_SECRET, WEBHOOK_URL=f"http://127.0.0.1:{front_port}/telegram",
+        )
+        started = lambda: api.webhook is not None  # noqa: E731
+    else:
+        started = lambda: api.calls['getUpdates'] > 0  # noqa: E731
+    log = open(os.path.join(workdir, 'router.log'), 'wb')
+    router = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'shard_router.py'), 'run', '--workers', str(args.workers),
+         '--worker-port-base', str(port_base), '--data-dir', workdir],
+        env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    expected = {}
+    try:
+        if not await wait_until(lambda: started() or router.poll() is not None, 60):
+            raise RuntimeError("Фронт не начал получать обновления")
+
+        start = time.perf_counter()
+        for chat_index in range(args.chats):
+            chat_id = -1001000000000 - chat_index
+            admin = make_user(900000 + chat_index)
+            api.add_chat(chat_id, admins=[admin])
+            # Очереди хранятся по topic_id, поэтому id топиков уникальны во всех чатах
+            thread_id = 100 + chat_index
+            waiter = api.wait_for_message(
+                lambda m, c=chat_id, t=thread_id: m['chat']['id'] == c
+                and m.get('message_thread_id') == t and 'reply_markup' in m,
+                timeout=60
+            )
+            api.send_text(chat_id, thread_id, admin, '/start')
+            message = await waiter
+            for user_index in range(args.users):
+                api.press_button(chat_id, message['message_id'], make_user(chat_index * 1000 + user_index + 1),
+                                 'add_to_queue')
+            expected[chat_id] = {thread_id: args.users}
+        answered = await wait_until(lambda: api.unanswered_callbacks == 0, 60)
+        elapsed = time.perf_counter() - start
+        # Рабочие могли зарегистрировать webhook при запуске, но уже после фронта
+        webhook_calls = [call.get('url') for call in api.webhook_calls]
+    finally:
+        router.send_signal(signal.SIGTERM)
+        router.wait(timeout=60)
+        log.close()
+        await api.stop()
+
+    problems = check_shards(workdir, args.workers, expected)
+    if not answered:
+        problems.append(f"{api.unanswered_callbacks} callbacks unanswered")
+    if args.mode == 'webhook':
+        if webhook_calls != [env['WEBHOOK_URL']]:
+            problems.append(f"setWebhook calls: {webhook_calls}")
+        if api.webhook_rejections:
+            problems.append(f"{api.webhook_rejections} webhook deliveries rejected")
+    per_shard = {}
+    for chat_id in expected:
+        index = shard_for(chat_id, args.workers)
+        per_shard[index] = per_shard.get(index, 0) + 1
+
+    moved = rebalance(workdir, args.workers, args.workers + 1)
+    rebalance_problems = check_shards(workdir, args.workers + 1, expected)
+    return {
+        'config': vars(args),
+        'elapsed_s': round(elapsed, 2),
+        'chats_per_shard': dict(sorted(per_shard.items())),
+        'problems': problems,
+        'rebalance': dict(moved, problems=rebalance_problems),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка разделения бота по чатам")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling',
+                        help="Как фронт получает обновления")
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--chats', type=int, default=12)
+    parser.add_argument('--users', type=int, default=5, help="Записей в очередь на чат")
+    parser.add_argument('--keep', action='store_true', help="Не удалять рабочий каталог")
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='shard_test_')
+    try:
+        report = asyncio.run(run(args, workdir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    if report['problems'] or report['rebalance']['problems']:
+        sys.exit("Данные чатов распределены неверно")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Длительный прогон сценариев обмена, отдачи и добавления на локальной замене Bot API
+
+Бот работает в этом же процессе (polling на FakeBotAPI), поэтому после прогона можно
+проверить его внутреннее состояние. В каждом топике свой имитируемый пользователь
+по очереди запускает сценарии: обмен местами, отдачу места, добавление по @username,
+вход и выход из очереди. С вероятностью --abandon сценарий бросается на середине, и
+его должен закрыть таймер бота (60 секунд).
+
+После нагрузки тест ждёт --settle секунд и сверяет с исходными значениями размеры
+active_add_sessions, active_give_sessions, pending_swaps, блокировок топиков
+(SimpleLockManager.locks) и TopicSerializer. Если что-то не вернулось - код выхода 1.
+
+Запуск:
+    python benchmarks/soak_test.py --chats 2 --topics 5 --duration 300 --abandon 0.3
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from load_test import TOKEN, create_topics, wait_until  # noqa: E402
+
+# Ожидание ответа бота на шаг сценария
+STEP_TIMEOUT = 10.0
+
+
+def buttons(message):
+    return [
+        button.get('callback_data', '')
+        for row in (message.get('reply_markup') or {}).get('inline_keyboard', [])
+        for button in row
+    ]
+
+
+def wait_for_buttons(api, chat_id, thread_id, prefix):
+    """Ожидание сообщения бота в топике с кнопкой, callback_data которой начинается с prefix"""
+    return api.wait_for_message(
+        lambda m: m['chat']['id'] == chat_id and m.get('message_thread_id') == thread_id
+        and any(data.startswith(prefix) for data in buttons(m)),
+        timeout=STEP_TIMEOUT
+    )
+
+
+def button(message, prefix):
+    return next(data for data in buttons(message) if data.startswith(prefix))
+
+
+class TopicWorker:
+    """Сценарии в одном топике, строго по одному"""
+    def __init__(self, api, state, topic, rnd, args):
+        self.api = api
+        self.state = state
+        self.chat_id, self.thread_id, self.main_message_id, users = topic
+        self.users = {user['id']: user for user in users}
+        self.rnd = rnd
+        self.args = args
+        self.outcomes = Counter()
+
+    def queue_members(self):
+        return [entry['user_id'] for entry in self.state.queue_manager.queues.get(self.thread_id, [])]
+
+    def abandon(self):
+        return self.rnd.random() < self.args.abandon
+
+    def press(self, message, user, data):
+        self.api.press_button(self.chat_id, message['message_id'], user, data)
+
+    async def finished(self):
+        """Сценарий завершён, когда бот снял блокировку топика"""
+        return await wait_until(
+            lambda: self.state.lock_manager.get_lock_info(self.thread_id) is None, STEP_TIMEOUT
+        )
+
+    async def join_or_leave(self):
+        user = self.users[self.rnd.choice(list(self.users))]
+        action = 'add_to_queue' if self.rnd.random() < 0.5 else 'remove_from_queue'
+        self.api.press_button(self.chat_id, self.main_message_id, user, action)
+        await asyncio.sleep(0.05)
+        return action
+
+    async def swap(self):
+        members = self.queue_members()
+        if len(members) < 2:
+            return 'swap_skipped'
+        initiator = self.users[self.rnd.choice(members)]
+        waiter = wait_for_buttons(self.api, self.chat_id, self.thread_id, "swap_with_")
+        self.api.press_button(self.chat_id, self.main_message_id, initiator, 'start_swap')
+        selection = await waiter
+        if self.abandon():
+            return 'swap_abandoned_selection'
+
+        data = self.rnd.choice([d for d in buttons(selection) if d.startswith('swap_with_')])
+        target = self.users[int(data.split('_')[2])]
+        waiter = wait_for_buttons(self.api, self.chat_id, self.thread_id, 'swap_confirm_')
+        self.press(selection, initiator, data)
+        proposal = await waiter
+        if self.abandon():
+            return 'swap_abandoned_proposal'
+
+        answer = 'swap_confirm_' if self.rnd.random() < 0.7 else 'swap_cancel_'
+        self.press(proposal, target, button(proposal, answer))
+        await self.finished()
+        return answer.rstrip('_')
+
+    async def give(self):
+        members = self.queue_members()
+        if not members:
+            return 'give_skipped'
+        giver = self.users[self.rnd.choice(members)]
+        waiter = wait_for_buttons(self.api, self.chat_id, self.thread_id, 'give_confirm_')
+        self.api.press_button(self.chat_id, self.main_message_id, giver, 'start_give_queue')
+        confirmation = await waiter
+        if self.abandon():
+            return 'give_abandoned_confirm'
+
+        waiter = wait_for_buttons(self.api, self.chat_id, self.thread_id, 'give_take_')
+        self.press(confirmation, giver, button(confirmation, 'give_confirm_'))
+        selection = await waiter
+        if self.abandon():
+            return 'give_abandoned_selection'
+
+        taker = self.users[self.rnd.choice([uid for uid in self.users if uid != giver['id']])]
+        self.press(selection, taker, button(selection, 'give_take_'))
+        await self.finished()
+        return 'give_take'
+
+    async def add_user(self):
+        initiator = self.users[self.rnd.choice(list(self.users))]
+        waiter = wait_for_buttons(self.api, self.chat_id, self.thread_id, 'add_back_')
+        self.api.press_button(self.chat_id, self.main_message_id, initiator, 'start_add_user')
+        prompt = await waiter
+        if self.abandon():
+            return 'add_abandoned'
+
+        if self.rnd.random() < 0.2:
+            self.press(prompt, initiator, button(prompt, 'add_back_'))
+            outcome = 'add_back'
+        else:
+            target = self.users[self.rnd.choice(list(self.users))]
+            self.api.send_text(self.chat_id, self.thread_id, initiator, f"@{target['username']}")
+            outcome = 'add_input'
+        await self.finished()
+        return outcome
+
+    async def run(self, deadline):
+        flows = (self.swap, self.give, self.add_user)
+        while time.monotonic() < deadline:
+            try:
+                # Брошенный сценарий держит топик до таймера: пока только входим и выходим
+                if self.state.lock_manager.get_lock_info(self.thread_id) or self.rnd.random() < 0.3:
+                    outcome = await self.join_or_leave()
+                else:
+                    outcome = await self.rnd.choice(flows)()
+            except (asyncio.TimeoutError, KeyError, StopIteration):
+                # Бот не ответил за STEP_TIMEOUT или сообщение уже удалено таймером
+                outcome = 'step_timeout'
+            self.outcomes[outcome] += 1
+            await asyncio.sleep(self.rnd.uniform(0, self.args.pause))
+
+
+class BotState:
+    """Внутреннее состояние бота, импортированное после настройки окружения"""
+    def __init__(self, application):
+        from queue_manager import queue_manager
+        from lock_manager import lock_manager, topic_serializer
+        from callback_handlers.add_user_handler import active_add_sessions
+        from callback_handlers.give_handler import active_give_sessions
+        self.application = application
+        self.queue_manager = queue_manager
+        self.lock_manager = lock_manager
+        self.topic_serializer = topic_serializer
+        self.active_add_sessions = active_add_sessions
+        self.active_give_sessions = active_give_sessions
+
+    def snapshot(self):
+        return {
+            'active_add_sessions': len(self.active_add_sessions),
+            'active_give_sessions': len(self.active_give_sessions),
+            'pending_swaps': len(self.queue_manager.pending_swaps),
+            'topic_locks': len(self.lock_manager.locks),
+            'topic_serializer': self.topic_serializer.active_count(),
+        }
+
+    def jobs(self):
+        return len(self.application.job_queue.jobs())
+
+
+async def soak(args, workdir):
+    # queue_manager создаётся при импорте: файл данных должен быть задан заранее
+    os.environ['QUEUE_DATA_FILE'] = os.path.join(workdir, 'queues_data.json')
+    import main as bot_main
+    from bench_memory import current_rss
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    api = FakeBotAPI()
+    await api.start()
+    application = bot_main.build_application(TOKEN, base_url=api.base_url)
+    state = BotState(application)
+    try:
+        async with application:
+            await application.updater.start_polling(timeout=1)
+            await application.start()
+
+            topics = await create_topics(api, args)
+            # Исходно в каждой очереди по --fill пользователей
+            for chat_id, _, message_id, users in topics:
+                for user in users[:args.fill]:
+                    api.press_button(chat_id, message_id, user, 'add_to_queue')
+            # Ответ на callback уходит раньше, чем обработчик заканчивает работу
+            await wait_until(
+                lambda: api.unanswered_callbacks == 0 and state.topic_serializer.active_count() == 0, 30
+            )
+
+            baseline = state.snapshot()
+            baseline_jobs = state.jobs()
+            rss_start = current_rss()
+
+            rnd = random.Random(args.seed)
+            workers = [TopicWorker(api, state, topic, random.Random(rnd.random()), args) for topic in topics]
+            start = time.monotonic()
+            await asyncio.gather(*(worker.run(start + args.duration) for worker in workers))
+            elapsed = time.monotonic() - start
+            peak = state.snapshot()
+
+            # Таймеры сценариев - 60 секунд, блокировка топика истекает через 120
+            settle_start = time.monotonic()
+            settled = await wait_until(lambda: state.snapshot() == baseline, args.settle, interval=1.0)
+            settle_s = time.monotonic() - settle_start
+            final = state.snapshot()
+            rss_end = current_rss()
+            final_jobs = state.jobs()
+            leftover_locks = {
+                str(topic_id): {'operation': lock['operation'], 'age_s': round(time.time() - lock['timestamp'], 1)}
+                for topic_id, lock in state.lock_manager.locks.items()
+            }
+
+            await application.updater.stop()
+            await application.stop()
+    finally:
+        await api.stop()
+
+    outcomes = sum((worker.outcomes for worker in workers), Counter())
+    return {
+        'config': vars(args),
+        'elapsed_s': round(elapsed, 1),
+        'outcomes': dict(sorted(outcomes.items())),
+        'baseline': baseline,
+        'after_load': peak,
+        'final': final,
+        'leaked': {name: final[name] - baseline[name] for name in baseline if final[name] != baseline[name]},
+        'leftover_locks': leftover_locks,
+        'settled': settled,
+        'settle_s': round(settle_s, 1),
+        # Сообщения об отмене обмена удаляются через 2 минуты, поэтому задачи - для справки
+        'jobs': {'baseline': baseline_jobs, 'final': final_jobs},
+        'rss_bytes': {'start': rss_start, 'end': rss_end, 'delta': rss_end - rss_start},
+        'unanswered_callbacks': api.unanswered_callbacks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Длительный прогон сценариев бота")
+    parser.add_argument('--chats', type=int, default=2)
+    parser.add_argument('--topics', type=int, default=5, help="Топиков в каждом чате")
+    parser.add_argument('--users', type=int, default=20, help="Пользователей в каждом чате")
+    parser.add_argument('--fill', type=int, default=8, help="Исходно пользователей в каждой очереди")
+    parser.add_argument('--duration', type=float, default=180.0, help="Длительность нагрузки, секунды")
+    parser.add_argument('--abandon', type=float, default=0.2, help="Вероятность бросить сценарий на каждом шаге")
+    parser.add_argument('--pause', type=float, default=0.5, help="Максимальная пауза между сценариями, секунды")
+    parser.add_argument('--settle', type=float, default=150.0, help="Ожидание возврата к исходному состоянию")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="Логи бота уровня INFO")
+    parser.add_argument('--output', help="Файл для результатов (JSON)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bot_soak_')
+    try:
+        report = asyncio.run(soak(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    if not report['settled']:
+        sys.exit(f"Состояние не вернулось к исходному: {report['leaked']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import logging
+import time
+from telegram.request import HTTPXRequest
+
+from metrics import metrics
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+API_REQUEST_DURATION = metrics.histogram(
+    'bot_telegram_request_duration_seconds', 'Длительность вызовов Telegram Bot API', ['method']
+)
+API_REQUEST_ERRORS = metrics.counter(
+    'bot_telegram_request_errors_total', 'Ошибки вызовов Telegram Bot API', ['method', 'code']
+)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером длительности и ошибок каждого метода Bot API"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        with tracer.span(f"api.{api_method}") as span:
+            try:
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            except Exception as e:
+                API_REQUEST_ERRORS.inc(method=api_method, code=type(e).__name__)
+                raise
+            finally:
+                API_REQUEST_DURATION.observe(time.perf_counter() - start, method=api_method)
+            if code >= 400:
+                API_REQUEST_ERRORS.inc(method=api_method, code=str(code))
+                span.set(status=code)
+        return code, payload
@@ -4,6 +4,7 @@ from queue_manager import queue_manager
 from keyboards import get_main_keyboard, get_add_user_keyboard
 from utils import safe_edit_message, callback_delete_add_user
 from lock_manager import lock_manager
+from user_ingest import user_ingestor
 import logging
 
 
@@ -50,7 +51,7 @@ async def start_add_user_handler(query, topic_id, user_id, chat_id, context: Con
 
         # Таймер на удаление через 60 секунд
         context.job_queue.run_once(
-            callback_delete_add_user,
+            callback_add_user_timeout,
             60,
             data={
                 'chat_id': chat_id,
@@ -137,7 +138,8 @@ async def handle_add_user_input(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Ошибка: система временных задач недоступна")
         return
 
-    # Ищем пользователя среди known_users
+    # Ищем пользователя среди known_users (с учётом ещё не записанных профилей)
+    user_ingestor.flush()
     known_users = queue_manager.get_known_users(chat_id)
     target_user = None
     for user in known_users:
@@ -245,4 +247,12 @@ async def handle_add_user_input(update: Update, context: ContextTypes.DEFAULT_TY
     # Разблокируем топик
     lock_manager.unlock(topic_id)
 
-    logger.info(f"Add user completed for @{input_text} in topic {topic_id}")
\ No newline at end of file
+    logger.info(f"Add user completed for @{input_text} in topic {topic_id}")
+
+
+async def callback_add_user_timeout(context: ContextTypes.DEFAULT_TYPE):
+    """Истечение времени на ввод @username: закрываем сессию и освобождаем топик"""
+    session = active_add_sessions.pop(context.job.data['add_id'], None)
+    if session:
+        lock_manager.unlock_by_user(session['topic_id'], session['initiator_id'])
+    await callback_delete_add_user(context)
@@ -1,3 +1,4 @@
+import asyncio
 from telegram.ext import ContextTypes
 from queue_manager import queue_manager
 from keyboards import get_main_keyboard
@@ -17,13 +18,15 @@ async def add_to_queue_handler(query, topic_id, user_id, context: ContextTypes.D
         )
 
         if success:
+            # Уведомление и обновление основного сообщения отправляются параллельно
+            pending = [query.answer("✅ Вы успешно добавлены в очередь!")]
             main_message_id = queue_manager.get_queue_message_id(topic_id)
             if main_message_id:
-                await safe_edit_message(
+                pending.append(safe_edit_message(
                     context, query.message.chat_id, main_message_id,
                     queue_manager.get_queue_text(topic_id), get_main_keyboard()
-                )
-            await query.answer("✅ Вы успешно добавлены в очередь!")
+                ))
+            await asyncio.gather(*pending)
         else:
             await query.answer("❌ Вы уже в очереди!")
     except Exception as e:
@@ -164,22 +164,7 @@ async def give_take_handler(query, give_id, chat_id, context: ContextTypes.DEFAU
         # Отмена таймера
         _cancel_give_timeout(context, give_id)
 
-        # Удаляем taker из очереди, если он там
-        queue_manager.remove_user_from_queue(topic_id, taker_id)
-
-        # Находим позицию giver
-        queue = queue_manager.queues[topic_id]
-        giver_pos = next((i for i, u in enumerate(queue) if u['user_id'] == session['giver_id']), None)
-        if giver_pos is None:
-            await query.edit_message_text("Место уже недоступно.")
-            _cleanup_give_session(give_id)
-            lock_manager.unlock(topic_id)  # Разблокируем
-            return
-
-        # Удаляем giver
-        giver = queue.pop(giver_pos)
-
-        # Добавляем taker на место giver
+        # Taker занимает место giver (и уходит со своего места, если был в очереди)
         taker_data = {
             'user_id': taker_id,
             'first_name': query.from_user.first_name or '',
@@ -188,9 +173,12 @@ async def give_take_handler(query, give_id, chat_id, context: ContextTypes.DEFAU
             'display_name': f"{query.from_user.first_name or ''} {query.from_user.last_name or ''}".strip() or f"User_{taker_id}",
             'joined_at': datetime.now().isoformat()
         }
-        queue.insert(giver_pos, taker_data)
-
-        queue_manager.save_data()
+        giver = queue_manager.give_place(topic_id, session['giver_id'], taker_data)
+        if giver is None:
+            await query.edit_message_text("Место уже недоступно.")
+            _cleanup_give_session(give_id)
+            lock_manager.unlock(topic_id)  # Разблокируем
+            return
 
         # Формируем сообщение
         giver_mention = f"@{giver['username']}" if giver['username'] else giver['display_name']
@@ -2,6 +2,7 @@ from telegram.ext import ContextTypes
 from queue_manager import queue_manager
 from keyboards import get_main_keyboard
 from utils import safe_edit_message
+from lock_manager import lock_manager
 import logging
 
 
@@ -29,6 +30,10 @@ async def remove_from_queue_handler(query, topic_id, user_id, context: ContextTy
                         logger.error(f"Error deleting proposal message on remove: {e}")
 
             for sid in to_remove:
+                # Обмен отменён: снимаем его таймер и блокировку топика инициатора
+                for job in context.job_queue.get_jobs_by_name(f"swap_timeout_{sid}"):
+                    job.schedule_removal()
+                lock_manager.unlock_by_user(topic_id, queue_manager.pending_swaps[sid]['user1_id'])
                 queue_manager.remove_pending_swap(sid)
 
             main_message_id = queue_manager.get_queue_message_id(topic_id)
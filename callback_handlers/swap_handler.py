@@ -49,7 +49,9 @@ async def start_swap_handler(query, topic_id, user_id, chat_id, context: Context
             data={
                 'chat_id': chat_id,
                 'message_id': sent_message.message_id,
-                'selection_id': selection_id
+                'selection_id': selection_id,
+                'topic_id': topic_id,
+                'user_id': user_id
             },
             name=f"selection_timeout_{selection_id}"
         )
@@ -75,7 +77,10 @@ async def create_swap_proposal(query, topic_id, user1_id, user2_id, chat_id, con
             await query.answer("Это меню только для инициатора обмена!")
             return
 
-        # Удаляем сообщение с выбором пользователя
+        # Удаляем сообщение с выбором пользователя и его таймер: иначе таймер освободит топик посреди обмена
+        selection_id = f"selection_{chat_id}_{topic_id}_{user1_id}_{query.message.message_id}"
+        for job in context.job_queue.get_jobs_by_name(f"selection_timeout_{selection_id}"):
+            job.schedule_removal()
         try:
             await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
         except Exception as e:
@@ -87,6 +92,8 @@ async def create_swap_proposal(query, topic_id, user1_id, user2_id, chat_id, con
         user2 = next((u for u in queue if u['user_id'] == user2_id), None)
 
         if not user1 or not user2:
+            # Таймер выбора уже снят, освободить топик больше некому
+            lock_manager.unlock(topic_id)
             await query.answer("Пользователь не найден в очереди")
             return
 
@@ -180,7 +187,9 @@ async def swap_back_handler(query, swap_id, chat_id, context: ContextTypes.DEFAU
             data={
                 'chat_id': chat_id,
                 'message_id': query.message.message_id,
-                'selection_id': selection_id
+                'selection_id': selection_id,
+                'topic_id': topic_id,
+                'user_id': user_id
             },
             name=f"selection_timeout_{selection_id}"
         )
@@ -1,15 +1,36 @@
 import logging
+import os
+from datetime import datetime
 from telegram import Update
-from telegram.ext import ContextTypes, CommandHandler
+from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters
 from telegram.error import TimedOut, NetworkError
 
-from queue_manager import queue_manager
+from queue_manager import queue_manager, format_wait
 from keyboards import get_main_keyboard
-from utils import safe_edit_message, send_temp_message
+from utils import safe_edit_message, send_temp_message, callback_profile_done
+from lock_manager import lock_manager, topic_serializer, serialize_by_topic
+from user_ingest import user_ingestor
+from profiler import profiler
+from stats import update_rate, job_counter
+from backup import backup_manager
+from queue_expiry import parse_expiry, format_ttl
+from queue_policy import POLICIES
+from queue_io import EXPORT_FORMATS, MAX_IMPORT_BYTES, RosterError, export_queue, parse_roster, resolve_roster
+from callback_handlers.add_user_handler import active_add_sessions
+from callback_handlers.give_handler import active_give_sessions
 
 logger = logging.getLogger(__name__)
 
 
+def is_operator(user_id):
+    """
+    Оператор бота из BOT_OPERATORS (id через запятую). Команды, затрагивающие весь процесс
+    и все чаты (/profile), доступны только операторам, а не админам отдельных групп
+    """
+    operators = os.getenv('BOT_OPERATORS', '')
+    return str(user_id) in {item.strip() for item in operators.split(',') if item.strip()}
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     try:
@@ -34,16 +55,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Собираем администраторов и добавляем в known_users
             try:
                 admins = await context.bot.get_chat_administrators(chat_id)
-                for member in admins:
-                    user = member.user
-                    queue_manager.add_known_user(
-                        chat_id,
-                        user.id,
-                        user.first_name,
-                        user.last_name,
-                        user.username,
-                        user.is_bot
-                    )
+                queue_manager.upsert_known_users(
+                    (chat_id, member.user.id, member.user.first_name, member.user.last_name,
+                     member.user.username, member.user.is_bot)
+                    for member in admins
+                )
             except Exception as e:
                 logger.error(f"Error collecting admins in start: {e}")
 
@@ -85,16 +101,11 @@ async def init_queue_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
             # Собираем администраторов и добавляем в known_users
             try:
                 admins = await context.bot.get_chat_administrators(chat_id)
-                for member in admins:
-                    user = member.user
-                    queue_manager.add_known_user(
-                        chat_id,
-                        user.id,
-                        user.first_name,
-                        user.last_name,
-                        user.username,
-                        user.is_bot
-                    )
+                queue_manager.upsert_known_users(
+                    (chat_id, member.user.id, member.user.first_name, member.user.last_name,
+                     member.user.username, member.user.is_bot)
+                    for member in admins
+                )
             except Exception as e:
                 logger.error(f"Error collecting admins in init: {e}")
 
@@ -125,15 +136,91 @@ async def init_queue_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для принудительного сохранения данных"""
+    """Команда для принудительного сохранения данных и резервной копии"""
     try:
         queue_manager.save_data()
-        # Удаляем сообщение с командой /backup без отправки подтверждения
+        result = await backup_manager.create(queue_manager)
+        if update.message.is_topic_message:
+            await send_temp_message(
+                context, update.message.chat_id, update.message.message_thread_id,
+                f"💾 Резервная копия {result['name']} ({result['bytes'] / 1024:.1f} КБ)",
+                duration=10
+            )
         await update.message.delete()
     except Exception as e:
         logger.error(f"Error in backup command: {e}")
 
 
+async def restore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /restore [имя] - список копий или восстановление чата из копии (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /restore."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            if not context.args:
+                backups = backup_manager.list_backups()[-10:]
+                if backups:
+                    lines = "\n".join(f"{b['name']} ({b['bytes'] / 1024:.1f} КБ)" for b in reversed(backups))
+                    text = f"💾 Последние резервные копии:\n\n{lines}\n\nВосстановить: /restore <имя>"
+                else:
+                    text = "💾 Резервных копий пока нет. Создать: /backup"
+                await send_temp_message(context, chat_id, topic_id, text, duration=60)
+                await update.message.delete()
+                return
+
+            name = context.args[0]
+            try:
+                state = await backup_manager.load_async(name)
+            except Exception as load_error:
+                logger.error(f"Error loading backup {name}: {load_error}")
+                await send_temp_message(context, chat_id, topic_id, f"❌ Не удалось прочитать копию {name}")
+                await update.message.delete()
+                return
+
+            # Восстанавливается только этот чат; перед этим текущее состояние тоже сохраняется в копию
+            await backup_manager.create(queue_manager)
+            topics = queue_manager.restore_chat(state, chat_id)
+
+            # Обновляем сообщения с очередями восстановленных топиков
+            for restored_topic in topics:
+                main_message_id = queue_manager.get_queue_message_id(restored_topic)
+                if main_message_id:
+                    await safe_edit_message(
+                        context, chat_id, main_message_id,
+                        queue_manager.get_queue_text(restored_topic), get_main_keyboard()
+                    )
+
+            logger.info(f"Chat {chat_id} restored from backup {name} by admin {user_id}")
+            await send_temp_message(
+                context, chat_id, topic_id, f"✅ Очереди чата восстановлены из копии {name}", duration=10
+            )
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in restore command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
 async def remove_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /remove @username1 @username2 ... для админов (можно несколько через пробел)"""
     try:
@@ -173,21 +260,13 @@ async def remove_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await update.message.delete()
                 return
 
-            removed_users = []
-            not_found_users = []
-            
-            # Обрабатываем всех переданных пользователей
-            for arg in context.args:
-                username = arg.lstrip('@')
-                
-                # Удаляем пользователя по username
-                removed = queue_manager.remove_user_by_username(topic_id, username)
-                
-                if removed:
-                    removed_users.append(f"@{username}")
-                    logger.info(f"User @{username} removed by admin {user_id}")
-                else:
-                    not_found_users.append(f"@{username}")
+            # Все пользователи удаляются за один проход очереди и одно сохранение
+            usernames = [arg.lstrip('@') for arg in context.args if arg.lstrip('@')]
+            removed = queue_manager.remove_users_by_username(topic_id, usernames)
+            removed_users = [f"@{username}" for username in usernames if username.lower() in removed]
+            not_found_users = [f"@{username}" for username in usernames if username.lower() not in removed]
+            if removed_users:
+                logger.info(f"Users {', '.join(removed_users)} removed by admin {user_id}")
 
             # Формируем отчет об удалении
             response_parts = []
@@ -237,8 +316,59 @@ async def remove_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             pass
 
 
-async def insert_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /insert @username позиция - вставить пользователя на позицию"""
+def queue_entry(known_user):
+    """Запись очереди для известного пользователя"""
+    return {
+        'user_id': known_user['user_id'],
+        'first_name': known_user['first_name'],
+        'last_name': known_user['last_name'],
+        'username': known_user['username'],
+        'display_name': known_user['display_name'],
+        'joined_at': datetime.now().isoformat()
+    }
+
+
+async def insert_known_users(context, chat_id, topic_id, requests):
+    """
+    Пакетная вставка известных пользователей: requests - [(username, позиция или None - в конец)]
+    Username разрешаются по индексу, очередь сохраняется один раз, сообщение с очередью
+    обновляется один раз, итог - одним временным сообщением
+    """
+    # Учитываем ещё не записанные профили
+    user_ingestor.flush()
+    entries = []
+    unknown = []
+    for username, position in requests:
+        known_user = queue_manager.find_known_user(chat_id, username)
+        if known_user is None:
+            unknown.append(f"@{username}")
+        else:
+            entries.append((queue_entry(known_user), position))
+
+    results = queue_manager.insert_users(topic_id, entries) if entries else []
+    inserted = [f"@{entry['username']} → {position}" for entry, position in results if position is not None]
+    already = [f"@{entry['username']}" for entry, position in results if position is None]
+
+    if inserted:
+        main_message_id = queue_manager.get_queue_message_id(topic_id)
+        if main_message_id:
+            await safe_edit_message(
+                context, chat_id, main_message_id,
+                queue_manager.get_queue_text(topic_id), get_main_keyboard()
+            )
+
+    response_parts = []
+    if inserted:
+        response_parts.append(f"✅ Добавлено в очередь:\n{', '.join(inserted)}")
+    if already:
+        response_parts.append(f"❌ Уже в очереди:\n{', '.join(already)}")
+    if unknown:
+        response_parts.append(f"❌ Не найдено среди известных:\n{', '.join(unknown)}")
+    await send_temp_message(context, chat_id, topic_id, "\n\n".join(response_parts))
+
+
+async def add_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /add @username1 @username2 ... - добавить известных пользователей в конец очереди"""
     try:
         if update.message and update.message.is_topic_message:
             topic_id = update.message.message_thread_id
@@ -262,7 +392,7 @@ async def insert_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 if member.status not in ['administrator', 'creator']:
                     await send_temp_message(
                         context, chat_id, topic_id,
-                        "❌ Только администраторы могут использовать /insert."
+                        "❌ Только администраторы могут использовать /add."
                     )
                     await update.message.delete()
                     return
@@ -271,103 +401,335 @@ async def insert_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await update.message.delete()
                 return
 
-            if not context.args or len(context.args) < 2:
+            usernames = [arg.lstrip('@') for arg in context.args or [] if arg.lstrip('@')]
+            if not usernames:
                 await send_temp_message(
                     context, chat_id, topic_id,
-                    "❌ Формат команды: /insert @username позиция"
+                    "❌ Укажите @username для добавления.\n\n"
+                    "Можно указать несколько пользователей через пробел:\n"
+                    "<code>/add @user1 @user2 @user3</code>"
                 )
                 await update.message.delete()
                 return
 
-            username = context.args[0].lstrip('@')
-            
+            await insert_known_users(context, chat_id, topic_id, [(username, None) for username in usernames])
+            logger.info(f"Bulk add of {len(usernames)} users into topic {topic_id} by admin {user_id}")
+
+            # Удаляем сообщение с командой /add
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in add command: {e}")
+        try:
+            if update.message:
+                await send_temp_message(
+                    context, update.message.chat_id,
+                    update.message.message_thread_id if update.message.is_topic_message else None,
+                    "❌ Произошла ошибка при выполнении команды."
+                )
+                await update.message.delete()
+        except:
+            pass
+
+
+async def next_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /next [N] - снять первых N из очереди (по умолчанию одного) и позвать следующего (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
             try:
-                position = int(context.args[1])
-                if position < 1:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /next."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            count = 1
+            if context.args:
+                try:
+                    count = int(context.args[0])
+                except ValueError:
+                    count = 0
+                if count < 1:
                     await send_temp_message(
                         context, chat_id, topic_id,
-                        "❌ Позиция должна быть положительным числом."
+                        "❌ Формат команды: /next [количество]"
                     )
                     await update.message.delete()
                     return
-            except ValueError:
+
+            popped = queue_manager.pop_front(topic_id, count)
+            if not popped:
+                await send_temp_message(context, chat_id, topic_id, "Очередь пуста")
+                await update.message.delete()
+                return
+
+            # Одно обновление сообщения с очередью на все снятые записи
+            main_message_id = queue_manager.get_queue_message_id(topic_id)
+            if main_message_id:
+                await safe_edit_message(
+                    context, chat_id, main_message_id,
+                    queue_manager.get_queue_text(topic_id), get_main_keyboard()
+                )
+
+            # Упоминание нового первого; повторно одному и тому же не отправляется
+            head = queue_manager.claim_head_notification(topic_id)
+            if head:
+                head_mention = f"@{head['username']}" if head['username'] else head['display_name']
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"🔔 {head_mention}, ваша очередь!",
+                    message_thread_id=topic_id
+                )
+
+            logger.info(f"{len(popped)} users taken from queue {topic_id} by admin {user_id}")
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in next command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+async def insert_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /insert @username позиция [@username позиция ...] - вставить пользователей на позиции"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Собираем пользователя, который вызвал команду
+            user = update.message.from_user
+            queue_manager.add_known_user(
+                chat_id,
+                user.id,
+                user.first_name,
+                user.last_name,
+                user.username,
+                user.is_bot
+            )
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /insert."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            # Пары "@username позиция": /insert @a 3 @b 5
+            args = context.args or []
+            requests = []
+            if args and len(args) % 2 == 0:
+                for username, position in zip(args[::2], args[1::2]):
+                    if not position.lstrip('-').isdigit():
+                        requests = []
+                        break
+                    requests.append((username.lstrip('@'), int(position)))
+
+            if not requests:
                 await send_temp_message(
                     context, chat_id, topic_id,
-                    "❌ Позиция должна быть числом."
+                    "❌ Формат команды: /insert @username позиция\n\n"
+                    "Можно указать несколько пар:\n"
+                    "<code>/insert @user1 3 @user2 5</code>"
                 )
                 await update.message.delete()
                 return
 
-            # Ищем пользователя в known_users
-            target_user = None
-            known_users = queue_manager.get_known_users(chat_id)
-            
-            for user in known_users:
-                if user['username'] == username:
-                    target_user = user
-                    break
+            if any(position < 1 for _, position in requests):
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    "❌ Позиция должна быть положительным числом."
+                )
+                await update.message.delete()
+                return
+
+            await insert_known_users(context, chat_id, topic_id, requests)
+            logger.info(f"Bulk insert of {len(requests)} users into topic {topic_id} by admin {user_id}")
+
+            # Удаляем сообщение с командой /insert
+            await update.message.delete()
             
-            # Если не нашли в known_users
-            if not target_user:
+    except Exception as e:
+        logger.error(f"Error in insert command: {e}")
+        try:
+            if update.message:
+                await send_temp_message(
+                    context, update.message.chat_id,
+                    update.message.message_thread_id if update.message.is_topic_message else None,
+                    "❌ Произошла ошибка при выполнении команды."
+                )
+                await update.message.delete()
+        except:
+            pass
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export [csv|json] - выгрузить очередь топика файлом (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /export."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            fmt = context.args[0].lower() if context.args else 'csv'
+            if fmt not in EXPORT_FORMATS:
                 await send_temp_message(
                     context, chat_id, topic_id,
-                    f"❌ @{username} не найден среди известных."
+                    "❌ Формат команды: /export [csv|json]"
                 )
                 await update.message.delete()
                 return
 
             queue = queue_manager.queues[topic_id]
-            
-            # Проверяем, не в очереди ли уже пользователь
-            for existing_user in queue:
-                if existing_user['user_id'] == target_user['user_id']:
+            buffer = export_queue(queue, fmt)
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=buffer,
+                filename=f"queue_{topic_id}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}",
+                caption=f"📋 Очередь: {len(queue)} чел.",
+                message_thread_id=topic_id,
+                disable_notification=True
+            )
+            logger.info(f"Queue {topic_id} exported as {fmt} by admin {user_id}")
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in export command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /import - добавить в очередь пользователей из файла (только для админов)
+    Файл прикладывается к сообщению с подписью /import или команда отправляется ответом на файл
+    """
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
                     await send_temp_message(
                         context, chat_id, topic_id,
-                        f"❌ @{username} уже в очереди."
+                        "❌ Только администраторы могут использовать /import."
                     )
                     await update.message.delete()
                     return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
 
-            # Вставляем пользователя на указанную позицию
-            insert_position = min(position - 1, len(queue))
+            document = update.message.document
+            if document is None and update.message.reply_to_message:
+                document = update.message.reply_to_message.document
+            if document is None:
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    "❌ Приложите CSV или JSON файл с подписью /import или ответьте /import на сообщение с файлом.\n\n"
+                    "В файле нужен столбец username (или user_id), position - по желанию.",
+                    duration=10
+                )
+                await update.message.delete()
+                return
+            if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    f"❌ Файл больше {MAX_IMPORT_BYTES // 1024} КБ."
+                )
+                await update.message.delete()
+                return
 
-            user_data = {
-                'user_id': target_user['user_id'],
-                'first_name': target_user['first_name'],
-                'last_name': target_user['last_name'],
-                'username': target_user['username'],
-                'display_name': target_user['display_name'],
-            }
+            telegram_file = await context.bot.get_file(document.file_id)
+            data = await telegram_file.download_as_bytearray()
+            try:
+                entries = parse_roster(data, document.file_name or '')
+            except RosterError as roster_error:
+                logger.warning(f"Invalid roster for topic {topic_id}: {roster_error}")
+                await send_temp_message(context, chat_id, topic_id, f"❌ Не удалось разобрать файл: {roster_error}")
+                await update.message.delete()
+                return
 
-            queue.insert(insert_position, user_data)
-            queue_manager.save_data()
+            # Учитываем ещё не записанные профили, затем сопоставляем весь файл за один проход
+            user_ingestor.flush()
+            resolved, unresolved = resolve_roster(queue_manager, chat_id, entries)
+            results = queue_manager.insert_users(
+                topic_id, [(queue_entry(known_user), position) for known_user, position in resolved]
+            ) if resolved else []
+            inserted = sum(1 for _, position in results if position is not None)
 
-            # Обновляем основное сообщение с очередью
-            main_message_id = queue_manager.get_queue_message_id(topic_id)
-            if main_message_id:
-                try:
+            # Одно обновление сообщения с очередью на весь файл
+            if inserted:
+                main_message_id = queue_manager.get_queue_message_id(topic_id)
+                if main_message_id:
                     await safe_edit_message(
                         context, chat_id, main_message_id,
                         queue_manager.get_queue_text(topic_id), get_main_keyboard()
                     )
-                except:
-                    pass
 
-            logger.info(f"User @{username} inserted at position {insert_position + 1} by admin {user_id}")
-            
-            # Удаляем сообщение с командой /insert
+            response_parts = [f"✅ Добавлено в очередь: {inserted}"]
+            if len(results) > inserted:
+                response_parts.append(f"Уже в очереди: {len(results) - inserted}")
+            if unresolved:
+                # Список ненайденных ограничен, чтобы уложиться в длину сообщения
+                shown = ', '.join(unresolved[:20]) + (' ...' if len(unresolved) > 20 else '')
+                response_parts.append(f"❌ Не найдено среди известных ({len(unresolved)}):\n{shown}")
+            await send_temp_message(context, chat_id, topic_id, "\n".join(response_parts), duration=10)
+            logger.info(
+                f"Roster imported into topic {topic_id} by admin {user_id}: "
+                f"{inserted} inserted, {len(results) - inserted} present, {len(unresolved)} unresolved"
+            )
             await update.message.delete()
-            
+
     except Exception as e:
-        logger.error(f"Error in insert command: {e}")
+        logger.error(f"Error in import command: {e}")
         try:
-            if update.message:
-                await send_temp_message(
-                    context, update.message.chat_id,
-                    update.message.message_thread_id if update.message.is_topic_message else None,
-                    "❌ Произошла ошибка при выполнении команды."
-                )
-                await update.message.delete()
+            await update.message.delete()
         except:
             pass
 
@@ -411,8 +773,7 @@ async def clear_queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
 
             # Очищаем очередь
-            queue_manager.queues[topic_id] = []
-            queue_manager.save_data()
+            queue_manager.clear_queue(topic_id)
 
             # Обновляем основное сообщение с очередью
             main_message_id = queue_manager.get_queue_message_id(topic_id)
@@ -435,11 +796,424 @@ async def clear_queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             pass
 
 
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [секунды] - семплирующее профилирование бота (только для операторов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Профиль охватывает весь процесс и все чаты: админства в группе недостаточно
+            if not is_operator(user_id):
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    "❌ /profile доступна только операторам бота."
+                )
+                await update.message.delete()
+                return
+
+            duration = 30
+            if context.args:
+                try:
+                    duration = int(context.args[0])
+                except ValueError:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Формат команды: /profile [секунды]"
+                    )
+                    await update.message.delete()
+                    return
+            duration = min(max(duration, 1), 300)
+
+            path = profiler.start(duration)
+            if path is None:
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    "⚠️ Профилирование уже запущено."
+                )
+            else:
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    f"⏱ Профилирование запущено на {duration} сек."
+                )
+                if context.job_queue:
+                    context.job_queue.run_once(
+                        callback_profile_done,
+                        duration + 1,
+                        data={'chat_id': chat_id, 'topic_id': topic_id, 'path': path}
+                    )
+                logger.info(f"Profiling for {duration}s started by operator {user_id}")
+
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in profile command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+async def ttl_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /ttl [6h|90m|23:00|off] - автоистечение записей очереди (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /ttl."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            usage = ("Формат команды:\n"
+                     "<code>/ttl 6h</code> - снимать записи через 6 часов (m - минуты, h - часы, d - дни)\n"
+                     "<code>/ttl 23:00</code> - очищать очередь каждый день в 23:00\n"
+                     "<code>/ttl off</code> - отключить")
+            if context.args:
+                try:
+                    kind, value = parse_expiry(" ".join(context.args))
+                except ValueError:
+                    await send_temp_message(context, chat_id, topic_id, f"❌ {usage}", duration=15)
+                    await update.message.delete()
+                    return
+                if kind == 'off':
+                    queue_manager.disable_topic_expiry(topic_id)
+                elif kind == 'ttl':
+                    queue_manager.set_topic_expiry(topic_id, ttl=value)
+                else:
+                    queue_manager.set_topic_expiry(topic_id, clear_at=value)
+                logger.info(f"Expiry of topic {topic_id} changed to {kind} {value} by admin {user_id}")
+
+            settings = queue_manager.topic_expiry.get(topic_id)
+            parts = []
+            if settings and settings.get('ttl'):
+                parts.append(f"записи снимаются через {format_ttl(settings['ttl'])}")
+            if settings and settings.get('clear_at'):
+                parts.append(f"очередь очищается в {settings['clear_at']}")
+            text = f"⏳ Автоистечение: {', '.join(parts)}" if parts else f"⏳ Автоистечение выключено.\n\n{usage}"
+            await send_temp_message(context, chat_id, topic_id, text, duration=15)
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in ttl command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+async def policy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /policy [fifo|priority|weighted] - порядок очереди топика (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /policy."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            if context.args:
+                kind = context.args[0].lower()
+                if kind not in POLICIES:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Формат команды: /policy [fifo|priority|weighted]"
+                    )
+                    await update.message.delete()
+                    return
+                queue_manager.set_topic_policy(topic_id, kind)
+                logger.info(f"Queue {topic_id} policy set to {kind} by admin {user_id}")
+
+                # Смена политики может переставить очередь
+                main_message_id = queue_manager.get_queue_message_id(topic_id)
+                if main_message_id:
+                    await safe_edit_message(
+                        context, chat_id, main_message_id,
+                        queue_manager.get_queue_text(topic_id), get_main_keyboard()
+                    )
+
+            policy = queue_manager.topic_policies.get(topic_id)
+            kind = policy.kind if policy else 'fifo'
+            descriptions = {
+                'fifo': "по времени записи",
+                'priority': "сначала пользователи с большим приоритетом (/priority @username N)",
+                'weighted': "взвешенная справедливость (/priority @username вес)",
+            }
+            await send_temp_message(
+                context, chat_id, topic_id, f"⚖️ Порядок очереди: {kind} - {descriptions[kind]}", duration=15
+            )
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in policy command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+async def priority_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /priority @username N - приоритет или вес пользователя в топике (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /priority."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            policy = queue_manager.topic_policies.get(topic_id)
+            if policy is None or not policy.ordered:
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    "❌ Сначала включите порядок: /policy priority или /policy weighted"
+                )
+                await update.message.delete()
+                return
+
+            level = None
+            if context.args and len(context.args) == 2:
+                try:
+                    level = int(context.args[1])
+                except ValueError:
+                    level = None
+            # Вес должен быть положительным, приоритет - любое целое
+            if level is None or (policy.kind == 'weighted' and level < 1):
+                await send_temp_message(
+                    context, chat_id, topic_id,
+                    "❌ Формат команды: /priority @username N\n\n"
+                    "priority: N - приоритет, больший обслуживается раньше (по умолчанию 0)\n"
+                    "weighted: N - вес от 1, пользователь с весом 2 обслуживается вдвое чаще"
+                )
+                await update.message.delete()
+                return
+
+            user_ingestor.flush()
+            username = context.args[0].lstrip('@')
+            target_user = queue_manager.find_known_user(chat_id, username)
+            if target_user is None:
+                await send_temp_message(context, chat_id, topic_id, f"❌ @{username} не найден среди известных.")
+                await update.message.delete()
+                return
+
+            queue_manager.set_user_level(topic_id, target_user['user_id'], level)
+            main_message_id = queue_manager.get_queue_message_id(topic_id)
+            if main_message_id:
+                await safe_edit_message(
+                    context, chat_id, main_message_id,
+                    queue_manager.get_queue_text(topic_id), get_main_keyboard()
+                )
+            label = "Приоритет" if policy.kind == 'priority' else "Вес"
+            await send_temp_message(context, chat_id, topic_id, f"✅ {label} @{username}: {level}")
+            logger.info(f"User {target_user['user_id']} level in topic {topic_id} set to {level} by admin {user_id}")
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in priority command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+# Названия операций для отчёта /undo
+UNDO_LABELS = {
+    'join': "запись", 'leave': "выход", 'remove': "удаление", 'insert': "вставка", 'give': "передача места",
+    'swap': "обмен", 'clear': "очистка", 'next': "/next", 'expire': "автоистечение",
+}
+
+
+async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /undo [N] - отменить последние N изменений очереди топика (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /undo."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            count = 1
+            if context.args:
+                try:
+                    count = int(context.args[0])
+                except ValueError:
+                    count = 0
+                if count < 1:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        f"❌ Формат команды: /undo [количество], не больше {queue_manager.undo_depth}"
+                    )
+                    await update.message.delete()
+                    return
+
+            undone = queue_manager.undo(topic_id, count)
+            if not undone:
+                await send_temp_message(context, chat_id, topic_id, "Нечего отменять")
+                await update.message.delete()
+                return
+
+            main_message_id = queue_manager.get_queue_message_id(topic_id)
+            if main_message_id:
+                await safe_edit_message(
+                    context, chat_id, main_message_id,
+                    queue_manager.get_queue_text(topic_id), get_main_keyboard()
+                )
+            labels = ", ".join(UNDO_LABELS.get(op, op) for op in undone)
+            await send_temp_message(context, chat_id, topic_id, f"↩️ Отменено: {labels}", duration=10)
+            logger.info(f"{len(undone)} operations undone in queue {topic_id} by admin {user_id}")
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in undo command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - внутренние счётчики бота (только для админов)"""
+    try:
+        if update.message and update.message.is_topic_message:
+            topic_id = update.message.message_thread_id
+            chat_id = update.message.chat_id
+            user_id = update.message.from_user.id
+
+            # Проверяем, является ли пользователь админом
+            try:
+                member = await context.bot.get_chat_member(chat_id, user_id)
+                if member.status not in ['administrator', 'creator']:
+                    await send_temp_message(
+                        context, chat_id, topic_id,
+                        "❌ Только администраторы могут использовать /stats."
+                    )
+                    await update.message.delete()
+                    return
+            except Exception as admin_error:
+                logger.error(f"Error checking admin status: {admin_error}")
+                await update.message.delete()
+                return
+
+            # Все значения берутся из счётчиков и размеров словарей, без обхода данных
+            if queue_manager.last_save_duration is not None:
+                last_save = (f"{queue_manager.last_save_duration * 1000:.1f} мс, "
+                             f"{queue_manager.last_save_bytes / 1024:.1f} КБ")
+            else:
+                last_save = "ещё не было"
+
+            # Агрегаты журнала очереди поддерживаются при каждом /next
+            queue_stats = queue_manager.events.stats.get(topic_id)
+            if queue_stats and queue_stats.served:
+                service = format_wait(queue_stats.ewma_service)
+                average_wait = format_wait(queue_stats.average_wait())
+                throughput = queue_stats.throughput()
+            else:
+                service = average_wait = "нет данных"
+                throughput = 0
+
+            text = (
+                "📊 Статистика бота\n\n"
+                f"Топиков в памяти: {len(queue_manager.queues)}\n"
+                f"Записей во всех очередях: {queue_manager.total_entries}\n"
+                f"В этой очереди: {len(queue_manager.queues.get(topic_id, []))}\n"
+                f"Время на одного (EWMA): {service}\n"
+                f"Среднее ожидание: {average_wait}\n"
+                f"Обслужено за час: {throughput}\n"
+                f"Известных пользователей в чате: {len(queue_manager.known_users.get(chat_id, []))}\n"
+                f"Известных пользователей всего: {queue_manager.known_users_total}\n"
+                f"Ожидающих обменов: {len(queue_manager.pending_swaps)}\n"
+                f"Сессий добавления: {len(active_add_sessions)}\n"
+                f"Сессий отдачи места: {len(active_give_sessions)}\n"
+                f"Заблокированных топиков: {len(lock_manager.locks)}\n"
+                f"Топиков в обработке: {topic_serializer.active_count()}\n"
+                f"Запланированных задач: {job_counter.count}\n"
+                f"Последнее сохранение: {last_save}\n"
+                f"Обновлений за минуту: {update_rate.total()}"
+            )
+            await send_temp_message(context, chat_id, topic_id, text, duration=30)
+            await update.message.delete()
+
+    except Exception as e:
+        logger.error(f"Error in stats command: {e}")
+        try:
+            await update.message.delete()
+        except:
+            pass
+
+
 def register_command_handlers(application):
     """Регистрация обработчиков команд"""
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("init", init_queue_message))
+    application.add_handler(CommandHandler("start", serialize_by_topic(start)))
+    application.add_handler(CommandHandler("init", serialize_by_topic(init_queue_message)))
     application.add_handler(CommandHandler("backup", backup_command))
-    application.add_handler(CommandHandler("remove", remove_user_command))
-    application.add_handler(CommandHandler("insert", insert_user_command))
-    application.add_handler(CommandHandler("clear", clear_queue_command))
\ No newline at end of file
+    application.add_handler(CommandHandler("restore", serialize_by_topic(restore_command)))
+    application.add_handler(CommandHandler("remove", serialize_by_topic(remove_user_command)))
+    application.add_handler(CommandHandler("insert", serialize_by_topic(insert_user_command)))
+    application.add_handler(CommandHandler("add", serialize_by_topic(add_users_command)))
+    application.add_handler(CommandHandler("next", serialize_by_topic(next_command)))
+    application.add_handler(CommandHandler("ttl", serialize_by_topic(ttl_command)))
+    application.add_handler(CommandHandler("policy", serialize_by_topic(policy_command)))
+    application.add_handler(CommandHandler("priority", serialize_by_topic(priority_command)))
+    application.add_handler(CommandHandler("undo", serialize_by_topic(undo_command)))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", serialize_by_topic(import_command)))
+    # Файл с подписью /import: подписи не обрабатываются CommandHandler
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r'^/import(@\w+)?(\s|$)'), serialize_by_topic(import_command)
+    ))
+    application.add_handler(CommandHandler("clear", serialize_by_topic(clear_queue_command)))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("stats", stats_command))
\ No newline at end of file
@@ -0,0 +1,527 @@
+"""
+Локальная замена Telegram Bot API для нагрузочного тестирования
+
+Бот подключается к ней через TELEGRAM_BASE_URL (например, http://127.0.0.1:8081/bot),
+а тестовый драйвер добавляет обновления от имитируемых пользователей и замеряет задержку
+ответов. Поддерживаются искусственная задержка, ответы 429 с retry_after и ошибки сервера.
+
+Самостоятельный запуск:
+    python fake_bot_api.py --port 8081 --latency 0.05 --flood-rate 0.01
+Обновления можно добавить извне: POST /_control/updates с JSON (объект или список)
+После setWebhook обновления доставляются POST-запросами на заданный адрес с секретом
+в заголовке, как это делает Telegram; отклонённые доставки повторяются
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from collections import defaultdict, deque
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from urllib.parse import parse_qsl
+
+import httpx
+
+from http_server import LocalHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Параметры, которые PTB передаёт как JSON-строки
+JSON_FIELDS = {'reply_markup', 'message_ids', 'allowed_updates', 'entities'}
+INT_FIELDS = {'chat_id', 'message_id', 'message_thread_id', 'user_id', 'offset', 'limit', 'timeout'}
+# Методы, на которые не действуют ошибки и ограничения (иначе бот не сможет запуститься)
+FAULT_EXEMPT = {'getme', 'getupdates', 'deletewebhook', 'setwebhook'}
+# Методы, на которые действует ограничение частоты сообщений в чате
+CHAT_RATE_METHODS = {'sendmessage', 'editmessagetext', 'senddocument'}
+
+ADMIN_RIGHTS = {
+    'can_be_edited': False, 'is_anonymous': False, 'can_manage_chat': True,
+    'can_delete_messages': True, 'can_manage_video_chats': True, 'can_restrict_members': True,
+    'can_promote_members': False, 'can_change_info': True, 'can_invite_users': True,
+    'can_post_stories': False, 'can_edit_stories': False, 'can_delete_stories': False,
+    'can_pin_messages': True, 'can_manage_topics': True,
+}
+
+
+class APIError(Exception):
+    """Ответ Bot API с ok=false"""
+    def __init__(self, code, description, retry_after=None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class FaultConfig:
+    """
+    Внедряемые сбои
+    latency/jitter - задержка ответа (секунды), error_rate - доля ответов 500,
+    flood_rate - доля случайных ответов 429 с retry_after секундами,
+    chat_rate/chat_burst - ограничение сообщений в секунду на чат (как у Telegram в группах)
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, flood_rate=0.0, retry_after=1,
+                 chat_rate=None, chat_burst=20):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+
+def make_user(user_id, first_name=None, username=None, last_name=None):
+    """Пользователь Telegram в формате Bot API"""
+    user = {
+        'id': user_id,
+        'is_bot': False,
+        'first_name': first_name or f"User{user_id}",
+        'username': username if username is not None else f"user{user_id}",
+    }
+    if last_name:
+        user['last_name'] = last_name
+    return user
+
+
+class FakeBotAPI:
+    """Имитация Bot API поверх LocalHTTPServer"""
+    def __init__(self, listen='127.0.0.1', port=0, faults=None):
+        self.faults = faults or FaultConfig()
+        self.http = LocalHTTPServer(listen, port, max_body_size=50 * 1024 * 1024)
+        self.http.fallback = self._handle
+        self.http.route('POST', '/_control/updates', self._handle_control_updates)
+
+        self.bot_user = {
+            'id': 7000000001, 'is_bot': True, 'first_name': 'Queue Bot', 'username': 'fake_queue_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False,
+        }
+        self.chats = {}  # chat_id -> чат в формате Bot API
+        self.admins = defaultdict(dict)  # chat_id -> {user_id: пользователь}
+        self.users = {}  # user_id -> пользователь (все, кого видел драйвер)
+        self.messages = {}  # (chat_id, message_id) -> сообщение
+        self._message_ids = itertools.count(1000)
+        self._update_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+        # Обновления, ещё не подтверждённые ботом через offset
+        self._updates = deque()
+        self._updates_event = asyncio.Event()
+
+        # Замеры: время добавления callback_query -> задержка до answerCallbackQuery
+        self._pending_callbacks = {}
+        self.callback_latencies = []
+        self.last_answer_at = None
+        self.calls = defaultdict(int)  # метод -> количество вызовов
+        self.errors = defaultdict(int)  # код ошибки -> количество
+        # Ожидание сообщений бота: список (предикат, future)
+        self._message_waiters = []
+        self._chat_buckets = {}  # chat_id -> [токены, время обновления]
+        # Webhook: параметры последнего setWebhook, все вызовы setWebhook и отклонённые доставки
+        self.webhook = None
+        self.webhook_calls = []
+        self.webhook_rejections = 0
+        self._webhook_task = None
+
+    @property
+    def base_url(self):
+        """Значение для TELEGRAM_BASE_URL"""
+        return f"http://{self.http.listen}:{self.http.port}/bot"
+
+    async def start(self):
+        await self.http.start()
+
+    async def stop(self):
+        self._stop_webhook()
+        await self.http.stop()
+
+    # ----- Состояние, которым управляет драйвер -----
+
+    def add_chat(self, chat_id, title=None, admins=()):
+        """Зарегистрировать форум-группу и её администраторов"""
+        self.chats[chat_id] = {
+            'id': chat_id, 'type': 'supergroup', 'title': title or f"Chat {chat_id}", 'is_forum': True,
+        }
+        for user in admins:
+            self.users[user['id']] = user
+            self.admins[chat_id][user['id']] = user
+        return self.chats[chat_id]
+
+    def push_update(self, payload):
+        """Добавить обновление в очередь getUpdates. Возвращает update_id"""
+        update = dict(payload)
+        update.setdefault('update_id', next(self._update_ids))
+        self._updates.append(update)
+        self._updates_event.set()
+        return update['update_id']
+
+    def send_text(self, chat_id, thread_id, user, text):
+        """Сообщение пользователя в топике. Возвращает update_id"""
+        self.users[user['id']] = user
+        message = self._new_message(chat_id, user, text, thread_id)
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self.push_update({'message': message})
+
+    def press_button(self, chat_id, message_id, user, data):
+        """Нажатие inline-кнопки под сообщением бота. Возвращает id callback_query"""
+        self.users[user['id']] = user
+        message = self.messages.get((chat_id, message_id))
+        if message is None:
+            raise KeyError(f"Message {message_id} not found in chat {chat_id}")
+        callback_id = str(next(self._callback_ids))
+        self._pending_callbacks[callback_id] = time.perf_counter()
+        self.push_update({'callback_query': {
+            'id': callback_id,
+            'from': user,
+            'message': message,
+            'chat_instance': str(chat_id),
+            'data': data,
+        }})
+        return callback_id
+
+    def observe_update(self, update):
+        """Запомнить чаты, пользователей и сообщения из готового обновления
+        (например, записанного), чтобы бот мог их редактировать и удалять"""
+        query = update.get('callback_query')
+        message = update.get('message') or update.get('edited_message') or (query or {}).get('message')
+        for user in (update.get('message') or {}).get('from'), (query or {}).get('from'):
+            if user:
+                self.users[user['id']] = user
+        if message and message.get('chat'):
+            chat = message['chat']
+            self.chats.setdefault(chat['id'], chat)
+            if message.get('date'):
+                self.messages[(chat['id'], message['message_id'])] = message
+
+    def expect_answer(self, callback_id):
+        """Начать отсчёт задержки ответа на callback_query, добавленный в обход press_button"""
+        self._pending_callbacks[callback_id] = time.perf_counter()
+
+    @property
+    def unanswered_callbacks(self):
+        return len(self._pending_callbacks)
+
+    def wait_for_message(self, predicate, timeout=10.0):
+        """Дождаться сообщения бота, для которого predicate(message) истинно"""
+        future = asyncio.get_running_loop().create_future()
+        self._message_waiters.append((predicate, future))
+        return asyncio.wait_for(future, timeout)
+
+    def reset_stats(self):
+        self.callback_latencies = []
+        self.last_answer_at = None
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    # ----- HTTP -----
+
+    async def _handle_control_updates(self, request):
+        payload = json.loads(request.body or b'[]')
+        for update in payload if isinstance(payload, list) else [payload]:
+            self.push_update(update)
+        return 200, json.dumps({'ok': True}), {'Content-Type': 'application/json'}
+
+    async def _handle(self, request):
+        # Путь вида /bot<token>/<method>
+        prefix, _, method = request.path.rpartition('/')
+        if not prefix.startswith('/bot') or not method:
+            return self._error_response(APIError(404, 'Not Found'))
+        name = method.lower()
+        self.calls[method] += 1
+
+        try:
+            params = self._parse_params(request)
+            if name not in FAULT_EXEMPT:
+                await self._inject_faults(name, params)
+            handler = getattr(self, f"_api_{name}", None)
+            if handler is None:
+                raise APIError(404, 'Not Found: method not found')
+            result = await handler(params)
+        except APIError as e:
+            self.errors[e.code] += 1
+            return self._error_response(e)
+        return 200, json.dumps({'ok': True, 'result': result}, ensure_ascii=False), {
+            'Content-Type': 'application/json'
+        }
+
+    @staticmethod
+    def _error_response(error):
+        body = {'ok': False, 'error_code': error.code, 'description': error.description}
+        if error.retry_after is not None:
+            body['parameters'] = {'retry_after': error.retry_after}
+        return error.code, json.dumps(body, ensure_ascii=False), {'Content-Type': 'application/json'}
+
+    @staticmethod
+    def _parse_params(request):
+        content_type = request.headers.get('content-type', '')
+        raw = dict(request.query)
+        if content_type.startswith('application/json'):
+            raw.update(json.loads(request.body or b'{}'))
+        elif content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=default_policy).parsebytes(
+                b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + request.body
+            )
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename():
+                    raw[name] = {'filename': part.get_filename(), 'size': len(part.get_payload(decode=True))}
+                else:
+                    raw[name] = part.get_content()
+        elif request.body:
+            raw.update(parse_qsl(request.body.decode('utf-8'), keep_blank_values=True))
+
+        params = {}
+        for key, value in raw.items():
+            if isinstance(value, str):
+                if key in JSON_FIELDS:
+                    value = json.loads(value)
+                elif key in INT_FIELDS:
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        pass
+                elif value in ('true', 'false'):
+                    value = value == 'true'
+            params[key] = value
+        return params
+
+    async def _inject_faults(self, name, params):
+        faults = self.faults
+        if faults.latency or faults.jitter:
+            await asyncio.sleep(faults.latency + random.uniform(0, faults.jitter))
+        if faults.error_rate and random.random() < faults.error_rate:
+            raise APIError(500, 'Internal Server Error')
+        if faults.flood_rate and random.random() < faults.flood_rate:
+            raise APIError(429, f"Too Many Requests: retry after {faults.retry_after}", faults.retry_after)
+        if faults.chat_rate and name in CHAT_RATE_METHODS:
+            self._take_chat_token(params.get('chat_id'))
+
+    def _take_chat_token(self, chat_id):
+        """Ограничение частоты сообщений в чате (token bucket)"""
+        faults = self.faults
+        now = time.monotonic()
+        tokens, updated = self._chat_buckets.get(chat_id, (faults.chat_burst, now))
+        tokens = min(faults.chat_burst, tokens + (now - updated) * faults.chat_rate)
+        if tokens < 1:
+            self._chat_buckets[chat_id] = (tokens, now)
+            retry_after = max(1, math.ceil((1 - tokens) / faults.chat_rate))
+            raise APIError(429, f"Too Many Requests: retry after {retry_after}", retry_after)
+        self._chat_buckets[chat_id] = (tokens - 1, now)
+
+    # ----- Сообщения -----
+
+    def _chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            raise APIError(400, 'Bad Request: chat not found')
+        return chat
+
+    def _new_message(self, chat_id, sender, text, thread_id=None, reply_markup=None):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': self._chat(chat_id),
+            'from': sender,
+        }
+        if text is not None:
+            message['text'] = text
+        if thread_id:
+            message['message_thread_id'] = thread_id
+            message['is_topic_message'] = True
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        self.messages[(chat_id, message['message_id'])] = message
+        return message
+
+    def _bot_message(self, message):
+        """Сообщение бота создано или изменено: будим ожидающих"""
+        waiters = []
+        for predicate, future in self._message_waiters:
+            if future.done():
+                continue
+            if predicate(message):
+                future.set_result(message)
+            else:
+                waiters.append((predicate, future))
+        self._message_waiters = waiters
+        return message
+
+    # ----- Методы Bot API -----
+
+    async def _api_getme(self, params):
+        return self.bot_user
+
+    async def _api_deletewebhook(self, params):
+        if params.get('drop_pending_updates'):
+            self._updates.clear()
+        self._stop_webhook()
+        return True
+
+    async def _api_setwebhook(self, params):
+        self.webhook_calls.append(dict(params))
+        self._stop_webhook()
+        if params.get('url'):
+            self.webhook = {'url': params['url'], 'secret_token': params.get('secret_token')}
+            self._webhook_task = asyncio.create_task(self._deliver_webhook(self.webhook))
+        return True
+
+    def _stop_webhook(self):
+        self.webhook = None
+        if self._webhook_task:
+            self._webhook_task.cancel()
+            self._webhook_task = None
+
+    async def _deliver_webhook(self, webhook):
+        """Доставка обновлений на webhook по одному, в порядке update_id"""
+        headers = {'Content-Type': 'application/json'}
+        if webhook['secret_token']:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = webhook['secret_token']
+        async with httpx.AsyncClient(timeout=10) as client:
+            while True:
+                if not self._updates:
+                    self._updates_event.clear()
+                    await self._updates_event.wait()
+                    continue
+                update = self._updates[0]
+                try:
+                    response = await client.post(webhook['url'], content=json.dumps(update), headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = None
+                if status == 200:
+                    self._updates.popleft()
+                    continue
+                if status == 403:
+                    self.webhook_rejections += 1
+                await asyncio.sleep(0.1)
+
+    async def _api_getupdates(self, params):
+        if self.webhook:
+            raise APIError(409, "Conflict: can't use getUpdates method while webhook is active")
+        offset = params.get('offset')
+        if offset:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+        if not self._updates:
+            self._updates_event.clear()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), params.get('timeout') or 0)
+            except asyncio.TimeoutError:
+                pass
+        limit = params.get('limit') or 100
+        return list(itertools.islice(self._updates, limit))
+
+    async def _api_sendmessage(self, params):
+        chat_id = params.get('chat_id')
+        message = self._new_message(
+            chat_id, self.bot_user, params.get('text', ''),
+            params.get('message_thread_id'), params.get('reply_markup')
+        )
+        return self._bot_message(message)
+
+    async def _api_senddocument(self, params):
+        chat_id = params.get('chat_id')
+        message = self._new_message(chat_id, self.bot_user, None, params.get('message_thread_id'))
+        document = params.get('document')
+        message['document'] = {
+            'file_id': f"file{message['message_id']}",
+            'file_unique_id': f"u{message['message_id']}",
+            'file_name': document.get('filename') if isinstance(document, dict) else None,
+        }
+        if params.get('caption'):
+            message['caption'] = params['caption']
+        return self._bot_message(message)
+
+    async def _api_editmessagetext(self, params):
+        key = (params.get('chat_id'), params.get('message_id'))
+        message = self.messages.get(key)
+        if message is None:
+            raise APIError(400, 'Bad Request: message to edit not found')
+        text = params.get('text', '')
+        reply_markup = params.get('reply_markup')
+        if message.get('text') == text and message.get('reply_markup') == reply_markup:
+            raise APIError(400, 'Bad Request: message is not modified: specified new message content '
+                                'and reply markup are exactly the same as a current content and reply '
+                                'markup of the message')
+        message = dict(message, text=text, edit_date=int(time.time()))
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        else:
+            message.pop('reply_markup', None)
+        self.messages[key] = message
+        return self._bot_message(message)
+
+    async def _api_deletemessage(self, params):
+        if self.messages.pop((params.get('chat_id'), params.get('message_id')), None) is None:
+            raise APIError(400, 'Bad Request: message to delete not found')
+        return True
+
+    async def _api_deletemessages(self, params):
+        chat_id = params.get('chat_id')
+        for message_id in params.get('message_ids') or []:
+            self.messages.pop((chat_id, message_id), None)
+        return True
+
+    async def _api_answercallbackquery(self, params):
+        started = self._pending_callbacks.pop(params.get('callback_query_id'), None)
+        if started is None:
+            raise APIError(400, 'Bad Request: query is too old and response timeout expired or query ID is invalid')
+        self.last_answer_at = time.perf_counter()
+        self.callback_latencies.append(self.last_answer_at - started)
+        return True
+
+    async def _api_getchatmember(self, params):
+        chat_id = params.get('chat_id')
+        self._chat(chat_id)
+        user_id = params.get('user_id')
+        if user_id in self.admins[chat_id]:
+            return dict(ADMIN_RIGHTS, status='administrator', user=self.admins[chat_id][user_id])
+        user = self.users.get(user_id)
+        if user is None:
+            raise APIError(400, 'Bad Request: user not found')
+        return {'status': 'member', 'user': user}
+
+    async def _api_getchatadministrators(self, params):
+        chat_id = params.get('chat_id')
+        self._chat(chat_id)
+        return [dict(ADMIN_RIGHTS, status='administrator', user=user) for user in self.admins[chat_id].values()]
+
+
+async def _serve(args):
+    faults = FaultConfig(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        flood_rate=args.flood_rate, retry_after=args.retry_after, chat_rate=args.chat_rate
+    )
+    api = FakeBotAPI(args.listen, args.port, faults)
+    for chat_id in args.chat:
+        api.add_chat(chat_id, admins=[make_user(uid) for uid in args.admin])
+    await api.start()
+    logger.info(f"Fake Bot API: TELEGRAM_BASE_URL={api.base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, секунды")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--chat-rate', type=float, default=None, help="Сообщений в секунду на чат")
+    parser.add_argument('--chat', type=int, action='append', default=[], help="id чата (можно несколько)")
+    parser.add_argument('--admin', type=int, action='append', default=[], help="id администратора чатов")
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
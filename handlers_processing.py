@@ -3,6 +3,8 @@ from telegram.error import TimedOut, NetworkError
 from telegram import Update
 from telegram.ext import ContextTypes
 import logging
+import os
+import time
 
 from callback_handlers.add_user_handler import *
 from callback_handlers.add_yourself_handler import *
@@ -12,10 +14,43 @@ from callback_handlers.swap_handler import *
 from callback_handlers.give_handler import * 
 from callback_handlers.info_handler import * 
 from queue_manager import queue_manager
-from lock_manager import lock_manager
+from lock_manager import lock_manager, serialize_by_topic, topic_serializer, get_update_topic_key, LOCK_REJECTIONS
+from metrics import metrics
+from tracing import tracer
+from utils import CallbackAnswer
+from user_ingest import user_ingestor
 
 logger = logging.getLogger(__name__)
 
+# Сколько секунд обработчик может ответить на нажатие сам (с текстом или алертом),
+# прежде чем будет отправлен пустой ответ, убирающий "часики" у кнопки
+CALLBACK_ANSWER_GRACE = float(os.getenv('CALLBACK_ANSWER_GRACE', '0.2'))
+
+CALLBACK_DURATION = metrics.histogram(
+    'bot_callback_duration_seconds', 'Длительность обработки нажатий кнопок', ['action']
+)
+
+# Действия без параметров в callback_data
+CALLBACK_ACTIONS = {
+    "add_to_queue", "remove_from_queue", "start_swap", "back_to_main",
+    "start_add_user", "start_give_queue", "show_info",
+}
+# Действия с параметрами: префикс callback_data
+CALLBACK_ACTION_PREFIXES = (
+    "swap_with_", "swap_confirm_", "swap_cancel_", "swap_back_", "add_back_",
+    "give_confirm_", "give_cancel_", "give_back_", "give_take_",
+)
+
+
+def callback_action(data):
+    """Название действия по callback_data (без идентификаторов)"""
+    if data in CALLBACK_ACTIONS:
+        return data
+    for prefix in CALLBACK_ACTION_PREFIXES:
+        if data.startswith(prefix):
+            return prefix.rstrip("_")
+    return "other"
+
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback запросов"""
@@ -24,13 +59,26 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not query or not query.data or not query.message:
         return
 
-    # try:
-    #     await query.answer()
-    # except (TimedOut, NetworkError) as e:
-    #     logger.warning(f"Timeout answering callback: {e}")
-    # except Exception as e:
-    #     logger.error(f"Error answering callback: {e}")
+    # Ранний ответ на нажатие запускается до ожидания очереди топика: "часики" пропадают,
+    # даже если топик занят. Более поздние уведомления отбрасываются
+    query = CallbackAnswer(query, CALLBACK_ANSWER_GRACE)
+    action = callback_action(query.data)
+    start = time.perf_counter()
+    try:
+        with tracer.span('callback', action=action):
+            # Изменения очереди выполняются последовательно в пределах топика
+            key = get_update_topic_key(update)
+            if key is None:
+                await _dispatch_callback(query, context)
+            else:
+                await topic_serializer.run(key[0], key[1], _dispatch_callback, query, context)
+    finally:
+        await query.finish()
+        CALLBACK_DURATION.observe(time.perf_counter() - start, action=action)
+
 
+async def _dispatch_callback(query, context: ContextTypes.DEFAULT_TYPE):
+    """Маршрутизация callback запроса по обработчикам"""
     user_id = query.from_user.id
     topic_id = query.message.message_thread_id
     chat_id = query.message.chat_id
@@ -49,6 +97,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if lock_info:
             if lock_info['user_id'] != user_id:
                 # Другой пользователь пытается начать операцию
+                LOCK_REJECTIONS.inc(operation=lock_info['operation'])
                 await query.answer(
                     f"⚠️ Топик занят: {lock_info['operation']}. Дождитесь завершения.",
                     show_alert=True
@@ -63,15 +112,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
 
     # Собираем пользователя из callback в known_users
-    user = query.from_user
-    queue_manager.add_known_user(
-        chat_id,
-        user.id,
-        user.first_name,
-        user.last_name,
-        user.username,
-        user.is_bot
-    )
+    user_ingestor.observe(chat_id, query.from_user)
 
     try:
         if query.data == "add_to_queue":
@@ -160,7 +201,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def register_callback_handlers(application):
     """Регистрация обработчиков callback запросов"""
+    # Обработчики, изменяющие очередь, выполняются последовательно в пределах топика
+    # (handle_callback сам ставит их в очередь топика после раннего ответа)
     application.add_handler(CallbackQueryHandler(handle_callback))
 
     # Добавляем обработчик текстовых сообщений для ввода @username
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_user_input))
\ No newline at end of file
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, serialize_by_topic(handle_add_user_input)))
\ No newline at end of file
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class HTTPRequest:
+    """Входящий HTTP запрос"""
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.headers = headers  # имена заголовков в нижнем регистре
+        self.body = body
+
+
+class LocalHTTPServer:
+    """
+    Минимальный HTTP/1.1 сервер на asyncio без внешних зависимостей
+    Обработчик маршрута: async handler(request) -> (status, body, headers)
+    """
+    def __init__(self, listen='127.0.0.1', port=8080, max_body_size=1024 * 1024):
+        self.listen = listen
+        self.port = port
+        self.max_body_size = max_body_size
+        self.routes = {}  # (method, path): handler
+        self.fallback = None  # handler для путей без маршрута
+        self._server = None
+
+    def route(self, method, path, handler):
+        """Зарегистрировать обработчик для метода и пути"""
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        # Порт 0 означает "любой свободный" - запоминаем фактический
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP server listening on {self.listen}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info(f"HTTP server on {self.listen}:{self.port} stopped")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            # Поддерживаем keep-alive: Telegram и reverse proxy переиспользуют соединения
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, int):
+                    await self._write_response(writer, request, b'', {}, keep_alive=False)
+                    break
+
+                status, body, headers = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, status, body, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Остановка событийного цикла во время ожидания запроса (keep-alive, long polling)
+            pass
+        except Exception as e:
+            logger.error(f"Error handling HTTP connection: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader):
+        """Прочитать запрос. None - соединение закрыто, int - код ошибки"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            return 400
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return 400
+        if length > self.max_body_size:
+            return 413
+        body = await reader.readexactly(length) if length else b''
+        return HTTPRequest(method.upper(), target, headers, body)
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return 405, b'', {}
+            handler = self.fallback
+        if handler is None:
+            return 404, b'', {}
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Error in HTTP handler for {request.path}: {e}")
+            return 500, b'', {}
+
+    async def _write_response(self, writer, status, body, headers, keep_alive):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Unknown')}"]
+        headers = dict(headers)
+        headers.setdefault('Content-Type', 'text/plain; charset=utf-8')
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
@@ -1,8 +1,20 @@
+import asyncio
+import functools
 import logging
 import time
 
+from metrics import metrics
+from tracing import tracer
+
 logger = logging.getLogger(__name__)
 
+LOCK_REJECTIONS = metrics.counter(
+    'bot_topic_lock_rejections_total', 'Отказы в начале операции из-за занятого топика', ['operation']
+)
+SERIALIZER_WAIT = metrics.histogram(
+    'bot_topic_serializer_wait_seconds', 'Ожидание блокировки топика перед обработкой обновления'
+)
+
 class SimpleLockManager:
     """
     Простой менеджер блокировок для предотвращения спама
@@ -42,6 +54,7 @@ class SimpleLockManager:
     def lock(self, topic_id: int, user_id: int, operation: str) -> bool:
         """Заблокировать топик для операции"""
         if self.is_locked(topic_id):
+            LOCK_REJECTIONS.inc(operation=operation)
             return False
         
         self.locks[topic_id] = {
@@ -67,5 +80,76 @@ class SimpleLockManager:
             return self.unlock(topic_id)
         return False
 
-# Глобальный экземпляр
-lock_manager = SimpleLockManager()
\ No newline at end of file
+
+class TopicSerializer:
+    """
+    Сериализация обработки обновлений внутри одного топика
+    Обновления одного (chat_id, topic_id) выполняются по очереди,
+    разные топики обрабатываются параллельно
+    """
+    def __init__(self):
+        # (chat_id, topic_id): asyncio.Lock
+        self._locks = {}
+        # (chat_id, topic_id): количество обработчиков, ожидающих или держащих блокировку
+        self._holders = {}
+
+    def _acquire_entry(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+            self._holders[key] = 0
+        self._holders[key] += 1
+        return lock
+
+    def _release_entry(self, key):
+        self._holders[key] -= 1
+        # Удаляем блокировку, когда она никому не нужна, чтобы словарь не рос бесконечно
+        if self._holders[key] == 0:
+            del self._holders[key]
+            del self._locks[key]
+
+    async def run(self, chat_id, topic_id, handler, *args):
+        """Выполнить обработчик под блокировкой топика"""
+        key = (chat_id, topic_id)
+        lock = self._acquire_entry(key)
+        start = time.perf_counter()
+        try:
+            with tracer.span('topic_lock_wait'):
+                await lock.acquire()
+            try:
+                SERIALIZER_WAIT.observe(time.perf_counter() - start)
+                with tracer.span(f"handler.{getattr(handler, '__name__', 'unknown')}"):
+                    return await handler(*args)
+            finally:
+                lock.release()
+        finally:
+            self._release_entry(key)
+
+    def active_count(self) -> int:
+        """Количество топиков с активной или ожидаемой блокировкой"""
+        return len(self._locks)
+
+
+def get_update_topic_key(update):
+    """Получить (chat_id, topic_id) из обновления или None"""
+    chat = getattr(update, 'effective_chat', None)
+    message = getattr(update, 'effective_message', None)
+    if not chat or not message:
+        return None
+    return chat.id, message.message_thread_id
+
+
+def serialize_by_topic(handler):
+    """Декоратор: обработчик обновления выполняется под блокировкой своего топика"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        key = get_update_topic_key(update)
+        if key is None:
+            return await handler(update, context)
+        return await topic_serializer.run(key[0], key[1], handler, update, context)
+    return wrapper
+
+
+# Глобальные экземпляры
+lock_manager = SimpleLockManager()
+topic_serializer = TopicSerializer()
\ No newline at end of file
@@ -1,15 +1,33 @@
 import logging
+import asyncio
 import atexit
 import os
+import signal
+import threading
 from dotenv import load_dotenv
+
+# Загрузка переменных окружения. До импорта модулей бота: глобальные экземпляры
+# (queue_manager, backup_manager и др.) читают настройки при импорте
+load_dotenv()
+
 from telegram.ext import Application, MessageHandler, filters
 from queue_manager import queue_manager
 from lock_manager import lock_manager
 from command_handlers import register_command_handlers
 from handlers_processing import register_callback_handlers
-
-# Загрузка переменных окружения
-load_dotenv()
+from webhook import run_webhook
+from update_queue import FairUpdateQueue
+from user_ingest import user_ingestor, callback_flush_known_users
+from bot_request import InstrumentedRequest
+from metrics import metrics, MetricsServer
+from tracing import tracer
+from update_processor import BotUpdateProcessor
+from profiler import profiler
+from stats import job_counter
+from update_recorder import update_recorder, register_update_recorder
+from backup import register_backups
+from utils import callback_expire_entries
+from queue_journal import take_over
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,6 +36,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+QUEUE_LENGTH = metrics.gauge('bot_queue_length', 'Длина очереди в топике', ['topic_id'])
+SCHEDULED_JOBS = metrics.gauge('bot_scheduled_jobs', 'Запланированные задачи JobQueue', ['job'])
+UPDATE_QUEUE_SIZE = metrics.gauge('bot_update_queue_size', 'Обновления, ожидающие обработки')
+UPDATES_IN_FLIGHT = metrics.gauge('bot_updates_in_flight', 'Обновления в обработке')
+UPDATES_SHED = metrics.gauge('bot_updates_shed', 'Отброшено обновлений при перегрузке с момента запуска')
+
 
 async def callback_auto_save(context):
     """Автоматическое сохранение данных"""
@@ -48,26 +72,80 @@ async def collect_users(update, context):
     else:
         return
     
-    # Добавляем пользователя в известные
-    if user and chat_id:
-        queue_manager.add_known_user(
-            chat_id,
-            user.id,
-            user.first_name,
-            user.last_name,
-            user.username,
-            user.is_bot
-        )
+    # Добавляем пользователя в известные (пачкой, по таймеру)
+    user_ingestor.observe(chat_id, user)
 
 
-def main():
-    """Основная функция"""
-    TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not TOKEN:
-        raise ValueError("Токен бота не найден в переменных окружения")
+def register_metrics_collectors(application):
+    """Метрики, вычисляемые в момент чтения /metrics"""
+    def collect_queues():
+        QUEUE_LENGTH.clear()
+        for topic_id, queue in queue_manager.queues.items():
+            QUEUE_LENGTH.set(len(queue), topic_id=topic_id)
 
-    # Создаем Application с JobQueue
-    application = Application.builder().token(TOKEN).build()
+    def collect_jobs():
+        SCHEDULED_JOBS.clear()
+        if not application.job_queue:
+            return
+        counts = {}
+        for job in application.job_queue.jobs():
+            name = getattr(job.callback, '__name__', 'unknown')
+            counts[name] = counts.get(name, 0) + 1
+        for name, count in counts.items():
+            SCHEDULED_JOBS.set(count, job=name)
+
+    def collect_update_queue():
+        update_queue = application.update_queue
+        UPDATE_QUEUE_SIZE.set(update_queue.qsize())
+        UPDATES_IN_FLIGHT.set(getattr(update_queue, 'in_flight', 0))
+        UPDATES_SHED.set(getattr(update_queue, 'shed_count', 0))
+
+    metrics.register_collector(collect_queues)
+    metrics.register_collector(collect_jobs)
+    metrics.register_collector(collect_update_queue)
+
+
+async def post_init(application):
+    """Запуск вспомогательных серверов после инициализации бота"""
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        server = MetricsServer(metrics, os.getenv('METRICS_LISTEN', '127.0.0.1'), int(metrics_port))
+        await server.start()
+        application.bot_data['metrics_server'] = server
+
+
+async def post_shutdown(application):
+    """Остановка вспомогательных серверов"""
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        await server.stop()
+
+
+def build_application(token, concurrent_updates=64, update_queue_size=1000, use_updater=True, base_url=None):
+    """Создание Application с обработчиками и периодическими задачами"""
+    builder = (
+        Application.builder()
+        .token(token)
+        # Каждое обновление обрабатывается внутри своей трассы (tracing.py)
+        .concurrent_updates(BotUpdateProcessor(concurrent_updates))
+        # Запросы к Bot API с замером длительности и ошибок по методам
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest(connection_pool_size=1))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Ограниченная очередь входящих обновлений с приоритетом кнопок и круговым
+        # обходом чатов. При переполнении сначала отбрасываются пассивные сообщения,
+        # затем polling ждёт, а webhook отвечает Telegram 503
+        .update_queue(FairUpdateQueue(maxsize=update_queue_size, max_in_flight=concurrent_updates))
+    )
+    if base_url:
+        # Другой адрес Bot API: локальный Bot API сервер или fake_bot_api.py для нагрузочных тестов
+        builder = builder.base_url(base_url)
+    if not use_updater:
+        # В режиме webhook обновления приходят через собственный HTTP сервер
+        builder = builder.updater(None)
+    application = builder.build()
+    register_metrics_collectors(application)
 
     # Регистрация обработчиков из модулей
     register_command_handlers(application)
@@ -80,24 +158,126 @@ def main():
     job_queue = application.job_queue
 
     if job_queue:
+        # Счётчик запланированных задач для /stats
+        job_counter.attach(job_queue)
+
         # Автосохранение каждые 5 минут
         job_queue.run_repeating(
             callback_auto_save,
             interval=300,
             first=10
         )
+        # Запись новых и переименованных известных пользователей каждые 5 секунд
+        job_queue.run_repeating(
+            callback_flush_known_users,
+            interval=5,
+            first=5
+        )
+        # Проверка сроков автоистечения записей (одна задача на все топики)
+        job_queue.run_repeating(
+            callback_expire_entries,
+            interval=30,
+            first=30
+        )
+        # Резервные копии каждые BACKUP_INTERVAL секунд
+        register_backups(application)
         logger.info("JobQueue initialized successfully")
     else:
         logger.error("JobQueue is not available!")
 
+    return application
+
+
+def install_profile_signal(duration):
+    """SIGUSR1 запускает профилирование основного потока (событийного цикла)"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    main_thread_id = threading.main_thread().ident
+
+    def handle_signal(signum, frame):
+        path = profiler.start(duration, thread_id=main_thread_id)
+        if path is None:
+            logger.warning("Profiling is already running")
+
+    signal.signal(signal.SIGUSR1, handle_signal)
+
+
+def main():
+    """Основная функция"""
+    TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not TOKEN:
+        raise ValueError("Токен бота не найден в переменных окружения")
+
+    # polling (по умолчанию) или webhook
+    mode = os.getenv('BOT_MODE', 'polling').lower()
+    if mode not in ('polling', 'webhook'):
+        raise ValueError(f"Неизвестный режим BOT_MODE: {mode}")
+
+    # Метрики собираются только если задан порт /metrics
+    metrics.enabled = bool(os.getenv('METRICS_PORT'))
+
+    # Трассировка: доля трассируемых обновлений и порог записи медленных трасс
+    tracer.configure(
+        sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', '0')),
+        slow_threshold=float(os.getenv('TRACE_SLOW_MS', '500')) / 1000,
+        path=os.getenv('TRACE_FILE', 'traces.jsonl')
+    )
+
+    # Количество одновременно обрабатываемых обновлений.
+    # Изменения одной очереди сериализуются блокировкой топика (lock_manager.topic_serializer)
+    concurrent_updates = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+    application = build_application(
+        TOKEN,
+        concurrent_updates=concurrent_updates,
+        update_queue_size=int(os.getenv('UPDATE_QUEUE_SIZE', '1000')),
+        use_updater=(mode == 'polling'),
+        base_url=os.getenv('TELEGRAM_BASE_URL') or None
+    )
+
+    # Запись входящих обновлений для воспроизведения (benchmarks/replay_updates.py)
+    record_path = os.getenv('RECORD_UPDATES')
+    if record_path:
+        update_recorder.configure(record_path, os.getenv('RECORD_SALT') or None)
+        register_update_recorder(application)
+        atexit.register(update_recorder.close)
+
+    # Профилирование по сигналу: kill -USR1 <pid>
+    profiler.output_dir = os.getenv('PROFILE_DIR', 'profiles')
+    install_profile_signal(int(os.getenv('PROFILE_SIGNAL_SECONDS', '30')))
+
+    # Горячий резерв: пока другой процесс держит блокировку в QUEUE_JOURNAL_DIR, применяем его
+    # журнал и ждём. Сохранение при завершении регистрируется только у основного процесса
+    journal_dir = os.getenv('QUEUE_JOURNAL_DIR')
+    primary_lock = None
+    if journal_dir:
+        primary_lock = take_over(queue_manager, journal_dir, float(os.getenv('QUEUE_JOURNAL_POLL', '0.2')))
+
     # Автоматическое сохранение при завершении
     atexit.register(queue_manager.save_data)
+    # atexit вызывает функции в обратном порядке: буфер пользователей записывается первым
+    atexit.register(user_ingestor.flush)
 
     # Запуск бота
     logger.info("Бот запущен...")
     logger.info(f"Система блокировок активна. Таймаут: {lock_manager.timeout} секунд")
-    application.run_polling()
+    logger.info(f"Параллельная обработка обновлений: до {concurrent_updates} одновременно")
+
+    if mode == 'webhook':
+        secret_token = os.getenv('WEBHOOK_SECRET') or None
+        if not secret_token:
+            logger.warning("WEBHOOK_SECRET не задан: запросы к webhook не проверяются")
+        asyncio.run(run_webhook(
+            application,
+            listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+            port=int(os.getenv('WEBHOOK_PORT', '8443')),
+            url_path=os.getenv('WEBHOOK_PATH', '/telegram'),
+            secret_token=secret_token,
+            webhook_url=os.getenv('WEBHOOK_URL') or None
+        ))
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
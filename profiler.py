@@ -0,0 +1,98 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse_stack(frame):
+    """Стек в формате collapsed: от корня к листу через ';'"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер потока событийного цикла
+    Пока профилирование не запущено, никаких накладных расходов нет: поток-семплер
+    создаётся только на время профилирования и сам завершается по истечении времени.
+    Результат - файл collapsed stacks (совместим с flamegraph.pl и speedscope)
+    """
+    def __init__(self, interval=0.005, output_dir='profiles'):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.last_result = None  # {'path': str, 'samples': int, 'top': [(label, count)]}
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration, thread_id=None):
+        """Запустить профилирование потока thread_id (по умолчанию - текущего).
+        Возвращает путь будущего файла или None, если профилирование уже идёт"""
+        if self.running:
+            return None
+        if thread_id is None:
+            thread_id = threading.get_ident()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed")
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(thread_id, duration, path), name='sampling-profiler', daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Profiling started for {duration}s, output: {path}")
+        return path
+
+    def stop(self):
+        """Досрочно завершить профилирование (результат будет записан)"""
+        self._stop.set()
+
+    def _run(self, thread_id, duration, path):
+        stacks = Counter()
+        deadline = time.monotonic() + duration
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[_collapse_stack(frame)] += 1
+            del frame
+            self._stop.wait(self.interval)
+
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except Exception as e:
+            logger.error(f"Error writing profile {path}: {e}")
+            return
+
+        # Самые частые листовые функции - для краткого отчёта
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        self.last_result = {
+            'path': path,
+            'samples': sum(stacks.values()),
+            'top': leaves.most_common(5),
+        }
+        logger.info(f"Profiling finished: {self.last_result['samples']} samples written to {path}")
+
+
+# Глобальный экземпляр
+profiler = SamplingProfiler()
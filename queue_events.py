@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Вес нового наблюдения в экспоненциальном среднем времени обслуживания
+EWMA_ALPHA = 0.2
+# Окно для пропускной способности, секунды
+THROUGHPUT_WINDOW = 3600
+# Размер журнала топика, после которого он переименовывается в <topic_id>.jsonl.1 (предыдущий
+# архив удаляется): на диске не больше двух таких размеров на топик
+EVENTS_MAX_BYTES = 1024 * 1024
+# Сколько файлов журнала держать открытыми (давно не писавшиеся закрываются)
+MAX_OPEN_FILES = 64
+
+
+class TopicStats:
+    """
+    Агрегаты очереди топика, обновляемые при каждом /next без пересчёта истории:
+    EWMA времени обслуживания одного человека, среднее ожидание (сумма и количество)
+    и отметки обслуживания за последний час
+    """
+    def __init__(self):
+        self.ewma_service = None
+        self.last_served_at = None
+        self.served = 0
+        self.wait_total = 0.0
+        self.served_times = deque()
+
+    def observe_served(self, now, entries):
+        """Учесть снятие entries с начала очереди в момент now"""
+        if not entries:
+            return
+        joined = [joined_timestamp(entry, now) for entry in entries]
+        # Обслуживание первого началось не раньше, чем он встал в очередь:
+        # простой пустой очереди не попадает в среднее
+        start = joined[0] if self.last_served_at is None else max(self.last_served_at, joined[0])
+        sample = max(now - start, 0.0) / len(entries)
+        if self.ewma_service is None:
+            self.ewma_service = sample
+        else:
+            self.ewma_service += EWMA_ALPHA * (sample - self.ewma_service)
+        self.last_served_at = now
+
+        self.served += len(entries)
+        self.wait_total += sum(max(now - joined_at, 0.0) for joined_at in joined)
+        self.served_times.extend([now] * len(entries))
+        self._trim(now)
+
+    def _trim(self, now):
+        while self.served_times and self.served_times[0] < now - THROUGHPUT_WINDOW:
+            self.served_times.popleft()
+
+    def average_wait(self):
+        return self.wait_total / self.served if self.served else None
+
+    def throughput(self, now=None):
+        """Обслужено за последний час"""
+        self._trim(time.time() if now is None else now)
+        return len(self.served_times)
+
+    def estimated_wait(self, position):
+        """Оценка ожидания для позиции (с 1) в секундах; первый уже на обслуживании"""
+        if self.ewma_service is None:
+            return None
+        return (position - 1) * self.ewma_service
+
+    def to_dict(self):
+        return {
+            'ewma_service': self.ewma_service,
+            'last_served_at': self.last_served_at,
+            'served': self.served,
+            'wait_total': self.wait_total,
+            'served_times': list(self.served_times),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.ewma_service = data.get('ewma_service')
+        stats.last_served_at = data.get('last_served_at')
+        stats.served = data.get('served', 0)
+        stats.wait_total = data.get('wait_total', 0.0)
+        stats.served_times = deque(data.get('served_times', []))
+        return stats
+
+
+def joined_timestamp(entry, default):
+    """joined_at записи в секундах от эпохи или default, если время не разобрать"""
+    try:
+        return datetime.fromisoformat(entry['joined_at']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+class QueueEventLog:
+    """
+    Журнал операций с очередями: файл <topic_id>.jsonl на топик, строки только дописываются
+    Каждая строка - {"t": время, "op": операция, ...поля операции}. Файлы остаются открытыми
+    между событиями; при превышении max_bytes журнал топика уходит в архив <topic_id>.jsonl.1.
+    directory=None - журнал не пишется, агрегаты всё равно считаются
+    """
+    def __init__(self, directory, max_bytes=EVENTS_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = defaultdict(TopicStats)
+        # topic_id -> открытый файл журнала, в порядке последней записи
+        self._files = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _file(self, topic_id):
+        f = self._files.get(topic_id)
+        if f is not None:
+            self._files.move_to_end(topic_id)
+            return f
+        if len(self._files) >= MAX_OPEN_FILES:
+            self._files.popitem(last=False)[1].close()
+        f = self._files[topic_id] = open(os.path.join(self.directory, f"{topic_id}.jsonl"), 'a', encoding='utf-8')
+        return f
+
+    def _rotate(self, topic_id):
+        """Журнал топика - в архив <topic_id>.jsonl.1, следующее событие начнёт новый файл"""
+        self._files.pop(topic_id).close()
+        path = os.path.join(self.directory, f"{topic_id}.jsonl")
+        os.replace(path, path + '.1')
+
+    def record(self, topic_id, op, **fields):
+        """Дописать событие в журнал топика. Возвращает время события"""
+        now = time.time()
+        if self.directory:
+            line = json.dumps({'t': round(now, 3), 'op': op, **fields}, ensure_ascii=False)
+            try:
+                f = self._file(topic_id)
+                f.write(line + '\n')
+                # Строка видна читателям журнала сразу, как и при открытии файла на каждое событие
+                f.flush()
+                if self.max_bytes and f.tell() >= self.max_bytes:
+                    self._rotate(topic_id)
+            except OSError as e:
+                # Журнал вспомогательный: ошибка записи не должна ломать операцию с очередью
+                logger.error(f"Failed to append queue event for topic {topic_id}: {e}")
+                f = self._files.pop(topic_id, None)
+                if f is not None:
+                    f.close()
+        return now
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def record_next(self, topic_id, entries):
+        """Снятие записей с начала очереди: событие и обновление агрегатов"""
+        now = self.record(topic_id, 'next', user_ids=[entry['user_id'] for entry in entries])
+        self.stats[topic_id].observe_served(now, entries)
+
+    def snapshot(self):
+        return {str(topic_id): stats.to_dict() for topic_id, stats in self.stats.items() if stats.served}
+
+    def load(self, data):
+        self.stats = defaultdict(TopicStats)
+        for topic_id_str, stats in data.items():
+            self.stats[int(topic_id_str)] = TopicStats.from_dict(stats)
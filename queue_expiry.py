@@ -0,0 +1,75 @@
+import heapq
+import re
+from datetime import datetime, timedelta
+
+# /ttl 6h, /ttl 90m, /ttl 1d: время жизни записи от joined_at
+TTL_PATTERN = re.compile(r'^(\d+)\s*([mhd])$')
+TTL_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+# /ttl 23:00: ежедневная очистка очереди (местное время)
+CLEAR_AT_PATTERN = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+
+def parse_expiry(text):
+    """
+    Разбор аргумента /ttl: ('ttl', секунды), ('clear_at', 'ЧЧ:ММ') или ('off', None)
+    ValueError, если формат не распознан
+    """
+    text = text.strip().lower()
+    if text in ('off', 'нет', '0'):
+        return 'off', None
+    match = TTL_PATTERN.match(text)
+    if match and int(match.group(1)) > 0:
+        return 'ttl', int(match.group(1)) * TTL_UNITS[match.group(2)]
+    match = CLEAR_AT_PATTERN.match(text)
+    if match:
+        return 'clear_at', f"{int(match.group(1)):02d}:{match.group(2)}"
+    raise ValueError(f"Unknown expiry format {text!r}")
+
+
+def format_ttl(seconds):
+    """Время жизни в виде 6h / 90m / 1d"""
+    for unit in ('d', 'h'):
+        if seconds % TTL_UNITS[unit] == 0:
+            return f"{seconds // TTL_UNITS[unit]}{unit}"
+    return f"{seconds // 60}m"
+
+
+def next_clear_time(clear_at, now):
+    """Ближайший после now момент ЧЧ:ММ (местное время) в секундах от эпохи"""
+    hour, minute = map(int, clear_at.split(':'))
+    current = datetime.fromtimestamp(now)
+    moment = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if moment.timestamp() <= now:
+        moment += timedelta(days=1)
+    return moment.timestamp()
+
+
+class ExpiryHeap:
+    """
+    Общая для всех топиков куча сроков истечения: (срок, topic_id, вид, метка)
+    Вид 'ttl' - срок записи (joined_at + TTL топика), 'clear' - ежедневная очистка
+    (метка - время ЧЧ:ММ, для которого срок посчитан). Записи не удаляются из кучи при выходе
+    из очереди или смене настроек: устаревшие отбрасываются при проверке, поэтому отдельная
+    задача на каждую запись не нужна
+    """
+    def __init__(self):
+        self._heap = []
+
+    def push(self, deadline, topic_id, kind, tag=''):
+        heapq.heappush(self._heap, (deadline, topic_id, kind, tag))
+
+    def pop_due(self, now):
+        """Извлечь все сроки не позже now: [(срок, topic_id, вид, метка)]"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def clear(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
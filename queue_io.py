@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Столбцы выгрузки; при загрузке обязателен username или user_id, position - по желанию
+EXPORT_FIELDS = ('position', 'user_id', 'username', 'first_name', 'last_name', 'display_name', 'joined_at')
+EXPORT_FORMATS = ('csv', 'json')
+# Ограничение размера загружаемого файла
+MAX_IMPORT_BYTES = 1 << 20
+
+
+class RosterError(ValueError):
+    """Файл со списком не удалось разобрать"""
+
+
+def export_queue(queue, fmt='csv'):
+    """
+    Выгрузка очереди в буфер в памяти для send_document
+    Записи пишутся по одной: CSV построчно, JSON - массив с записью на строке
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise RosterError(f"Unknown export format {fmt!r}")
+    buffer = io.BytesIO()
+    # utf-8-sig: Excel открывает CSV с кириллицей без ручного выбора кодировки
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='')
+    rows = (
+        {'position': position, **{field: user.get(field) for field in EXPORT_FIELDS[1:]}}
+        for position, user in enumerate(queue, 1)
+    )
+    if fmt == 'csv':
+        writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    else:
+        text.write('[')
+        for i, row in enumerate(rows):
+            text.write((',\n' if i else '\n') + json.dumps(row, ensure_ascii=False))
+        text.write('\n]\n')
+    text.flush()
+    # Буфер остаётся открытым после отсоединения обёртки
+    text.detach()
+    buffer.seek(0)
+    return buffer
+
+
+def _json_rows(text):
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        rows = json.loads(stripped)
+        if not isinstance(rows, list):
+            raise RosterError("JSON roster must be an array")
+        yield from rows
+        return
+    # JSON Lines: объект на строке
+    for line in text.splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+
+def _csv_rows(text):
+    lines = text.splitlines()
+    header = next(csv.reader(lines[:1]), [])
+    if any(field.strip().lower() in ('username', 'user_id') for field in header):
+        for row in csv.DictReader(lines):
+            yield {key.strip().lower(): value for key, value in row.items() if key}
+    else:
+        # Список без заголовка: первый столбец - username
+        for row in csv.reader(lines):
+            if row and row[0].strip():
+                yield {'username': row[0]}
+
+
+def parse_roster(data, filename=''):
+    """
+    Разбор списка: CSV (с заголовком из EXPORT_FIELDS или столбец username без заголовка),
+    JSON-массив или JSON Lines. Возвращает [{'username', 'user_id', 'position'}] в порядке файла
+    """
+    if len(data) > MAX_IMPORT_BYTES:
+        raise RosterError(f"File is larger than {MAX_IMPORT_BYTES} bytes")
+    try:
+        text = bytes(data).decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        raise RosterError(f"File is not UTF-8: {e}") from e
+
+    is_json = filename.lower().endswith(('.json', '.jsonl')) or text.lstrip()[:1] in ('[', '{')
+    entries = []
+    try:
+        for row in (_json_rows(text) if is_json else _csv_rows(text)):
+            if not isinstance(row, dict):
+                raise RosterError(f"Row {len(entries) + 1} is not an object")
+            username = str(row.get('username') or '').strip().lstrip('@')
+            user_id = str(row.get('user_id') or '').strip()
+            position = str(row.get('position') or '').strip()
+            if not username and not user_id:
+                continue
+            entries.append({
+                'username': username or None,
+                'user_id': int(user_id) if user_id else None,
+                'position': int(position) if position else None,
+            })
+    except RosterError:
+        raise
+    except (ValueError, csv.Error) as e:
+        raise RosterError(f"Invalid roster row {len(entries) + 1}: {e}") from e
+    return entries
+
+
+def resolve_roster(manager, chat_id, entries):
+    """
+    Сопоставление строк списка с известными пользователями чата за один проход
+    (по user_id, затем по username через индексы). Возвращает (найденные [(known_user, position)],
+    ненайденные подписи)
+    """
+    resolved = []
+    unresolved = []
+    for entry in entries:
+        known_user = None
+        if entry['user_id'] is not None:
+            known_user = manager.get_known_user(chat_id, entry['user_id'])
+        if known_user is None and entry['username']:
+            known_user = manager.find_known_user(chat_id, entry['username'])
+        if known_user is None:
+            unresolved.append(f"@{entry['username']}" if entry['username'] else str(entry['user_id']))
+        else:
+            resolved.append((known_user, entry['position']))
+    return resolved, unresolved
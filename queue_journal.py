@@ -0,0 +1,284 @@
+"""
+Журнал изменений состояния для горячего резерва (QUEUE_JOURNAL_DIR)
+
+Основной процесс при каждом save_data дописывает в журнал изменившиеся ключи снимка
+(очереди, известные пользователи чатов, обмены и т.д.) и удалённые ключи. Журнал разбит на
+сегменты journal-<номер>.jsonl, каждый сегмент начинается с полной записи состояния,
+поэтому читатель, отставший на удалённый сегмент, продолжает с начала последнего.
+
+Основной процесс держит блокировку primary.lock. Резервный процесс ждёт её, применяя журнал
+к своему PersistentQueueManager, и после падения основного получает блокировку и продолжает
+работу с уже загруженным состоянием, не разбирая снимок заново.
+"""
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Разделы снимка, которые передаются через журнал
+JOURNAL_SECTIONS = ('queues', 'pending_swaps', 'queue_message_ids', 'known_users', 'topic_to_chat',
+                    'queue_stats', 'topic_expiry', 'topic_policies')
+# Размер сегмента, после которого начинается новый (не меньше нескольких полных записей)
+SEGMENT_BYTES = 4 * 1024 * 1024
+# Сколько предыдущих сегментов хранить для отстающих читателей
+KEEP_SEGMENTS = 2
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.jsonl'
+
+
+def list_segments(directory):
+    """Сегменты журнала по возрастанию номера"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+
+def segment_name(number):
+    return f"{SEGMENT_PREFIX}{number:08d}{SEGMENT_SUFFIX}"
+
+
+def segment_number(name):
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def _encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class JournalWriter:
+    """
+    Запись журнала основным процессом. ship(data) сравнивает разделы снимка с переданными
+    ранее (по JSON каждого ключа) и дописывает только разницу
+    """
+    def __init__(self, directory, next_seq=1, durability='none', segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.seq = next_seq - 1
+        self.durability = durability
+        self.segment_bytes = segment_bytes
+        # Переданное состояние: раздел -> {ключ: JSON значения}
+        self._shipped = {}
+        self._file = None
+        self._size = 0
+        self._full_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        """Новый сегмент после последнего существующего; старые сверх KEEP_SEGMENTS удаляются"""
+        if self._file:
+            self._file.close()
+        segments = list_segments(self.directory)
+        number = segment_number(segments[-1]) + 1 if segments else 1
+        self._file = open(os.path.join(self.directory, segment_name(number)), 'ab')
+        self._size = 0
+        self._shipped = {}
+        for name in segments[:max(len(segments) - KEEP_SEGMENTS, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                logger.warning(f"Failed to remove journal segment {name}: {e}")
+
+    def ship(self, data):
+        """Дописать изменения снимка data (snapshot_data). Возвращает номер последней записи"""
+        full = self._file is None or self._size > max(self.segment_bytes, 4 * self._full_bytes)
+        try:
+            if full:
+                self._open_segment()
+            changed, removed, shipped = {}, {}, {}
+            for section in JOURNAL_SECTIONS:
+                previous = self._shipped.get(section, {})
+                current = {}
+                for key, value in data.get(section, {}).items():
+                    encoded = _encode(value)
+                    current[key] = encoded
+                    if previous.get(key) != encoded:
+                        changed.setdefault(section, {})[key] = value
+                gone = [key for key in previous if key not in current]
+                if gone:
+                    removed[section] = gone
+                shipped[section] = current
+            if not full and not changed and not removed:
+                return self.seq
+
+            record = {'seq': self.seq + 1, 't': round(time.time(), 3), 'full': full, 'set': changed}
+            if removed:
+                record['del'] = removed
+            line = (_encode(record) + '\n').encode('utf-8')
+            self._file.write(line)
+            self._file.flush()
+            if self.durability != 'none':
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            # Снимок важнее журнала: ошибка записи не мешает сохранению, а следующая запись
+            # начнёт новый сегмент с полного состояния
+            logger.error(f"Failed to append state journal: {e}")
+            if self._file:
+                self._file.close()
+            self._file = None
+            return self.seq
+
+        self.seq += 1
+        self._size += len(line)
+        if full:
+            self._full_bytes = len(line)
+        self._shipped = shipped
+        return self.seq
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class JournalReader:
+    """
+    Чтение журнала резервным процессом. poll() возвращает новые записи, которые можно применить
+    по порядку: записи не новее applied_seq пропускаются, при пропуске номеров чтение
+    продолжается с полной записи в начале последнего сегмента.
+    applied_seq=None - состояние не связано с журналом, уже записанное пропускается
+    """
+    def __init__(self, directory, applied_seq=None):
+        self.directory = directory
+        self.segment = None
+        self._file = None
+        self._buffer = b''
+        # Последний номер, встреченный в журнале, и последний применённый
+        self.last_seq = 0
+        self.applied_seq = applied_seq or 0
+        segments = list_segments(directory)
+        if segments:
+            self._open(segments[-1])
+            if applied_seq is None:
+                self._read_records()
+                self.applied_seq = self.last_seq
+
+    def _open(self, name):
+        if self._file:
+            self._file.close()
+        self.segment = name
+        self._buffer = b''
+        try:
+            self._file = open(os.path.join(self.directory, name), 'rb')
+        except FileNotFoundError:
+            self._file = None
+
+    def _read_records(self):
+        """Полные строки, дописанные в текущий сегмент с прошлого чтения"""
+        if self._file is None:
+            return []
+        self._buffer += self._file.read()
+        *lines, self._buffer = self._buffer.split(b'\n')
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.error(f"Corrupt record in journal segment {self.segment}, skipped")
+                continue
+            self.last_seq = max(self.last_seq, record['seq'])
+            records.append(record)
+        return records
+
+    def poll(self):
+        records = []
+        while True:
+            segments = list_segments(self.directory)
+            if self.segment is None:
+                if not segments:
+                    return records
+                self._open(segments[0])
+            # Следующий сегмент проверяется до чтения: если он уже есть, текущий дописан целиком
+            later = [name for name in segments if name > self.segment]
+            batch = self._read_records()
+            for record in batch:
+                if record['seq'] <= self.applied_seq:
+                    continue
+                if record['full'] or record['seq'] == self.applied_seq + 1:
+                    records.append(record)
+                    self.applied_seq = record['seq']
+                elif later:
+                    logger.warning(f"Journal gap after record {self.applied_seq}, resyncing from {segments[-1]}")
+                    self._open(segments[-1])
+                    break
+                else:
+                    logger.error(f"Journal gap after record {self.applied_seq} in the last segment, record {record['seq']} applied")
+                    records.append(record)
+                    self.applied_seq = record['seq']
+            if batch:
+                continue
+            if not later:
+                return records
+            self._open(later[0])
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class PrimaryLock:
+    """
+    Эксклюзивная блокировка файла, которую держит основной процесс. Снимается ОС при завершении
+    процесса, в том числе аварийном, поэтому резервный получает её сразу после падения основного.
+    Каталог должен поддерживать блокировки POSIX (локальный диск или NFSv4)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self):
+        f = open(self.path, 'a+')
+        try:
+            if fcntl:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        f.truncate(0)
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file = f
+        return True
+
+
+def take_over(manager, directory, poll_interval=0.2):
+    """
+    Стать основным процессом: пока блокировку держит другой процесс, применять его журнал
+    к manager (горячий резерв), затем применить остаток журнала и начать писать свой.
+    Возвращает блокировку - её нужно держать до завершения процесса
+    """
+    os.makedirs(directory, exist_ok=True)
+    lock = PrimaryLock(os.path.join(directory, 'primary.lock'))
+    reader = JournalReader(directory, manager.journal_seq)
+    standby_since = None
+    while not lock.try_acquire():
+        if standby_since is None:
+            standby_since = time.monotonic()
+            logger.info(f"Primary lock in {directory} is held, running as hot standby")
+        manager.replay_journal(reader.poll())
+        time.sleep(poll_interval)
+
+    start = time.monotonic()
+    manager.replay_journal(reader.poll())
+    reader.close()
+    writer = JournalWriter(directory, max(reader.last_seq, manager.journal_seq or 0) + 1, manager.durability)
+    manager.attach_journal(writer)
+    if standby_since is not None:
+        logger.info(f"Took over as primary after {time.monotonic() - standby_since:.1f}s in standby, "
+                    f"catch-up {time.monotonic() - start:.3f}s, journal record {manager.journal_seq}")
+    else:
+        logger.info(f"Running as primary, journal record {manager.journal_seq}")
+    return lock
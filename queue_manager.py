@@ -1,50 +1,185 @@
-import json
 import os
+import time
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
 
+from metrics import metrics
+from tracing import traced
+from snapshot import COMPRESSIONS, encode_snapshot, read_snapshot
+from queue_events import EVENTS_MAX_BYTES, QueueEventLog, TopicStats, joined_timestamp
+from queue_expiry import ExpiryHeap, next_clear_time
+from queue_policy import TopicPolicy, ordered_index, rank_between
+
 logger = logging.getLogger(__name__)
 
+SAVE_DURATION = metrics.histogram('bot_save_duration_seconds', 'Длительность save_data')
+SAVE_BYTES = metrics.counter('bot_save_bytes_total', 'Байт записано save_data')
+SNAPSHOT_FALLBACKS = metrics.counter(
+    'bot_snapshot_fallbacks_total', 'Загрузки предыдущего снимка из-за повреждённого основного'
+)
+
+# Надёжность сохранения (QUEUE_DURABILITY):
+#   none - без fsync: переживает падение процесса, но не отключение питания
+#   file - fsync файла перед заменой: содержимое нового снимка на диске
+#   dir  - fsync файла и каталога: на диске и содержимое, и сама замена файла
+DURABILITY_LEVELS = ('none', 'file', 'dir')
+
+
+def fsync_directory(path):
+    """fsync каталога, чтобы переименование файла в нём пережило отключение питания"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Windows не позволяет открыть каталог
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def format_wait(seconds):
+    """Ожидание в минутах или часах для сообщения с очередью"""
+    minutes = max(round(seconds / 60), 1)
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60} мин"
+
+
+def ttl_start(entry, default):
+    """Начало отсчёта TTL записи: время записи или, после отмены истечения (/undo), время возврата"""
+    try:
+        return datetime.fromisoformat(entry['ttl_from']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return joined_timestamp(entry, default)
+
 
 class PersistentQueueManager:
-    def __init__(self, filename='queues_data.json'):
+    def __init__(self, filename='queues_data.json', durability=None, compression=None):
         # Получаем абсолютный путь к папке проекта
         self.project_dir = os.path.dirname(os.path.abspath(__file__))
         self.filename = os.path.join(self.project_dir, filename)
-
-        self.queues = defaultdict(list)
+        # Предыдущий снимок: на него загрузка переключается, если основной повреждён
+        self.previous_filename = self.filename + '.prev'
+        # Повреждённый основной снимок не должен заменить собой целый предыдущий
+        self._main_snapshot_valid = True
+        self.durability = durability or os.getenv('QUEUE_DURABILITY', 'none')
+        if self.durability not in DURABILITY_LEVELS:
+            logger.error(f"Unknown durability level {self.durability!r}, using 'none'")
+            self.durability = 'none'
+        self.compression = compression or os.getenv('QUEUE_SNAPSHOT_COMPRESSION', 'none')
+        if self.compression not in COMPRESSIONS:
+            logger.error(f"Unknown snapshot compression {self.compression!r}, using 'none'")
+            self.compression = 'none'
+
+        # Очереди - deque: снятие первого (/next) за O(1)
+        self.queues = defaultdict(deque)
         self.pending_swaps = {}
         self.queue_message_ids = defaultdict(lambda: None)
         self.known_users = defaultdict(list)
+        # Индекс известных пользователей: chat_id -> {user_id: запись из known_users}
+        self._known_index = defaultdict(dict)
+        # Индекс по username (без учёта регистра): chat_id -> {username: запись из known_users}
+        self._username_index = defaultdict(dict)
         self.topic_to_chat = {}  # Новое: маппинг topic_id -> chat_id
+        # Первый в очереди, которому уже отправлено упоминание: topic_id -> user_id (не сохраняется)
+        self.notified_heads = {}
+        # Журнал операций и агрегаты времени ожидания; QUEUE_EVENTS_DIR="" - без журнала
+        events_dir = os.getenv('QUEUE_EVENTS_DIR')
+        if events_dir is None:
+            events_dir = os.path.join(os.path.dirname(self.filename), 'queue_events')
+        self.events = QueueEventLog(events_dir or None, int(os.getenv('QUEUE_EVENTS_MAX_BYTES', str(EVENTS_MAX_BYTES))))
+        # Автоистечение записей: topic_id -> {'ttl': секунды или None, 'clear_at': 'ЧЧ:ММ' или None}
+        self.topic_expiry = {}
+        self.expiry = ExpiryHeap()
+        # Политики порядка очередей: topic_id -> TopicPolicy (нет записи - fifo)
+        self.topic_policies = {}
+        # История для /undo: topic_id -> deque обратных операций (в памяти, не сохраняется)
+        self.undo_depth = int(os.getenv('QUEUE_UNDO_DEPTH', '20'))
+        self.undo_history = defaultdict(lambda: deque(maxlen=self.undo_depth))
+        # Журнал изменений для горячего резерва (queue_journal.py): подключается, когда процесс
+        # становится основным; journal_seq - последняя запись журнала, отражённая в состоянии
+        self.journal = None
+        self.journal_seq = None
+        # Статистика последнего сохранения
+        self.last_save_duration = None
+        self.last_save_bytes = None
+        # Счётчики, поддерживаемые при каждом изменении (для /stats без полного обхода)
+        self.total_entries = 0
+        self.known_users_total = 0
         self.load_data()
 
     def load_data(self):
-        """Загрузка данных из файла"""
-        try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Восстанавливаем queues
-                    for topic_id_str, queue in data.get('queues', {}).items():
-                        self.queues[int(topic_id_str)] = queue
-                    self.pending_swaps = data.get('pending_swaps', {})
-                    # Восстанавливаем queue_message_ids
-                    self.queue_message_ids = {int(k): v for k, v in data.get('queue_message_ids', {}).items()}
-                    # Восстанавливаем known_users
-                    self.known_users = defaultdict(list)
-                    for chat_id_str, users in data.get('known_users', {}).items():
-                        self.known_users[int(chat_id_str)] = [dict(u, is_bot=u.get('is_bot', False)) for u in users]
-                    # Восстанавливаем topic_to_chat
-                    self.topic_to_chat = {int(k): v for k, v in data.get('topic_to_chat', {}).items()}
-                    
-                    # Автоматически добавляем пользователей из очередей в known_users
-                    self._sync_queue_users_to_known_users()
-                    
-                logger.info(f"Данные загружены из {self.filename}")
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке данных: {e}")
+        """Загрузка данных из файла, при повреждении - из предыдущего снимка"""
+        for path in (self.filename, self.previous_filename):
+            if not os.path.exists(path):
+                continue
+            try:
+                self._apply_snapshot(read_snapshot(path))
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке данных из {path}: {e}")
+                continue
+            if path == self.previous_filename:
+                self._main_snapshot_valid = False
+                SNAPSHOT_FALLBACKS.inc()
+                logger.warning(f"Основной снимок недоступен, загружен предыдущий: {path}")
+            logger.info(f"Данные загружены из {path}")
+            return
+
+    def _apply_snapshot(self, data):
+        """Подмена состояния разобранным снимком"""
+        # Сначала разбираем снимок целиком, затем подменяем состояние:
+        # при ошибке разбора менеджер не остаётся загруженным наполовину
+        queues = defaultdict(deque)
+        for topic_id_str, queue in data.get('queues', {}).items():
+            queues[int(topic_id_str)] = deque(queue)
+        pending_swaps = data.get('pending_swaps', {})
+        queue_message_ids = {int(k): v for k, v in data.get('queue_message_ids', {}).items()}
+        known_users = defaultdict(list)
+        for chat_id_str, users in data.get('known_users', {}).items():
+            known_users[int(chat_id_str)] = [dict(u, is_bot=u.get('is_bot', False)) for u in users]
+        topic_to_chat = {int(k): v for k, v in data.get('topic_to_chat', {}).items()}
+        queue_stats = data.get('queue_stats', {})
+        topic_expiry = {int(k): v for k, v in data.get('topic_expiry', {}).items()}
+        topic_policies = {int(k): TopicPolicy.from_dict(v) for k, v in data.get('topic_policies', {}).items()}
+
+        self.queues = queues
+        self.pending_swaps = pending_swaps
+        self.queue_message_ids = queue_message_ids
+        self.known_users = known_users
+        self._rebuild_known_index()
+        self.topic_to_chat = topic_to_chat
+        self.events.load(queue_stats)
+        self.topic_expiry = topic_expiry
+        self._rebuild_expiry()
+        self.topic_policies = topic_policies
+        self.journal_seq = data.get('journal_seq')
+
+        # Автоматически добавляем пользователей из очередей в known_users
+        self._sync_queue_users_to_known_users()
+        self._recount()
+
+    def _recount(self):
+        """Пересчёт счётчиков после загрузки данных"""
+        self.total_entries = sum(len(queue) for queue in self.queues.values())
+        self.known_users_total = sum(len(users) for users in self.known_users.values())
+
+    def _rebuild_known_index(self):
+        """Построение индекса известных пользователей по user_id"""
+        self._known_index = defaultdict(dict)
+        self._username_index = defaultdict(dict)
+        for chat_id in self.known_users:
+            self._index_known_chat(chat_id)
+
+    def _index_known_chat(self, chat_id):
+        """Построение индексов известных пользователей одного чата"""
+        index = self._known_index[chat_id] = {}
+        usernames = self._username_index[chat_id] = {}
+        for user in self.known_users.get(chat_id, ()):
+            index[user['user_id']] = user
+            if user['username']:
+                usernames[user['username'].lower()] = user
 
     def _sync_queue_users_to_known_users(self):
         """Синхронизация пользователей из очередей в known_users"""
@@ -52,9 +187,9 @@ class PersistentQueueManager:
             if topic_id in self.topic_to_chat:
                 chat_id = self.topic_to_chat[topic_id]
                 for user in queue:
-                    # Проверяем, нет ли уже такого пользователя
-                    if not any(u['user_id'] == user['user_id'] for u in self.known_users[chat_id]):
-                        self.add_known_user(
+                    # Добавляем только отсутствующих, профили из очереди могут быть устаревшими
+                    if user['user_id'] not in self._known_index[chat_id]:
+                        self._upsert_known_user(
                             chat_id,
                             user['user_id'],
                             user['first_name'],
@@ -63,39 +198,116 @@ class PersistentQueueManager:
                             False  # is_bot
                         )
 
+    def snapshot_data(self):
+        """Сохраняемое состояние: словарь для JSON (ключи - строки)"""
+        return {
+            'queues': {str(k): list(v) for k, v in self.queues.items()},
+            'pending_swaps': self.pending_swaps,
+            'queue_message_ids': {str(k): v for k, v in self.queue_message_ids.items()},
+            'known_users': {str(k): v for k, v in self.known_users.items()},
+            'topic_to_chat': {str(k): v for k, v in self.topic_to_chat.items()},
+            'queue_stats': self.events.snapshot(),
+            'topic_expiry': {str(k): v for k, v in self.topic_expiry.items()},
+            'topic_policies': {str(k): v.to_dict() for k, v in self.topic_policies.items()},
+            'last_save': datetime.now().isoformat()
+        }
+
+    @traced('storage.save_data')
     def save_data(self):
         """Сохранение данных в файл"""
+        start = time.perf_counter()
         try:
-            # Конвертируем ключи в строки для JSON
-            queues_serializable = {str(k): v for k, v in self.queues.items()}
-            queue_message_ids_serializable = {str(k): v for k, v in self.queue_message_ids.items()}
-            known_users_serializable = {str(k): v for k, v in self.known_users.items()}
-            topic_to_chat_serializable = {str(k): v for k, v in self.topic_to_chat.items()}
-
-            data = {
-                'queues': queues_serializable,
-                'pending_swaps': self.pending_swaps,
-                'queue_message_ids': queue_message_ids_serializable,
-                'known_users': known_users_serializable,
-                'topic_to_chat': topic_to_chat_serializable,  # Новое поле
-                'last_save': datetime.now().isoformat()
-            }
+            data = self.snapshot_data()
+            if self.journal:
+                # Журнал пишется раньше снимка: резерв видит изменение не позже, чем оно попадёт на диск
+                self.journal_seq = self.journal.ship(data)
+            if self.journal_seq is not None:
+                data['journal_seq'] = self.journal_seq
 
             # Создаем временный файл для безопасного сохранения
+            snapshot = encode_snapshot(data, self.compression)
+            size = len(snapshot)
             temp_filename = self.filename + '.tmp'
-            with open(temp_filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-
-            # Заменяем старый файл новым
-            if os.path.exists(self.filename):
-                os.replace(temp_filename, self.filename)
-            else:
-                os.rename(temp_filename, self.filename)
-
+            with open(temp_filename, 'wb') as f:
+                f.write(snapshot)
+                if self.durability != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # Текущий снимок становится предыдущим, новый занимает его место. Между заменами
+            # основного файла нет, и загрузка берёт предыдущий
+            if os.path.exists(self.filename) and self._main_snapshot_valid:
+                os.replace(self.filename, self.previous_filename)
+            os.replace(temp_filename, self.filename)
+            self._main_snapshot_valid = True
+            if self.durability == 'dir':
+                fsync_directory(os.path.dirname(self.filename))
+
+            self.last_save_duration = time.perf_counter() - start
+            self.last_save_bytes = size
+            SAVE_DURATION.observe(self.last_save_duration)
+            SAVE_BYTES.inc(size)
             logger.info(f"Данные сохранены в {self.filename}")
         except Exception as e:
             logger.error(f"Ошибка при сохранении данных: {e}")
 
+    def replay_journal(self, records):
+        """Применение записей журнала основного процесса (горячий резерв) без сохранения"""
+        for record in records:
+            if record['full']:
+                self._apply_snapshot(record['set'])
+            else:
+                self._apply_delta(record['set'], record.get('del', {}))
+            self.journal_seq = record['seq']
+
+    def _apply_delta(self, changed, removed):
+        """Замена изменившихся и удаление исчезнувших ключей разделов снимка"""
+        for topic_id_str in removed.get('queues', ()):
+            self.total_entries -= len(self.queues.pop(int(topic_id_str), ()))
+        for topic_id_str, queue in changed.get('queues', {}).items():
+            topic_id = int(topic_id_str)
+            self.total_entries += len(queue) - len(self.queues.get(topic_id, ()))
+            self.queues[topic_id] = deque(queue)
+
+        for swap_id in removed.get('pending_swaps', ()):
+            self.pending_swaps.pop(swap_id, None)
+        self.pending_swaps.update(changed.get('pending_swaps', {}))
+
+        chats = set()
+        for chat_id_str in removed.get('known_users', ()):
+            chat_id = int(chat_id_str)
+            self.known_users_total -= len(self.known_users.pop(chat_id, ()))
+            chats.add(chat_id)
+        for chat_id_str, users in changed.get('known_users', {}).items():
+            chat_id = int(chat_id_str)
+            self.known_users_total += len(users) - len(self.known_users.get(chat_id, ()))
+            self.known_users[chat_id] = [dict(u, is_bot=u.get('is_bot', False)) for u in users]
+            chats.add(chat_id)
+        for chat_id in chats:
+            self._index_known_chat(chat_id)
+
+        for section, target, convert in (
+            ('queue_message_ids', self.queue_message_ids, None),
+            ('topic_to_chat', self.topic_to_chat, None),
+            ('queue_stats', self.events.stats, TopicStats.from_dict),
+            ('topic_expiry', self.topic_expiry, None),
+            ('topic_policies', self.topic_policies, TopicPolicy.from_dict),
+        ):
+            for key in removed.get(section, ()):
+                target.pop(int(key), None)
+            for key, value in changed.get(section, {}).items():
+                target[int(key)] = convert(value) if convert else value
+
+    def attach_journal(self, journal):
+        """
+        Процесс становится основным: сроки автоистечения пересчитываются по применённому
+        журналу, дальнейшие изменения пишутся в journal. Первое сохранение - полная запись
+        """
+        self._rebuild_expiry()
+        self.journal = journal
+        self.save_data()
+
+    @traced('queue_manager.add_user_to_queue')
     def add_user_to_queue(self, topic_id, user_id, first_name, last_name, username):
         """Добавление пользователя в очередь с валидацией"""
         if not isinstance(topic_id, int) or not isinstance(user_id, int):
@@ -117,7 +329,11 @@ class PersistentQueueManager:
             'joined_at': datetime.now().isoformat()
         }
 
-        queue.append(user_data)
+        self._place_entry(topic_id, queue, user_data)
+        self.total_entries += 1
+        self.events.record(topic_id, 'join', user_id=user_id)
+        self._remember(topic_id, 'join', added=[user_id])
+        self._track_expiry(topic_id, user_data)
         
         # Автоматически добавляем пользователя в known_users для этого чата
         if topic_id in self.topic_to_chat:
@@ -128,26 +344,384 @@ class PersistentQueueManager:
         logger.info(f"User {user_id} added to queue {topic_id}")
         return True
 
+    @traced('queue_manager.remove_user_from_queue')
     def remove_user_from_queue(self, topic_id, user_id):
         queue = self.queues[topic_id]
         for i, user in enumerate(queue):
             if user['user_id'] == user_id:
-                queue.pop(i)
+                del queue[i]
+                self.total_entries -= 1
+                self.events.record(topic_id, 'leave', user_id=user_id)
+                self._remember(topic_id, 'leave', removed=[(i, user)])
                 self.save_data()
                 logger.info(f"User {user_id} removed from queue {topic_id}")
                 return True
         return False
 
+    @traced('queue_manager.remove_user_by_username')
     def remove_user_by_username(self, topic_id, username):
         queue = self.queues[topic_id]
         for i, user in enumerate(queue):
             if user['username'] == username:
-                queue.pop(i)
+                del queue[i]
+                self.total_entries -= 1
+                self.events.record(topic_id, 'leave', user_id=user['user_id'])
+                self._remember(topic_id, 'remove', removed=[(i, user)])
                 self.save_data()
                 logger.info(f"User @{username} removed from queue {topic_id}")
                 return True
         return False
 
+    @traced('queue_manager.remove_users_by_username')
+    def remove_users_by_username(self, topic_id, usernames):
+        """Удаление нескольких пользователей за один проход очереди и одно сохранение.
+        Возвращает множество удалённых username в нижнем регистре"""
+        wanted = {username.lstrip('@').lower() for username in usernames}
+        queue = self.queues[topic_id]
+        kept = []
+        removed = set()
+        removed_entries = []
+        for i, user in enumerate(queue):
+            username = user['username'].lower()
+            if username and username in wanted:
+                removed.add(username)
+                removed_entries.append((i, user))
+                self.events.record(topic_id, 'leave', user_id=user['user_id'])
+            else:
+                kept.append(user)
+        if removed:
+            self.total_entries -= len(removed_entries)
+            queue.clear()
+            queue.extend(kept)
+            self._remember(topic_id, 'remove', removed=removed_entries)
+            self.save_data()
+            logger.info(f"Users {sorted(removed)} removed from queue {topic_id}")
+        return removed
+
+    @traced('queue_manager.insert_users')
+    def insert_users(self, topic_id, entries):
+        """Пакетная вставка с одним сохранением. entries - [(user_data, позиция с 1 или None - в конец)],
+        применяются по порядку. Возвращает [(user_data, фактическая позиция или None, если уже в очереди)]"""
+        queue = self.queues[topic_id]
+        present = {user['user_id'] for user in queue}
+        results = []
+        for user_data, position in entries:
+            if user_data['user_id'] in present:
+                results.append((user_data, None))
+                continue
+            insert_position = self._place_entry(topic_id, queue, user_data, position)
+            present.add(user_data['user_id'])
+            self.events.record(topic_id, 'insert', user_id=user_data['user_id'], position=insert_position + 1)
+            self._track_expiry(topic_id, user_data)
+            results.append((user_data, insert_position + 1))
+        inserted = sum(1 for _, position in results if position is not None)
+        if inserted:
+            self.total_entries += inserted
+            self._remember(topic_id, 'insert', added=[entry['user_id'] for entry, position in results if position])
+            self.save_data()
+            logger.info(f"{inserted} users inserted into queue {topic_id}")
+        return results
+
+    @traced('queue_manager.give_place')
+    def give_place(self, topic_id, giver_id, taker_data):
+        """Передача места giver'а пользователю taker (taker уходит со своего места, если был в очереди).
+        Возвращает запись giver'а или None, если его уже нет в очереди"""
+        queue = self.queues[topic_id]
+        giver_pos = next((i for i, u in enumerate(queue) if u['user_id'] == giver_id), None)
+        if giver_pos is None:
+            return None
+
+        taker_pos = next((i for i, u in enumerate(queue) if u['user_id'] == taker_data['user_id']), None)
+        # Отмена: убрать taker'а и вернуть обоих на исходные позиции
+        removed = [(giver_pos, queue[giver_pos])]
+        if taker_pos is not None:
+            removed = sorted(removed + [(taker_pos, queue[taker_pos])], key=lambda item: item[0])
+            del queue[taker_pos]
+            self.total_entries -= 1
+            if taker_pos < giver_pos:
+                giver_pos -= 1
+
+        giver = queue[giver_pos]
+        # В упорядоченной очереди место - это ранг: taker получает ранг giver'а
+        if 'rank' in giver:
+            taker_data['rank'] = giver['rank']
+        queue[giver_pos] = taker_data
+        self.events.record(topic_id, 'give', user_id=giver_id, taker_id=taker_data['user_id'])
+        self._remember(topic_id, 'give', removed=removed, added=[taker_data['user_id']])
+        self._track_expiry(topic_id, taker_data)
+        self.save_data()
+        logger.info(f"User {taker_data['user_id']} took place of {giver_id} in queue {topic_id}")
+        return giver
+
+    @traced('queue_manager.clear_queue')
+    def clear_queue(self, topic_id):
+        """Очистка очереди. Возвращает количество удалённых записей"""
+        queue = self.queues.get(topic_id)
+        if not queue:
+            return 0
+        removed = len(queue)
+        self._remember(topic_id, 'clear', removed=list(enumerate(queue)))
+        self.queues[topic_id] = deque()
+        self.total_entries -= removed
+        self.events.record(topic_id, 'clear', count=removed)
+        self.save_data()
+        logger.info(f"Queue {topic_id} cleared, {removed} entries removed")
+        return removed
+
+    @traced('queue_manager.pop_front')
+    def pop_front(self, topic_id, count=1):
+        """Снятие первых count записей очереди (O(1) на запись) с одним сохранением.
+        Возвращает снятые записи"""
+        queue = self.queues[topic_id]
+        popped = [queue.popleft() for _ in range(min(count, len(queue)))]
+        if popped:
+            self.total_entries -= len(popped)
+            self.events.record_next(topic_id, popped)
+            policy = self.topic_policies.get(topic_id)
+            virtual_time = policy.virtual_time if policy else None
+            if policy:
+                policy.served(popped)
+            self._remember(topic_id, 'next', removed=list(enumerate(popped)), virtual_time=virtual_time)
+            self.save_data()
+            logger.info(f"{len(popped)} users popped from the front of queue {topic_id}")
+        return popped
+
+    def _place_entry(self, topic_id, queue, entry, position=None):
+        """
+        Вставка записи: position (с 1) - явная позиция, None - по политике топика
+        (fifo - в конец, иначе - по рангу двоичным поиском). Возвращает индекс записи
+        """
+        policy = self.topic_policies.get(topic_id)
+        if policy is None or not policy.ordered:
+            index = len(queue) if position is None else min(max(position, 1) - 1, len(queue))
+        elif position is None:
+            entry['rank'] = policy.rank(entry)
+            index = ordered_index(queue, entry['rank'])
+        else:
+            index = min(max(position, 1) - 1, len(queue))
+            entry['rank'] = rank_between(queue, index)
+        queue.insert(index, entry)
+        return index
+
+    def set_topic_policy(self, topic_id, kind):
+        """
+        Смена политики порядка. Стоящие в очереди ранжируются заново в текущем порядке,
+        как если бы записались в нём, и очередь пересортировывается (для fifo ранги снимаются)
+        """
+        previous = self.topic_policies.get(topic_id)
+        if kind == 'fifo':
+            self.topic_policies.pop(topic_id, None)
+        else:
+            policy = TopicPolicy(kind, levels=previous.levels if previous and previous.kind == kind else None)
+            self.topic_policies[topic_id] = policy
+        self._rerank(topic_id)
+        self.events.record(topic_id, 'policy', kind=kind)
+        self.save_data()
+        logger.info(f"Queue {topic_id} policy set to {kind}")
+
+    def _rerank(self, topic_id):
+        """
+        Ранги записей очереди по текущей политике топика (для fifo ранги снимаются).
+        Равные ранги не меняют текущий порядок: внутри приоритета он сохраняется
+        """
+        queue = self.queues.get(topic_id)
+        if not queue:
+            return
+        policy = self.topic_policies.get(topic_id)
+        if policy is None:
+            for entry in queue:
+                entry.pop('rank', None)
+            return
+        for index, entry in enumerate(queue):
+            entry['rank'] = policy.rank(entry, index)
+        ordered = sorted(queue, key=lambda entry: entry['rank'])
+        queue.clear()
+        queue.extend(ordered)
+
+    def set_user_level(self, topic_id, user_id, level):
+        """
+        Приоритет (priority) или вес (weighted) пользователя в топике.
+        Если пользователь в очереди (priority), очередь ранжируется заново: он переходит к записям
+        своего нового приоритета, и все записи сохраняют текущий порядок внутри приоритета.
+        Возвращает False для fifo
+        """
+        policy = self.topic_policies.get(topic_id)
+        if policy is None or not policy.ordered:
+            return False
+        policy.levels[user_id] = level
+        queue = self.queues[topic_id]
+        if policy.kind == 'priority' and any(entry['user_id'] == user_id for entry in queue):
+            self._rerank(topic_id)
+        self.events.record(topic_id, 'level', user_id=user_id, level=level)
+        self.save_data()
+        logger.info(f"User {user_id} level in queue {topic_id} set to {level}")
+        return True
+
+    def _track_expiry(self, topic_id, entry):
+        """Срок записи в общую кучу, если у топика задан TTL"""
+        ttl = self.topic_expiry.get(topic_id, {}).get('ttl')
+        if ttl:
+            self.expiry.push(ttl_start(entry, time.time()) + ttl, topic_id, 'ttl')
+
+    def _schedule_clear(self, topic_id, now=None):
+        clear_at = self.topic_expiry.get(topic_id, {}).get('clear_at')
+        if clear_at:
+            self.expiry.push(next_clear_time(clear_at, time.time() if now is None else now), topic_id, 'clear', clear_at)
+
+    def _rebuild_expiry(self):
+        """Заполнение кучи сроков по загруженным очередям и настройкам"""
+        self.expiry.clear()
+        for topic_id in self.topic_expiry:
+            for entry in self.queues.get(topic_id, ()):
+                self._track_expiry(topic_id, entry)
+            self._schedule_clear(topic_id)
+
+    def set_topic_expiry(self, topic_id, ttl=None, clear_at=None):
+        """Настройка автоистечения топика (None - не меняется). Возвращает текущие настройки"""
+        settings = self.topic_expiry.setdefault(topic_id, {'ttl': None, 'clear_at': None})
+        if ttl is not None:
+            settings['ttl'] = ttl
+            # Сроки уже стоящих в очереди считаются от их joined_at
+            for entry in self.queues.get(topic_id, ()):
+                self._track_expiry(topic_id, entry)
+        if clear_at is not None:
+            settings['clear_at'] = clear_at
+            self._schedule_clear(topic_id)
+        self.save_data()
+        logger.info(f"Expiry for topic {topic_id} set to {settings}")
+        return dict(settings)
+
+    def disable_topic_expiry(self, topic_id):
+        """Отключение автоистечения; сроки в куче отбросятся при проверке"""
+        if self.topic_expiry.pop(topic_id, None) is not None:
+            self.save_data()
+            logger.info(f"Expiry for topic {topic_id} disabled")
+
+    def pop_due_expiry(self, now):
+        """Топики, в которых наступили сроки: {topic_id: {'ttl', 'clear'}}. Устаревшие сроки отбрасываются"""
+        due = {}
+        for _, topic_id, kind, tag in self.expiry.pop_due(now):
+            settings = self.topic_expiry.get(topic_id)
+            if not settings:
+                continue
+            if kind == 'clear' and settings.get('clear_at') != tag:
+                continue
+            if kind == 'ttl' and not settings.get('ttl'):
+                continue
+            due.setdefault(topic_id, set()).add(kind)
+        return due
+
+    def postpone_expiry(self, topic_id, kinds, deadline):
+        """Вернуть извлечённые сроки топика в кучу (его проверка не удалась)"""
+        settings = self.topic_expiry.get(topic_id)
+        if not settings:
+            return
+        for kind in kinds:
+            self.expiry.push(deadline, topic_id, kind, settings.get('clear_at') if kind == 'clear' else '')
+
+    @traced('queue_manager.expire_topic')
+    def expire_topic(self, topic_id, kinds, now):
+        """Снятие истёкших записей топика одним проходом и одним сохранением. Возвращает снятые записи"""
+        settings = self.topic_expiry.get(topic_id, {})
+        queue = self.queues[topic_id]
+        if 'clear' in kinds:
+            expired = list(enumerate(queue))
+            queue.clear()
+            # Следующая ежедневная очистка
+            self._schedule_clear(topic_id, now)
+        else:
+            ttl = settings.get('ttl')
+            expired = []
+            kept = []
+            for i, entry in enumerate(queue):
+                if ttl and ttl_start(entry, now) + ttl <= now:
+                    expired.append((i, entry))
+                else:
+                    kept.append(entry)
+            if expired:
+                queue.clear()
+                queue.extend(kept)
+        if expired:
+            self._remember(topic_id, 'expire', removed=expired)
+            expired = [entry for _, entry in expired]
+            self.total_entries -= len(expired)
+            self.events.record(topic_id, 'expire', user_ids=[entry['user_id'] for entry in expired])
+            self.save_data()
+            logger.info(f"{len(expired)} expired entries removed from queue {topic_id}")
+        return expired
+
+    def _remember(self, topic_id, op, removed=(), added=(), swapped=None, virtual_time=None):
+        """
+        Обратная операция для /undo, размером с изменение: removed - [(индекс до изменения, запись)]
+        по возрастанию индекса, added - user_id добавленных, swapped - пара обменявшихся,
+        virtual_time - виртуальное время политики до /next
+        """
+        if self.undo_depth > 0:
+            self.undo_history[topic_id].append({'op': op, 'removed': list(removed), 'added': list(added),
+                                                'swapped': swapped, 'virtual_time': virtual_time})
+
+    @traced('queue_manager.undo')
+    def undo(self, topic_id, count=1):
+        """
+        Отмена последних count изменений очереди обратными операциями, одним сохранением.
+        Возвращает названия отменённых операций (последняя - первой)
+        """
+        history = self.undo_history.get(topic_id)
+        queue = self.queues[topic_id]
+        undone = []
+        while history and len(undone) < count:
+            record = history.pop()
+            if record['swapped']:
+                user1_id, user2_id = record['swapped']
+                positions = [i for i, entry in enumerate(queue) if entry['user_id'] in (user1_id, user2_id)]
+                if len(positions) == 2:
+                    i, j = positions
+                    queue[i], queue[j] = queue[j], queue[i]
+                    if 'rank' in queue[i] and 'rank' in queue[j]:
+                        queue[i]['rank'], queue[j]['rank'] = queue[j]['rank'], queue[i]['rank']
+            if record['added']:
+                added = set(record['added'])
+                kept = [entry for entry in queue if entry['user_id'] not in added]
+                self.total_entries -= len(queue) - len(kept)
+                queue.clear()
+                queue.extend(kept)
+            if record['removed']:
+                # По возрастанию индекса: каждая запись встаёт туда, где стояла до изменения
+                present = {entry['user_id'] for entry in queue}
+                for index, entry in record['removed']:
+                    if entry['user_id'] in present:
+                        continue
+                    if record['op'] == 'expire':
+                        # Место и время записи сохраняются, а TTL отсчитывается заново,
+                        # иначе запись снова истечёт при ближайшей проверке
+                        entry['ttl_from'] = datetime.now().isoformat()
+                    queue.insert(min(index, len(queue)), entry)
+                    present.add(entry['user_id'])
+                    self.total_entries += 1
+                    self._track_expiry(topic_id, entry)
+            if record['virtual_time'] is not None and topic_id in self.topic_policies:
+                # weighted: сроки следующих записей снова считаются от времени до /next
+                self.topic_policies[topic_id].virtual_time = record['virtual_time']
+            undone.append(record['op'])
+        if undone:
+            self.events.record(topic_id, 'undo', ops=undone)
+            self.save_data()
+            logger.info(f"Undone {undone} in queue {topic_id}")
+        return undone
+
+    def claim_head_notification(self, topic_id):
+        """Первый в очереди, если упоминание ему ещё не отправлялось (и отметка об отправке), иначе None"""
+        queue = self.queues[topic_id]
+        if not queue:
+            self.notified_heads.pop(topic_id, None)
+            return None
+        head = queue[0]
+        if self.notified_heads.get(topic_id) == head['user_id']:
+            return None
+        self.notified_heads[topic_id] = head['user_id']
+        return head
+
+    @traced('queue_manager.swap_users')
     def swap_users(self, topic_id, user1_id, user2_id):
         queue = self.queues[topic_id]
         user1_index = None
@@ -161,20 +735,31 @@ class PersistentQueueManager:
 
         if user1_index is not None and user2_index is not None:
             queue[user1_index], queue[user2_index] = queue[user2_index], queue[user1_index]
+            # Ранги остаются за позициями, чтобы очередь осталась отсортированной
+            user1, user2 = queue[user1_index], queue[user2_index]
+            if 'rank' in user1 and 'rank' in user2:
+                user1['rank'], user2['rank'] = user2['rank'], user1['rank']
+            self.events.record(topic_id, 'swap', user_id=user1_id, other_id=user2_id)
+            self._remember(topic_id, 'swap', swapped=(user1_id, user2_id))
             self.save_data()
             logger.info(f"Users {user1_id} and {user2_id} swapped in queue {topic_id}")
             return True
         return False
 
+    @traced('queue_manager.get_queue_text')
     def get_queue_text(self, topic_id):
         queue = self.queues[topic_id]
         if not queue:
             return "Очередь пуста"
 
+        # Оценка ожидания - умножение на EWMA времени обслуживания, без обхода истории
+        stats = self.events.stats.get(topic_id)
         text = "📋 Текущая очередь:\n\n"
         for i, user in enumerate(queue, 1):
             username = f"(@{user['username']})" if user['username'] else ""
-            text += f"{i}. {user['display_name']} {username}\n"
+            wait = stats.estimated_wait(i) if stats else None
+            estimate = f" ~{format_wait(wait)}" if wait else ""
+            text += f"{i}. {user['display_name']} {username}{estimate}\n"
 
         return text
 
@@ -204,26 +789,139 @@ class PersistentQueueManager:
     def get_pending_swap(self, swap_id):
         return self.pending_swaps.get(swap_id)
 
+    def known_user_matches(self, chat_id, user_id, first_name, last_name, username, is_bot=False):
+        """True, если пользователь уже известен с точно таким же профилем"""
+        known = self._known_index[chat_id].get(user_id)
+        return (known is not None
+                and known['first_name'] == (first_name or '')
+                and known['last_name'] == (last_name or '')
+                and known['username'] == (username or '')
+                and known['is_bot'] == is_bot)
+
+    def _upsert_known_user(self, chat_id, user_id, first_name, last_name, username, is_bot=False):
+        """Добавление или обновление профиля известного пользователя без сохранения.
+        Возвращает True, если данные изменились"""
+        if self.known_user_matches(chat_id, user_id, first_name, last_name, username, is_bot):
+            return False
+
+        user_data = {
+            'user_id': user_id,
+            'first_name': first_name or '',
+            'last_name': last_name or '',
+            'username': username or '',
+            'display_name': f"{first_name or ''} {last_name or ''}".strip() or f"User_{user_id}",
+            'is_bot': is_bot
+        }
+        known = self._known_index[chat_id].get(user_id)
+        usernames = self._username_index[chat_id]
+        if known is None:
+            self.known_users[chat_id].append(user_data)
+            self._known_index[chat_id][user_id] = user_data
+            known = user_data
+            self.known_users_total += 1
+            logger.info(f"Known user {user_id} added for chat {chat_id}")
+        else:
+            # Пользователь сменил имя или username - обновляем запись на месте
+            if known['username'] and usernames.get(known['username'].lower()) is known:
+                del usernames[known['username'].lower()]
+            known.update(user_data)
+            logger.info(f"Known user {user_id} updated for chat {chat_id}")
+        if known['username']:
+            usernames[known['username'].lower()] = known
+        return True
+
     def add_known_user(self, chat_id, user_id, first_name, last_name, username, is_bot=False):
-        """Добавление известного пользователя из сообщений"""
-        users = self.known_users[chat_id]
-        if not any(u['user_id'] == user_id for u in users):
-            user_data = {
-                'user_id': user_id,
-                'first_name': first_name or '',
-                'last_name': last_name or '',
-                'username': username or '',
-                'display_name': f"{first_name or ''} {last_name or ''}".strip() or f"User_{user_id}",
-                'is_bot': is_bot
-            }
-            users.append(user_data)
+        """Добавление или обновление известного пользователя из сообщений"""
+        if self._upsert_known_user(chat_id, user_id, first_name, last_name, username, is_bot):
             self.save_data()
-            logger.info(f"Known user {user_id} added for chat {chat_id}")
+
+    @traced('queue_manager.upsert_known_users')
+    def upsert_known_users(self, users):
+        """Пакетное добавление/обновление известных пользователей с одним сохранением.
+        users - итерируемое из (chat_id, user_id, first_name, last_name, username, is_bot)"""
+        changed = 0
+        for user in users:
+            if self._upsert_known_user(*user):
+                changed += 1
+        if changed:
+            self.save_data()
+        return changed
 
     def get_known_users(self, chat_id):
         """Получение списка известных пользователей"""
         return self.known_users[chat_id]
 
+    def get_known_user(self, chat_id, user_id):
+        """Известный пользователь чата по user_id или None"""
+        return self._known_index[chat_id].get(user_id)
+
+    def find_known_user(self, chat_id, username):
+        """Известный пользователь чата по username (без @, без учёта регистра) или None"""
+        return self._username_index[chat_id].get(username.lstrip('@').lower())
+
+    def restore_chat(self, data, chat_id):
+        """
+        Восстановление одного чата из снимка (snapshot_data): очереди, сообщения, автоистечение,
+        статистика и политики его топиков, связи топиков с чатом и известные пользователи. Остальные чаты не меняются.
+        Ожидающие обмены чата сбрасываются: их таймеры остались в прошлом.
+        Возвращает список затронутых топиков
+        """
+        saved_topics = {int(k) for k, v in data.get('topic_to_chat', {}).items() if v == chat_id}
+        current_topics = {topic_id for topic_id, chat in self.topic_to_chat.items() if chat == chat_id}
+        topics = saved_topics | current_topics
+        for topic_id in topics:
+            key = str(topic_id)
+            # Обратные операции относятся к состоянию до восстановления
+            self.undo_history.pop(topic_id, None)
+            queue = data.get('queues', {}).get(key)
+            if queue:
+                self.queues[topic_id] = deque(dict(entry) for entry in queue)
+            else:
+                self.queues.pop(topic_id, None)
+            message_id = data.get('queue_message_ids', {}).get(key)
+            if message_id:
+                self.queue_message_ids[topic_id] = message_id
+            else:
+                self.queue_message_ids.pop(topic_id, None)
+            if topic_id in saved_topics:
+                self.topic_to_chat[topic_id] = chat_id
+            else:
+                self.topic_to_chat.pop(topic_id, None)
+            # Автоистечение и статистика восстанавливаются, если они есть в копии
+            saved_expiry = data.get('topic_expiry')
+            if saved_expiry is not None:
+                if saved_expiry.get(key):
+                    self.topic_expiry[topic_id] = dict(saved_expiry[key])
+                else:
+                    self.topic_expiry.pop(topic_id, None)
+            saved_stats = data.get('queue_stats')
+            if saved_stats is not None:
+                if saved_stats.get(key):
+                    self.events.stats[topic_id] = TopicStats.from_dict(saved_stats[key])
+                else:
+                    self.events.stats.pop(topic_id, None)
+            # Политика восстанавливается вместе с очередью. В копиях без политик остаётся текущая;
+            # записи без ранга ранжируются по ней, иначе упорядоченная очередь сломается
+            saved_policies = data.get('topic_policies')
+            if saved_policies is not None:
+                if saved_policies.get(key):
+                    self.topic_policies[topic_id] = TopicPolicy.from_dict(saved_policies[key])
+                else:
+                    self.topic_policies.pop(topic_id, None)
+            if topic_id not in self.topic_policies or any('rank' not in entry for entry in self.queues.get(topic_id, ())):
+                self._rerank(topic_id)
+
+        self.pending_swaps = {k: v for k, v in self.pending_swaps.items() if v.get('chat_id') != chat_id}
+        users = data.get('known_users', {}).get(str(chat_id), [])
+        self.known_users[chat_id] = [dict(u, is_bot=u.get('is_bot', False)) for u in users]
+        self._rebuild_known_index()
+        self._sync_queue_users_to_known_users()
+        self._recount()
+        self._rebuild_expiry()
+        self.save_data()
+        logger.info(f"Chat {chat_id} restored, topics: {sorted(topics)}")
+        return sorted(topics)
+
 
 # Создаем глобальный экземпляр менеджера очередей
-queue_manager = PersistentQueueManager()
\ No newline at end of file
+queue_manager = PersistentQueueManager(os.getenv('QUEUE_DATA_FILE', 'queues_data.json'))
\ No newline at end of file
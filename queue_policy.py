@@ -0,0 +1,91 @@
+import bisect
+import time
+
+from queue_events import joined_timestamp
+
+# Порядок очереди топика:
+#   fifo     - по времени записи (по умолчанию, записи без ранга)
+#   priority - сначала пользователи с большим приоритетом, внутри приоритета - по времени записи
+#              (при смене политики и приоритета - в текущем порядке очереди)
+#   weighted - взвешенная справедливость: пользователь с весом 2 при повторных записях
+#              обслуживается вдвое чаще пользователя с весом 1
+POLICIES = ('fifo', 'priority', 'weighted')
+# Разнос приоритетов в ранге: больше любой метки времени и любого номера в очереди
+PRIORITY_SPAN = 1e10
+
+
+class TopicPolicy:
+    """
+    Политика очереди топика. Записи упорядоченных очередей хранят ранг (entry['rank']),
+    очередь остаётся отсортированной по нему: место новой записи находится двоичным поиском,
+    первый снимается за O(1). Вставка в середину deque - O(n) (как и доступ по индексу
+    при поиске). Куча с O(log n) не используется: сообщение с очередью, позиции, обмен и /insert
+    нужны в порядке очереди, а каждое изменение и так пересохраняет снимок целиком.
+    Обмен и передача места обмениваются рангами вместе с позициями, поэтому порядок не нарушается
+    """
+    def __init__(self, kind='fifo', levels=None, virtual_time=0.0, finish=None):
+        self.kind = kind
+        # priority: user_id -> приоритет (по умолчанию 0); weighted: user_id -> вес (по умолчанию 1)
+        self.levels = levels or {}
+        # weighted: виртуальное время (ранг последнего снятого) и виртуальные сроки пользователей
+        self.virtual_time = virtual_time
+        self.finish = finish or {}
+
+    @property
+    def ordered(self):
+        return self.kind != 'fifo'
+
+    def rank(self, entry, order=None):
+        """
+        Ранг записи. order - номер записи в очереди при переранжировании: внутри приоритета
+        записи остаются в текущем порядке (обмены, передачи места и /insert не теряются),
+        а новые записи встают после них по времени записи
+        """
+        user_id = entry['user_id']
+        if self.kind == 'priority':
+            tie = joined_timestamp(entry, time.time()) if order is None else order
+            return -self.levels.get(user_id, 0) * PRIORITY_SPAN + tie
+        # weighted: виртуальный срок обслуживания, шаг обратно пропорционален весу
+        weight = self.levels.get(user_id, 1)
+        finish = max(self.virtual_time, self.finish.get(user_id, 0.0)) + 1.0 / weight
+        self.finish[user_id] = finish
+        return finish
+
+    def served(self, entries):
+        """Записи сняты с начала очереди"""
+        if self.kind == 'weighted' and entries:
+            self.virtual_time = max(self.virtual_time, entries[-1].get('rank', self.virtual_time))
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'levels': {str(k): v for k, v in self.levels.items()},
+            'virtual_time': self.virtual_time,
+            'finish': {str(k): v for k, v in self.finish.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get('kind', 'fifo'),
+            {int(k): v for k, v in data.get('levels', {}).items()},
+            data.get('virtual_time', 0.0),
+            {int(k): v for k, v in data.get('finish', {}).items()},
+        )
+
+
+def ordered_index(queue, rank):
+    """Позиция для записи с рангом rank в отсортированной очереди (после равных).
+    O(log n) сравнений, но каждый доступ к середине deque - O(n)"""
+    return bisect.bisect_right(queue, rank, key=lambda entry: entry['rank'])
+
+
+def rank_between(queue, index):
+    """Ранг для явной вставки на позицию index (/insert) между соседями"""
+    if not queue:
+        return 0.0
+    if index <= 0:
+        return queue[0]['rank'] - 1.0
+    if index >= len(queue):
+        return queue[-1]['rank'] + 1.0
+    return (queue[index - 1]['rank'] + queue[index]['rank']) / 2
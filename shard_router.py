@@ -0,0 +1,397 @@
+"""
+Горизонтальное масштабирование: фронт-процесс и N рабочих процессов бота, разделённых по чатам
+
+Фронт получает обновления (getUpdates или webhook) и по chat_id передаёт каждое одному рабочему.
+Рабочий - обычный main.py в режиме webhook на локальном порту со своим файлом данных
+(queues_data.shard<k>.json): все очереди, известные пользователи и обмены чата живут в одном
+процессе, поэтому блокировки и сохранение не нужно согласовывать между процессами. Ответы
+в Telegram рабочие отправляют сами.
+
+Чат закрепляется за рабочим rendezvous-хэшированием: при изменении числа рабочих с N на M
+переезжает только доля чатов около |M - N| / max(M, N). Переезд данных - команда rebalance
+при остановленных процессах.
+
+Запуск:
+    python shard_router.py run --workers 4
+    python shard_router.py rebalance --from-workers 4 --to-workers 6
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+from collections import defaultdict
+
+import httpx
+from dotenv import load_dotenv
+
+from http_server import LocalHTTPServer
+from snapshot import encode_snapshot, read_snapshot
+from webhook import SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORKER_PATH = '/telegram'
+# Обновления, ожидающие передачи одному рабочему; при переполнении фронт перестаёт принимать новые
+WORKER_QUEUE_SIZE = 1000
+# Поля обновления, в которых есть чат
+CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'business_message',
+               'my_chat_member', 'chat_member', 'chat_join_request', 'message_reaction', 'chat_boost')
+# Разделы снимка с ключом topic_id
+TOPIC_SECTIONS = ('queues', 'queue_message_ids', 'queue_stats', 'topic_expiry', 'topic_policies')
+# Суффикс, с которым rebalance оставляет прежние файлы рабочих
+REBALANCE_SUFFIX = '.before-rebalance'
+
+
+def shard_for(chat_id, workers):
+    """Номер рабочего для чата (rendezvous-хэширование: максимум хэша пары чат-рабочий)"""
+    def score(index):
+        return hashlib.blake2b(f"{chat_id}:{index}".encode(), digest_size=8).digest()
+    return max(range(workers), key=score)
+
+
+def update_chat_id(update):
+    """chat_id обновления; для обновлений без чата (inline-запросы и т.п.) - id пользователя"""
+    for field in CHAT_FIELDS:
+        if field in update:
+            return update[field].get('chat', {}).get('id')
+    query = update.get('callback_query')
+    if query:
+        message = query.get('message')
+        if message:
+            return message['chat']['id']
+        return query['from']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return None
+
+
+class Worker:
+    """Рабочий процесс: main.py в режиме webhook на порту port"""
+    def __init__(self, index, workers, port, data_dir, secret_token):
+        self.index = index
+        self.port = port
+        self.secret_token = secret_token
+        self.url = f"http://127.0.0.1:{port}{WORKER_PATH}"
+        self.env = dict(
+            os.environ,
+            BOT_MODE='webhook',
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(port),
+            WEBHOOK_PATH=WORKER_PATH,
+            WEBHOOK_SECRET=secret_token,
+            QUEUE_DATA_FILE=os.path.join(data_dir, f"queues_data.shard{index}.json"),
+            QUEUE_EVENTS_DIR=os.path.join(data_dir, f"queue_events.shard{index}"),
+            BACKUP_DIR=os.path.join(data_dir, 'backups', f"shard{index}"),
+            SHARD_INDEX=str(index),
+            SHARD_COUNT=str(workers),
+        )
+        # Публичный webhook регистрирует только фронт. Пустое значение, а не отсутствие ключа:
+        # load_dotenv в main.py не заменяет заданные переменные, но дописал бы WEBHOOK_URL из .env
+        self.env['WEBHOOK_URL'] = ''
+        # Каталог журнала и запись обновлений у каждого рабочего свои
+        if os.getenv('QUEUE_JOURNAL_DIR'):
+            self.env['QUEUE_JOURNAL_DIR'] = os.path.join(os.getenv('QUEUE_JOURNAL_DIR'), f"shard{index}")
+        else:
+            self.env['QUEUE_JOURNAL_DIR'] = ''
+        if os.getenv('RECORD_UPDATES'):
+            self.env['RECORD_UPDATES'] = f"{os.getenv('RECORD_UPDATES')}.shard{index}"
+        else:
+            self.env['RECORD_UPDATES'] = ''
+        if os.getenv('METRICS_PORT'):
+            self.env['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + index)
+        self.process = None
+        self.queue = asyncio.Queue(WORKER_QUEUE_SIZE)
+        self.forwarded = 0
+        self.dropped = 0
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], cwd=ROOT, env=self.env)
+        logger.info(f"Worker {self.index} started, pid {self.process.pid}, port {self.port}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            # SIGTERM: рабочий сохраняет данные при завершении
+            self.process.terminate()
+
+    async def forward(self, client):
+        """Передача обновлений рабочему по одному, в порядке получения: порядок внутри чата сохраняется"""
+        while True:
+            update = await self.queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    response = await client.post(
+                        self.url, content=json.dumps(update, ensure_ascii=False).encode('utf-8'),
+                        headers={'Content-Type': 'application/json', SECRET_HEADER: self.secret_token}
+                    )
+                    if response.status_code == 200:
+                        self.forwarded += 1
+                        break
+                    if response.status_code < 500 and response.status_code != 429:
+                        # Рабочий отверг само обновление (секрет, разбор): повтор не поможет, а остановил бы
+                        # очередь рабочего и, в режиме polling, подтверждение getUpdates для всех рабочих
+                        logger.error(f"Worker {self.index} rejected update {update.get('update_id')} "
+                                     f"with {response.status_code}, dropped")
+                        self.dropped += 1
+                        break
+                    # 503 - очередь рабочего заполнена, 429 и остальные 5xx - повторяем
+                    logger.warning(f"Worker {self.index} returned {response.status_code}")
+                except httpx.HTTPError as e:
+                    # Рабочий запускается или перезапускается
+                    logger.debug(f"Worker {self.index} is unavailable: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            self.queue.task_done()
+
+
+class ShardRouter:
+    """Фронт: приём обновлений и распределение по рабочим"""
+    def __init__(self, token, workers, base_url, data_dir, worker_port_base):
+        self.token = token
+        self.base_url = base_url
+        data_dir = os.path.abspath(data_dir)
+        self.workers = [
+            Worker(index, workers, worker_port_base + index, data_dir, secrets.token_hex(16))
+            for index in range(workers)
+        ]
+        self._tasks = []
+        self._client = None
+
+    async def dispatch(self, update):
+        """Поставить обновление в очередь его рабочего"""
+        chat_id = update_chat_id(update)
+        worker = self.workers[shard_for(chat_id, len(self.workers)) if chat_id is not None else 0]
+        await worker.queue.put(update)
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.workers[0].env['QUEUE_DATA_FILE']), exist_ok=True)
+        self._client = httpx.AsyncClient(timeout=30)
+        for worker in self.workers:
+            worker.start()
+            self._tasks.append(asyncio.create_task(worker.forward(self._client)))
+        self._tasks.append(asyncio.create_task(self._supervise()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            if worker.process:
+                await asyncio.to_thread(worker.process.wait)
+        await self._client.aclose()
+
+    async def _supervise(self):
+        """Перезапуск упавших рабочих; их обновления ждут в очереди фронта"""
+        while True:
+            await asyncio.sleep(1)
+            for worker in self.workers:
+                if worker.process.poll() is not None:
+                    logger.error(f"Worker {worker.index} exited with code {worker.process.returncode}, restarting")
+                    worker.start()
+
+    async def poll(self):
+        """getUpdates; смещение подтверждается только после передачи пачки рабочим"""
+        url = f"{self.base_url}{self.token}"
+        await self._client.post(f"{url}/deleteWebhook", json={})
+        offset = None
+        while True:
+            try:
+                response = await self._client.post(
+                    f"{url}/getUpdates", json={'offset': offset, 'timeout': 25}, timeout=35
+                )
+                updates = response.json().get('result') or []
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.dispatch(update)
+                offset = update['update_id'] + 1
+            # Доставка "хотя бы один раз": следующий getUpdates подтвердит пачку, когда рабочие её приняли
+            for worker in self.workers:
+                await worker.queue.join()
+
+    def webhook_server(self, listen, port, url_path, secret_token):
+        """Приём обновлений от Telegram на фронте"""
+        server = LocalHTTPServer(listen, port)
+
+        async def handle(request):
+            if secret_token and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, '').encode(), secret_token.encode()
+            ):
+                return 403, b'', {}
+            try:
+                update = json.loads(request.body)
+            except ValueError:
+                return 400, b'', {}
+            chat_id = update_chat_id(update)
+            worker = self.workers[shard_for(chat_id, len(self.workers)) if chat_id is not None else 0]
+            try:
+                worker.queue.put_nowait(update)
+            except asyncio.QueueFull:
+                return 503, b'', {'Retry-After': '1'}
+            return 200, b'', {}
+
+        server.route('POST', url_path, handle)
+        return server
+
+
+async def run(args):
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        raise ValueError("Токен бота не найден в переменных окружения")
+    base_url = os.getenv('TELEGRAM_BASE_URL') or 'https://api.telegram.org/bot'
+    router = ShardRouter(token, args.workers, base_url, args.data_dir, args.worker_port_base)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await router.start()
+    server = None
+    if os.getenv('BOT_MODE', 'polling').lower() == 'webhook':
+        secret_token = os.getenv('WEBHOOK_SECRET') or None
+        server = router.webhook_server(
+            os.getenv('WEBHOOK_LISTEN', '127.0.0.1'), int(os.getenv('WEBHOOK_PORT', '8443')),
+            os.getenv('WEBHOOK_PATH', '/telegram'), secret_token
+        )
+        await server.start()
+        if os.getenv('WEBHOOK_URL'):
+            await router._client.post(f"{base_url}{token}/setWebhook", json={
+                'url': os.getenv('WEBHOOK_URL'), 'secret_token': secret_token
+            })
+        receiver = asyncio.create_task(stop_event.wait())
+    else:
+        receiver = asyncio.create_task(router.poll())
+
+    logger.info(f"Shard router started with {args.workers} workers")
+    try:
+        await asyncio.wait({receiver, asyncio.create_task(stop_event.wait())}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        receiver.cancel()
+        if server:
+            await server.stop()
+        await router.stop()
+
+
+def shard_leftovers(data_dir, index):
+    """
+    Файлы и каталоги рабочего index, кроме файла данных, с состоянием его чатов: предыдущий снимок,
+    журнал событий, резервные копии и журнал горячего резерва. После rebalance они относятся
+    к прежнему распределению: бот мог бы загрузить .prev с чатами, которые теперь у другого рабочего
+    """
+    paths = [
+        os.path.join(data_dir, f"queues_data.shard{index}.json.prev"),
+        os.path.join(data_dir, f"queue_events.shard{index}"),
+        os.path.join(data_dir, 'backups', f"shard{index}"),
+    ]
+    if os.getenv('QUEUE_JOURNAL_DIR'):
+        paths.append(os.path.join(os.getenv('QUEUE_JOURNAL_DIR'), f"shard{index}"))
+    return paths
+
+
+def _set_aside(path):
+    """path -> path.before-rebalance (оставшееся от прошлого rebalance заменяется)"""
+    if not os.path.exists(path):
+        return
+    target = path + REBALANCE_SUFFIX
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.replace(path, target)
+    logger.info(f"{path} moved to {target}")
+
+
+def rebalance(data_dir, from_workers, to_workers, compression='none'):
+    """
+    Перераспределение файлов данных с from_workers на to_workers рабочих (процессы остановлены)
+    Всё, что относится к чату (очереди и сообщения его топиков, известные пользователи, обмены),
+    переезжает к его новому рабочему. Прежние файлы данных и shard_leftovers всех рабочих
+    откладываются с суффиксом .before-rebalance. Возвращает {'moved_chats', 'chats'}
+    """
+    shards = [defaultdict(dict) for _ in range(to_workers)]
+    moved = set()
+    chats = set()
+    for old_index in range(from_workers):
+        path = os.path.join(data_dir, f"queues_data.shard{old_index}.json")
+        if not os.path.exists(path):
+            continue
+        data = read_snapshot(path)
+        topic_to_chat = {int(k): v for k, v in data.get('topic_to_chat', {}).items()}
+
+        def target(chat_id):
+            # Топики без известного чата остаются у рабочего с тем же номером
+            return shard_for(chat_id, to_workers) if chat_id is not None else old_index % to_workers
+
+        for chat_id in {int(k) for k in data.get('known_users', {})} | set(topic_to_chat.values()):
+            chats.add(chat_id)
+            if target(chat_id) != old_index:
+                moved.add(chat_id)
+        for chat_id_str, users in data.get('known_users', {}).items():
+            shards[target(int(chat_id_str))]['known_users'][chat_id_str] = users
+        for section in TOPIC_SECTIONS:
+            for topic_id_str, value in data.get(section, {}).items():
+                shard = shards[target(topic_to_chat.get(int(topic_id_str)))][section]
+                if topic_id_str in shard:
+                    logger.warning(f"Topic {topic_id_str} exists in several shards, {section} of shard {old_index} wins")
+                shard[topic_id_str] = value
+        for topic_id_str, chat_id in data.get('topic_to_chat', {}).items():
+            shards[target(chat_id)]['topic_to_chat'][topic_id_str] = chat_id
+        for swap_id, swap in data.get('pending_swaps', {}).items():
+            shards[target(swap.get('chat_id'))]['pending_swaps'][swap_id] = swap
+
+    # Включая номера сверх from_workers: там могли остаться файлы ещё более раннего распределения
+    for index in range(max(from_workers, to_workers)):
+        _set_aside(os.path.join(data_dir, f"queues_data.shard{index}.json"))
+        for path in shard_leftovers(data_dir, index):
+            _set_aside(path)
+    for index, shard in enumerate(shards):
+        path = os.path.join(data_dir, f"queues_data.shard{index}.json")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(encode_snapshot(dict(shard), compression))
+        os.replace(path + '.tmp', path)
+    logger.info(f"Rebalanced {from_workers} -> {to_workers} workers: {len(moved)} of {len(chats)} chats moved")
+    return {'moved_chats': len(moved), 'chats': len(chats)}
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Фронт-процесс и рабочие, разделённые по чатам")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="Запустить фронт и рабочих")
+    run_parser.add_argument('--workers', type=int, default=int(os.getenv('SHARD_WORKERS', '2')))
+    run_parser.add_argument('--worker-port-base', type=int, default=int(os.getenv('SHARD_PORT_BASE', '8600')))
+    run_parser.add_argument('--data-dir', default=os.getenv('SHARD_DATA_DIR', ROOT))
+    balance_parser = subparsers.add_parser('rebalance', help="Перераспределить данные (процессы остановлены)")
+    balance_parser.add_argument('--from-workers', type=int, required=True)
+    balance_parser.add_argument('--to-workers', type=int, required=True)
+    balance_parser.add_argument('--data-dir', default=os.getenv('SHARD_DATA_DIR', ROOT))
+    balance_parser.add_argument('--compression', default=os.getenv('QUEUE_SNAPSHOT_COMPRESSION', 'none'))
+    args = parser.parse_args()
+
+    if args.command == 'rebalance':
+        print(json.dumps(rebalance(args.data_dir, args.from_workers, args.to_workers, args.compression)))
+        return
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+import json
+import lzma
+import zlib
+
+# Формат снимка: строка заголовка и сразу за ней данные
+#   QSNAP {"version": 2, "compression": "gzip", "length": 1234, "sha256": "..."}\n
+#   <минифицированный JSON, сжатый указанным способом>
+# Версия 1 - прежний JSON с отступами без заголовка, читается как есть
+SNAPSHOT_MAGIC = b'QSNAP '
+SNAPSHOT_VERSION = 2
+COMPRESSIONS = ('none', 'gzip', 'lzma')
+# Заголовок - одна короткая строка; длиннее - файл повреждён
+MAX_HEADER_SIZE = 4096
+CHUNK_SIZE = 1 << 16
+
+
+class SnapshotError(ValueError):
+    """Снимок повреждён, обрезан или записан неподдерживаемой версией"""
+
+
+def encode_snapshot(data, compression='none'):
+    """Снимок в байтах: заголовок с версией и контрольной суммой + данные"""
+    if compression not in COMPRESSIONS:
+        raise SnapshotError(f"Unknown compression {compression!r}")
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if compression == 'gzip':
+        # mtime=0: одинаковые данные дают одинаковые байты
+        payload = gzip.compress(payload, compresslevel=6, mtime=0)
+    elif compression == 'lzma':
+        payload = lzma.compress(payload, preset=1)
+    header = {
+        'version': SNAPSHOT_VERSION,
+        'compression': compression,
+        'length': len(payload),
+        'sha256': hashlib.sha256(payload).hexdigest(),
+    }
+    return SNAPSHOT_MAGIC + json.dumps(header, separators=(',', ':')).encode('ascii') + b'\n' + payload
+
+
+def _decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if compression == 'lzma':
+        return lzma.LZMADecompressor()
+    return None
+
+
+def read_snapshot(path):
+    """
+    Чтение и проверка снимка
+    Данные читаются блоками: контрольная сумма и распаковка идут по мере чтения,
+    JSON разбирается только после того, как сумма и длина совпали
+    """
+    with open(path, 'rb') as f:
+        head = f.read(len(SNAPSHOT_MAGIC))
+        if head != SNAPSHOT_MAGIC:
+            # Версия 1: JSON с отступами
+            f.seek(0)
+            try:
+                return json.loads(f.read().decode('utf-8'))
+            except ValueError as e:
+                raise SnapshotError(f"Invalid legacy snapshot: {e}") from e
+
+        line = f.readline(MAX_HEADER_SIZE)
+        if not line.endswith(b'\n'):
+            raise SnapshotError("Snapshot header is truncated")
+        try:
+            header = json.loads(line)
+        except ValueError as e:
+            raise SnapshotError(f"Invalid snapshot header: {e}") from e
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotError(f"Unsupported snapshot version {header.get('version')}")
+        if header.get('compression') not in COMPRESSIONS:
+            raise SnapshotError(f"Unknown compression {header.get('compression')!r}")
+
+        hasher = hashlib.sha256()
+        decompressor = _decompressor(header['compression'])
+        parts = []
+        length = 0
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            length += len(chunk)
+            if length > header['length']:
+                raise SnapshotError("Snapshot is longer than its header says")
+            hasher.update(chunk)
+            try:
+                parts.append(decompressor.decompress(chunk) if decompressor else chunk)
+            except (zlib.error, lzma.LZMAError) as e:
+                raise SnapshotError(f"Snapshot data is corrupted: {e}") from e
+
+    if length != header['length']:
+        raise SnapshotError(f"Snapshot is truncated: {length} of {header['length']} bytes")
+    if hasher.hexdigest() != header['sha256']:
+        raise SnapshotError("Snapshot checksum mismatch")
+    try:
+        return json.loads(b''.join(parts).decode('utf-8'))
+    except ValueError as e:
+        raise SnapshotError(f"Invalid snapshot data: {e}") from e
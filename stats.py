@@ -0,0 +1,53 @@
+import logging
+import time
+from apscheduler.events import EVENT_JOB_ADDED, EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED
+
+logger = logging.getLogger(__name__)
+
+
+class RateCounter:
+    """
+    Количество событий за последние window секунд
+    Кольцевой буфер по секундам: добавление и чтение не зависят от числа событий
+    """
+    def __init__(self, window=60):
+        self.window = window
+        self.counts = [0] * window
+        self.seconds = [0] * window
+
+    def add(self, amount=1):
+        second = int(time.monotonic())
+        i = second % self.window
+        if self.seconds[i] != second:
+            self.seconds[i] = second
+            self.counts[i] = 0
+        self.counts[i] += amount
+
+    def total(self):
+        now = int(time.monotonic())
+        return sum(count for count, second in zip(self.counts, self.seconds) if now - second < self.window)
+
+
+class JobCounter:
+    """Количество запланированных задач JobQueue по событиям планировщика"""
+    def __init__(self):
+        self.count = 0
+
+    def attach(self, job_queue):
+        def listener(event):
+            if event.code == EVENT_JOB_ADDED:
+                self.count += 1
+            elif event.code == EVENT_JOB_REMOVED:
+                self.count = max(self.count - 1, 0)
+            elif event.code == EVENT_ALL_JOBS_REMOVED:
+                self.count = 0
+
+        # До запуска планировщика задачи отложены и будут объявлены событием при старте
+        scheduler = job_queue.scheduler
+        self.count = len(scheduler.get_jobs()) if scheduler.running else 0
+        scheduler.add_listener(listener, EVENT_JOB_ADDED | EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED)
+
+
+# Глобальные экземпляры
+update_rate = RateCounter(60)
+job_counter = JobCounter()
@@ -0,0 +1,174 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Трассировка текущего обновления и текущий (родительский) span
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _NullSpan:
+    """Пустой span, когда обновление не трассируется"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.parent = _current_span.get()
+        self.index = None
+        self.start = None
+        self.duration = None
+        self._token = None
+
+    def set(self, **attrs):
+        """Добавить атрибуты к span"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.index = len(self.trace.spans)
+        self.trace.spans.append(self)
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _current_span.reset(self._token)
+        return False
+
+    def to_dict(self):
+        record = {
+            'name': self.name,
+            'parent': self.parent.index if self.parent else None,
+            'start_ms': round((self.start - self.trace.start) * 1000, 3),
+            'duration_ms': round((self.duration if self.duration is not None else 0) * 1000, 3),
+        }
+        if self.attrs:
+            record['attrs'] = self.attrs
+        return record
+
+
+class Trace:
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.started_at = datetime.now().isoformat()
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+class Tracer:
+    """
+    Лёгкая трассировка обработки обновлений
+    Трассируется доля обновлений sample_rate; трассы дольше slow_threshold секунд
+    дописываются в JSON Lines файл
+    """
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.slow_threshold = 0.5
+        self.path = 'traces.jsonl'
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def configure(self, sample_rate=None, slow_threshold=None, path=None):
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if path is not None:
+            self.path = path
+
+    def trace(self, update_id, **attrs):
+        """Контекст трассировки одного обновления (корневой span 'update')"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return _NULL_SPAN
+        return _TraceContext(self, Trace(update_id), attrs)
+
+    def span(self, name, **attrs):
+        """Вложенный span внутри текущей трассы"""
+        trace = _current_trace.get()
+        if trace is None:
+            return _NULL_SPAN
+        return Span(trace, name, attrs)
+
+    def finish(self, trace):
+        duration = time.perf_counter() - trace.start
+        if duration < self.slow_threshold:
+            return
+        record = {
+            'update_id': trace.update_id,
+            'started_at': trace.started_at,
+            'duration_ms': round(duration * 1000, 3),
+            'spans': [span.to_dict() for span in trace.spans],
+        }
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        except Exception as e:
+            logger.error(f"Error writing trace for update {trace.update_id}: {e}")
+
+
+class _TraceContext:
+    def __init__(self, tracer, trace, attrs):
+        self.tracer = tracer
+        self.trace = trace
+        self.root = Span(trace, 'update', attrs)
+
+    def set(self, **attrs):
+        self.root.set(**attrs)
+
+    def __enter__(self):
+        self._token = _current_trace.set(self.trace)
+        self.root.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.root.__exit__(exc_type, exc, tb)
+        _current_trace.reset(self._token)
+        self.tracer.finish(self.trace)
+        return False
+
+
+def traced(name):
+    """Декоратор: выполнение функции (обычной или async) записывается как span"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Глобальный экземпляр
+tracer = Tracer()
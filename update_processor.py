@@ -0,0 +1,33 @@
+import logging
+from telegram.ext import SimpleUpdateProcessor
+
+from tracing import tracer
+from stats import update_rate
+
+logger = logging.getLogger(__name__)
+
+
+def describe_update(update):
+    """Краткое описание обновления для трассировки"""
+    attrs = {}
+    chat = getattr(update, 'effective_chat', None)
+    if chat:
+        attrs['chat_id'] = chat.id
+    if getattr(update, 'callback_query', None):
+        attrs['type'] = 'callback'
+        attrs['data'] = update.callback_query.data
+    elif getattr(update, 'effective_message', None):
+        text = update.effective_message.text or ''
+        attrs['type'] = 'command' if text.startswith('/') else 'message'
+        if text.startswith('/'):
+            attrs['command'] = text.split()[0]
+    return attrs
+
+
+class BotUpdateProcessor(SimpleUpdateProcessor):
+    """Обработчик обновлений Application: учёт пропускной способности и трассировка"""
+
+    async def do_process_update(self, update, coroutine):
+        update_rate.add()
+        with tracer.trace(getattr(update, 'update_id', None), **describe_update(update)):
+            await coroutine
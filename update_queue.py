@@ -0,0 +1,179 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты входящих обновлений (меньше - важнее)
+PRIORITY_HIGH = 0      # нажатия кнопок и команды
+PRIORITY_TEXT = 1      # текстовые сообщения (возможный ввод @username)
+PRIORITY_PASSIVE = 2   # прочие сообщения, нужны только для сбора пользователей
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_TEXT, PRIORITY_PASSIVE)
+
+
+def classify_update(update) -> int:
+    """Определение приоритета обновления"""
+    if update.callback_query:
+        return PRIORITY_HIGH
+
+    message = update.effective_message
+    if not message:
+        # Прочие типы обновлений (изменения участников и т.п.) редки - не откладываем
+        return PRIORITY_HIGH
+
+    text = message.text or message.caption
+    if text and text.startswith('/'):
+        return PRIORITY_HIGH
+    if message.text:
+        return PRIORITY_TEXT
+    return PRIORITY_PASSIVE
+
+
+class _FairBuffer:
+    """
+    Хранилище очереди: для каждого приоритета - круговой обход по чатам
+    lanes[priority]: OrderedDict chat_id -> deque обновлений этого чата
+    """
+    def __init__(self):
+        self.lanes = [OrderedDict() for _ in PRIORITIES]
+        self.sizes = [0 for _ in PRIORITIES]
+        self.control = deque()  # служебные объекты Application (сигнал остановки)
+
+    def __len__(self):
+        return sum(self.sizes) + len(self.control)
+
+    def push(self, item):
+        if not isinstance(item, Update):
+            self.control.append(item)
+            return
+        priority = classify_update(item)
+        chat_id = item.effective_chat.id if item.effective_chat else None
+        lane = self.lanes[priority]
+        chat_queue = lane.get(chat_id)
+        if chat_queue is None:
+            chat_queue = lane[chat_id] = deque()
+        chat_queue.append(item)
+        self.sizes[priority] += 1
+
+    def pop(self):
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                chat_id, chat_queue = next(iter(lane.items()))
+                item = chat_queue.popleft()
+                self.sizes[priority] -= 1
+                if chat_queue:
+                    # Чат уходит в конец круга - следующим обслуживается другой чат
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+                return item
+        # Служебные объекты - после всех обновлений
+        return self.control.popleft()
+
+    def evict(self, priority):
+        """Выбросить самое старое обновление самого шумного чата с данным приоритетом"""
+        lane = self.lanes[priority]
+        if not lane:
+            return None
+        chat_id = max(lane, key=lambda c: len(lane[c]))
+        chat_queue = lane[chat_id]
+        item = chat_queue.popleft()
+        self.sizes[priority] -= 1
+        if not chat_queue:
+            del lane[chat_id]
+        return item
+
+
+class FairUpdateQueue(asyncio.Queue):
+    """
+    Очередь входящих обновлений с приоритетами и справедливостью между чатами
+    - кнопки и команды обслуживаются раньше обычных сообщений;
+    - внутри приоритета чаты обслуживаются по кругу, шумный чат не блокирует остальные;
+    - при перегрузке первыми отбрасываются пассивные сообщения (сбор пользователей);
+    - get() не выдаёт больше max_in_flight обновлений одновременно, поэтому
+      ожидающие обновления остаются здесь, а не в очереди задач Application
+    """
+    def __init__(self, maxsize=0, max_in_flight=0, passive_limit=None):
+        self.max_in_flight = max_in_flight
+        # Сколько мест могут занимать не приоритетные обновления
+        if passive_limit is None:
+            passive_limit = maxsize // 2
+        self.passive_limit = passive_limit
+        self.in_flight = 0
+        self.shed_count = 0
+        self._slot_freed = asyncio.Event()
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = _FairBuffer()
+
+    def _put(self, item):
+        self._queue.push(item)
+
+    def _get(self):
+        return self._queue.pop()
+
+    def _passive_size(self):
+        return self._queue.sizes[PRIORITY_TEXT] + self._queue.sizes[PRIORITY_PASSIVE]
+
+    def _shed(self, item):
+        self.shed_count += 1
+        if self.shed_count == 1 or self.shed_count % 100 == 0:
+            logger.warning(f"Update queue overloaded, shed {self.shed_count} low priority updates so far")
+        else:
+            logger.debug(f"Shed update {getattr(item, 'update_id', None)}")
+
+    def _evict_below(self, priority):
+        """Освободить место, выбросив обновление с более низким приоритетом"""
+        for lower in reversed(PRIORITIES):
+            if lower <= priority:
+                return False
+            evicted = self._queue.evict(lower)
+            if evicted is not None:
+                self._shed(evicted)
+                # Выброшенное обновление никогда не будет обработано
+                asyncio.Queue.task_done(self)
+                return True
+        return False
+
+    def _make_room(self, priority):
+        """True, если обновление можно поставить в очередь"""
+        if priority != PRIORITY_HIGH and self.passive_limit and self._passive_size() >= self.passive_limit:
+            if not self._evict_below(priority):
+                return False
+        if self.full() and not self._evict_below(priority):
+            return priority == PRIORITY_HIGH
+        return True
+
+    def put_nowait(self, item):
+        if isinstance(item, Update):
+            priority = classify_update(item)
+            if not self._make_room(priority):
+                # Пассивные обновления при перегрузке отбрасываются молча
+                self._shed(item)
+                return
+        super().put_nowait(item)
+
+    async def put(self, item):
+        if isinstance(item, Update):
+            priority = classify_update(item)
+            if priority != PRIORITY_HIGH:
+                # Не приоритетные обновления не ждут места в очереди
+                return self.put_nowait(item)
+            self._make_room(priority)
+        return await super().put(item)
+
+    async def get(self):
+        while self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        item = await super().get()
+        self.in_flight += 1
+        return item
+
+    def task_done(self):
+        super().task_done()
+        if self.in_flight:
+            self.in_flight -= 1
+            self._slot_freed.set()
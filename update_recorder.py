@@ -0,0 +1,202 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import re
+import secrets
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# Числа из 6 и более цифр в callback_data считаются id пользователей и чатов
+_ID_PATTERN = re.compile(r'-?\d{6,}')
+_WORD_PATTERN = re.compile(r'\S+')
+# Поля с пользователями и чатами внутри обновления
+_USER_KEYS = {'from', 'user', 'left_chat_member', 'via_bot'}
+_CHAT_KEYS = {'chat', 'sender_chat'}
+# Вложения и данные, которые боту не нужны и не записываются
+_DROP_KEYS = {
+    'photo', 'document', 'video', 'video_note', 'voice', 'audio', 'sticker', 'animation',
+    'contact', 'location', 'venue', 'poll', 'dice', 'reply_markup', 'author_signature',
+    'forward_origin', 'external_reply', 'quote', 'link_preview_options',
+}
+
+
+class UpdateAnonymizer:
+    """
+    Обезличивание обновлений
+    id пользователей и чатов заменяются на HMAC от соли (одинаковые id - одинаковые псевдонимы,
+    так что очереди и обмены при воспроизведении ведут себя так же), имена - на шаблонные,
+    слова в тексте - на 'x' той же длины. Команды, @упоминания и короткие числа сохраняются
+    """
+    def __init__(self, salt):
+        self.salt = salt.encode('utf-8')
+
+    def _digest(self, kind, value):
+        return hmac.new(self.salt, f"{kind}:{value}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def user_id(self, user_id):
+        return 10 ** 9 + int(self._digest('user', user_id)[:12], 16) % (10 ** 12)
+
+    def chat_id(self, chat_id):
+        if chat_id > 0:
+            # Личный чат: id совпадает с id пользователя
+            return self.user_id(chat_id)
+        return -(10 ** 12) - int(self._digest('chat', chat_id)[:12], 16) % (10 ** 11)
+
+    def username(self, username):
+        return 'u' + self._digest('username', username.lower())[:10]
+
+    def number(self, value):
+        value = int(value)
+        return self.chat_id(value) if value < 0 else self.user_id(value)
+
+    def text(self, text):
+        def replace(match):
+            word = match.group()
+            if word.startswith('@') and len(word) > 1:
+                return '@' + self.username(word[1:])
+            if match.start() == 0 and word.startswith('/'):
+                return word
+            if word.lstrip('-').isdigit():
+                return str(self.number(word)) if len(word.lstrip('-')) >= 6 else word
+            return 'x' * len(word)
+        # Пробелы и переводы строк сохраняются
+        return _WORD_PATTERN.sub(replace, text)
+
+    def user(self, user):
+        anonymous_id = self.user_id(user['id'])
+        result = {'id': anonymous_id, 'is_bot': user.get('is_bot', False), 'first_name': f"User{anonymous_id % 100000}"}
+        if user.get('last_name'):
+            result['last_name'] = 'L'
+        if user.get('username'):
+            result['username'] = self.username(user['username'])
+        return result
+
+    def chat(self, chat):
+        result = dict(chat, id=self.chat_id(chat['id']))
+        if 'title' in result:
+            result['title'] = f"Chat {result['id']}"
+        if result.get('username'):
+            result['username'] = self.username(result['username'])
+        for key in ('first_name', 'last_name'):
+            if key in result:
+                result[key] = 'User'
+        return result
+
+    def update(self, data):
+        """Обезличенная копия обновления (dict в формате Bot API)"""
+        return self._walk(data)
+
+    def _walk(self, data):
+        if isinstance(data, list):
+            return [self._walk(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            if key in _DROP_KEYS:
+                continue
+            if key in _USER_KEYS and isinstance(value, dict):
+                result[key] = self.user(value)
+            elif key == 'new_chat_members':
+                result[key] = [self.user(user) for user in value]
+            elif key in _CHAT_KEYS and isinstance(value, dict):
+                result[key] = self.chat(value)
+            elif key in ('text', 'caption') and isinstance(value, str):
+                result[key] = self.text(value)
+            elif key in ('entities', 'caption_entities'):
+                # Смещения остальных сущностей после замены текста неверны; команда остаётся на месте
+                commands = [e for e in value if e.get('type') == 'bot_command' and e.get('offset') == 0]
+                if commands:
+                    result[key] = commands
+            elif key == 'data' and isinstance(value, str):
+                result[key] = _ID_PATTERN.sub(lambda m: str(self.number(m.group())), value)
+            elif key == 'chat_instance':
+                result[key] = self._digest('instance', value)[:16]
+            else:
+                result[key] = self._walk(value)
+        return result
+
+
+class UpdateRecorder:
+    """
+    Запись входящих обновлений в сжатый JSON Lines файл
+    Каждая строка: {"ts": время получения, "update": обезличенное обновление}.
+    Строки копятся в буфере gzip и сбрасываются на диск периодической задачей
+    """
+    def __init__(self):
+        self.path = None
+        self.anonymizer = None
+        self.recorded = 0
+        self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def configure(self, path, salt=None):
+        """Включить запись. Без соли псевдонимы согласованы только в пределах одного запуска"""
+        self.path = path
+        self.anonymizer = UpdateAnonymizer(salt or secrets.token_hex(16))
+
+    async def record(self, update: Update, context):
+        if not self.enabled:
+            return
+        try:
+            line = json.dumps(
+                {'ts': round(time.time(), 3), 'update': self.anonymizer.update(update.to_dict())},
+                ensure_ascii=False, separators=(',', ':')
+            )
+            if self._file is None:
+                # Дописывание создаёт новый gzip-член: файл остаётся читаемым целиком
+                self._file = gzip.open(self.path, 'at', encoding='utf-8')
+            self._file.write(line + '\n')
+            self.recorded += 1
+        except Exception as e:
+            logger.error(f"Error recording update {update.update_id}: {e}")
+
+    def flush(self):
+        if self._file is not None:
+            try:
+                self._file.flush()
+            except Exception as e:
+                logger.error(f"Error flushing recorded updates: {e}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Recorded {self.recorded} updates to {self.path}")
+
+
+def read_recording(path):
+    """Чтение записи: (ts, update dict) по порядку. Поддерживаются .gz и обычный JSONL"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                yield record['ts'], record['update']
+
+
+async def callback_flush_recording(context):
+    """Периодический сброс записанных обновлений на диск"""
+    update_recorder.flush()
+
+
+def register_update_recorder(application):
+    """Запись всех обновлений до остальных обработчиков (группа -2)"""
+    application.add_handler(TypeHandler(Update, update_recorder.record), group=-2)
+    if application.job_queue:
+        application.job_queue.run_repeating(callback_flush_recording, interval=5, first=5)
+
+
+# Глобальный экземпляр
+update_recorder = UpdateRecorder()
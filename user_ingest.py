@@ -0,0 +1,54 @@
+import logging
+from telegram.ext import ContextTypes
+
+from queue_manager import queue_manager
+
+logger = logging.getLogger(__name__)
+
+
+class KnownUserIngestor:
+    """
+    Буферизованный сбор известных пользователей
+    Уже известные пользователи с неизменным профилем отсекаются одной проверкой по индексу,
+    новые и переименованные копятся в буфере (с дедупликацией) и записываются пачкой
+    """
+    def __init__(self, manager, max_pending=500):
+        self.manager = manager
+        self.max_pending = max_pending
+        # (chat_id, user_id): (first_name, last_name, username, is_bot)
+        self.pending = {}
+
+    def observe(self, chat_id, user):
+        """Учесть пользователя Telegram, увиденного в чате"""
+        if not user or not chat_id:
+            return
+        profile = (user.first_name, user.last_name, user.username, bool(user.is_bot))
+        if self.manager.known_user_matches(chat_id, user.id, *profile):
+            return
+
+        self.pending[(chat_id, user.id)] = profile
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        """Записать накопленных пользователей одним сохранением"""
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+        changed = self.manager.upsert_known_users(
+            (chat_id, user_id, *profile) for (chat_id, user_id), profile in batch.items()
+        )
+        logger.debug(f"Known users flushed: {len(batch)} pending, {changed} changed")
+        return changed
+
+
+async def callback_flush_known_users(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая запись буфера известных пользователей"""
+    try:
+        user_ingestor.flush()
+    except Exception as e:
+        logger.error(f"Error flushing known users: {e}")
+
+
+# Глобальный экземпляр
+user_ingestor = KnownUserIngestor(queue_manager)
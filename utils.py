@@ -1,10 +1,19 @@
+import asyncio
 import logging
+import time
 from telegram.ext import ContextTypes
+from telegram.error import TimedOut, NetworkError
+
+from tracing import traced
+from profiler import profiler
 
 from queue_manager import queue_manager  # Импорт, если нужен для таймеров
+from lock_manager import lock_manager, topic_serializer
+from keyboards import get_main_keyboard
 
 logger = logging.getLogger(__name__)
 
+@traced('render.safe_edit_message')
 async def safe_edit_message(context, chat_id, message_id, text, reply_markup):
     """Безопасное обновление сообщения с обработкой ошибок"""
     try:
@@ -20,6 +29,61 @@ async def safe_edit_message(context, chat_id, message_id, text, reply_markup):
         return False
 
 
+class CallbackAnswer:
+    """
+    Обёртка над CallbackQuery с ранним ответом на нажатие кнопки
+    Если обработчик не ответил сам за grace секунд, Telegram получает пустой ответ,
+    чтобы у пользователя пропали "часики". Уведомление, пришедшее после раннего ответа,
+    отбрасывается: уведомления адресованы нажавшему, и в общем топике их видели бы все.
+    Остальные атрибуты берутся из исходного query
+    """
+    def __init__(self, query, grace=0.0):
+        self._query = query
+        self._answered = False
+        self._auto_task = asyncio.create_task(self._auto_answer(grace))
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    @property
+    def answered(self) -> bool:
+        return self._answered
+
+    async def _auto_answer(self, grace):
+        if grace > 0:
+            await asyncio.sleep(grace)
+        await self._send()
+
+    async def _send(self, text=None, show_alert=False, **kwargs):
+        # Telegram принимает только один ответ на callback
+        if self._answered:
+            return False
+        self._answered = True
+        try:
+            await self._query.answer(text=text, show_alert=show_alert, **kwargs)
+            return True
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Timeout answering callback: {e}")
+        except Exception as e:
+            logger.error(f"Error answering callback: {e}")
+        return False
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        """Ответить с уведомлением. Если ранний ответ уже ушёл, уведомление не доставляется"""
+        if self._answered:
+            if text:
+                logger.debug(f"Callback already answered, notification dropped: {text}")
+            return False
+        self._auto_task.cancel()
+        return await self._send(text, show_alert, **kwargs)
+
+    async def finish(self):
+        """Ответить немедленно, если обработчик так и не ответил"""
+        if not self._answered:
+            self._auto_task.cancel()
+            await self._send()
+
+
 async def callback_delete_proposal(context: ContextTypes.DEFAULT_TYPE):
     """Удаление сообщения обмена по таймеру через 60 секунд"""
     job = context.job
@@ -56,8 +120,11 @@ async def callback_delete_proposal(context: ContextTypes.DEFAULT_TYPE):
         except Exception as edit_error:
             logger.error(f"Failed to edit expired swap message {message_id}: {edit_error}")
 
-    # Удаляем данные об обмене независимо от результата
+    # Удаляем данные об обмене независимо от результата и освобождаем топик инициатора
+    swap_data = queue_manager.get_pending_swap(swap_id)
     queue_manager.remove_pending_swap(swap_id)
+    if swap_data:
+        lock_manager.unlock_by_user(swap_data['topic_id'], swap_data['user1_id'])
     logger.info(f"Removed pending swap {swap_id} from storage")
 
 
@@ -75,6 +142,12 @@ async def callback_delete_selection(context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"Timeout callback triggered for selection {selection_id}, deleting message {message_id}")
 
+    # Выбор так и не сделан: освобождаем топик, если его всё ещё держит этот обмен
+    topic_id = job_data.get('topic_id')
+    lock_info = lock_manager.get_lock_info(topic_id) if topic_id else None
+    if lock_info and lock_info['user_id'] == job_data.get('user_id') and lock_info['operation'] == "обмен местами":
+        lock_manager.unlock(topic_id)
+
     try:
         await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
         logger.info(f"Successfully deleted selection message {message_id}")
@@ -209,4 +282,58 @@ async def send_temp_message(context, chat_id, topic_id, text, duration = 2):
         return temp_msg
     except Exception as e:
         logger.error(f"Error sending temp message: {e}")
-        return None
\ No newline at end of file
+        return None
+
+async def _expire_topic(context, chat_id, topic_id, kinds):
+    """Снятие истёкших записей топика и одно обновление сообщения с очередью"""
+    expired = queue_manager.expire_topic(topic_id, kinds, time.time())
+    if not expired:
+        return
+    main_message_id = queue_manager.get_queue_message_id(topic_id)
+    if chat_id and main_message_id:
+        await safe_edit_message(
+            context, chat_id, main_message_id,
+            queue_manager.get_queue_text(topic_id), get_main_keyboard()
+        )
+
+
+async def callback_expire_entries(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая проверка общей кучи сроков: истёкшие записи снимаются пачкой по топикам"""
+    try:
+        due = queue_manager.pop_due_expiry(time.time())
+    except Exception as e:
+        logger.error(f"Error expiring queue entries: {e}")
+        return
+    # Сроки уже извлечены из кучи: ошибка в одном топике не должна оставить остальные без проверки
+    for topic_id, kinds in due.items():
+        try:
+            chat_id = queue_manager.topic_to_chat.get(topic_id)
+            # Под блокировкой топика, как обработчики его обновлений
+            await topic_serializer.run(chat_id, topic_id, _expire_topic, context, chat_id, topic_id, kinds)
+        except Exception as e:
+            logger.error(f"Error expiring entries of topic {topic_id}: {e}")
+            # Срок наступил: топик проверится снова при следующем запуске задачи
+            queue_manager.postpone_expiry(topic_id, kinds, time.time())
+
+
+async def callback_profile_done(context: ContextTypes.DEFAULT_TYPE):
+    """Отчёт о завершении профилирования"""
+    job = context.job
+    if not job:
+        logger.error("No job context in callback_profile_done")
+        return
+
+    job_data = job.data
+    result = profiler.last_result
+    if profiler.running or not result or result['path'] != job_data['path']:
+        logger.error(f"Profile {job_data['path']} is not ready")
+        return
+
+    top = "\n".join(f"{count} - {label}" for label, count in result['top'])
+    await send_temp_message(
+        context, job_data['chat_id'], job_data['topic_id'],
+        f"✅ Профиль сохранён: {result['path']}\n"
+        f"Семплов: {result['samples']}\n\n"
+        f"Чаще всего выполнялись:\n{top}",
+        duration=60
+    )
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import urllib.error
+import urllib.request
+from telegram import Update
+
+from http_server import LocalHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class WebhookServer:
+    """
+    Приём обновлений от Telegram через webhook
+    Обновления кладутся в ограниченную очередь application.update_queue,
+    при переполнении Telegram получает 503 и повторяет доставку позже
+    """
+    def __init__(self, application, listen='127.0.0.1', port=8443, url_path='/telegram', secret_token=None):
+        self.application = application
+        self.secret_token = secret_token
+        self.url_path = url_path
+        self.http = LocalHTTPServer(listen, port)
+        self.http.route('POST', url_path, self._handle_update)
+
+    async def start(self):
+        await self.http.start()
+
+    async def stop(self):
+        await self.http.stop()
+
+    async def _handle_update(self, request):
+        # Проверка секретного токена из заголовка Telegram
+        if self.secret_token:
+            received = request.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+                logger.warning("Webhook request with invalid secret token rejected")
+                return 403, b'', {}
+
+        try:
+            data = json.loads(request.body)
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            return 400, b'', {}
+
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning(f"Update queue is full, rejecting update {update.update_id}")
+            return 503, b'', {'Retry-After': '1'}
+
+        return 200, b'', {}
+
+
+async def run_webhook(application, listen, port, url_path, secret_token=None, webhook_url=None):
+    """Запуск бота в режиме webhook до получения SIGINT/SIGTERM"""
+    server = WebhookServer(application, listen, port, url_path, secret_token)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка через KeyboardInterrupt
+            pass
+
+    async with application:
+        # post_init/post_shutdown вызываются так же, как в run_polling
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+
+        # Регистрируем webhook в Telegram только если задан публичный URL
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook registered: {webhook_url}")
+        else:
+            logger.info("WEBHOOK_URL is not set, webhook registration skipped")
+
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def post_updates(path, url, secret_token=None):
+    """Отправить записанные обновления (JSON Lines) на локальный webhook"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            request = urllib.request.Request(url, data=line.encode('utf-8'), method='POST')
+            request.add_header('Content-Type', 'application/json')
+            if secret_token:
+                request.add_header(SECRET_HEADER, secret_token)
+            update_id = json.loads(line).get('update_id')
+            try:
+                with urllib.request.urlopen(request) as response:
+                    print(f"{response.status} {update_id}")
+            except urllib.error.HTTPError as e:
+                print(f"{e.code} {update_id}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Отправка записанных обновлений на локальный webhook")
+    parser.add_argument('updates', help="Файл с обновлениями, по одному JSON на строку")
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', default=None)
+    args = parser.parse_args()
+    post_updates(args.updates, args.url, args.secret)